@@ -1,7 +1,9 @@
 class Addons:
     def update_settings(self, settings):
-        settings["SPIDER_MIDDLEWARES"]["scrapy_konne.core.ack.RequestAckMiddleware"] = 0
+        settings["SPIDER_MIDDLEWARES"]["scrapy_konne.middlewares.mqack.AckSignalMiddleware"] = 0
+        settings["SPIDER_MIDDLEWARES"]["scrapy_konne.middlewares.coordination.SeederLockMiddleware"] = 1
+        settings["DOWNLOADER_MIDDLEWARES"]["scrapy_konne.middlewares.mqack.AckSignalMiddleware"] = 1000
 
     @classmethod
     def from_crawler(cls, crawler):
-        return cls()
\ No newline at end of file
+        return cls()
@@ -0,0 +1,87 @@
+import time
+
+from redis import Redis
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from scrapy_konne.utils.fingerprint import FP_ENCODINGS, encode_fp, is_encoded_fp, is_url_fp
+
+
+def legacy_fp(member: bytes, encoding: str):
+    """需要迁移的十进制指纹成员，返回指纹整数，不需要迁移时返回None"""
+    if is_encoded_fp(member, encoding):
+        # 已经是新编码
+        return None
+    try:
+        fp = int(member)
+    except ValueError:
+        return None
+    # 游标、自增id等较小的数字不是指纹，运行时同样按十进制保存
+    return fp if is_url_fp(fp) else None
+
+
+def migrate_key(client: Redis, key: str, encoding: str, batch_size: int) -> tuple[int, int]:
+    """用ZSCAN遍历去重库，把十进制指纹原地改写为新编码，分数保持不变，返回(扫描数, 迁移数)"""
+    scanned = 0
+    migrated = 0
+    batch = {}
+    for member, score in client.zscan_iter(key, count=batch_size):
+        scanned += 1
+        fp = legacy_fp(member, encoding)
+        if fp is None:
+            continue
+        batch[member] = (encode_fp(fp, encoding), score)
+        if len(batch) >= batch_size:
+            migrated += rewrite(client, key, batch)
+            batch = {}
+    migrated += rewrite(client, key, batch)
+    return scanned, migrated
+
+
+def rewrite(client: Redis, key: str, batch: dict) -> int:
+    if not batch:
+        return 0
+    with client.pipeline(transaction=True) as pipe:
+        # 新成员已存在时保留较早的分数
+        pipe.zadd(key, {member: score for member, score in batch.values()}, lt=True)
+        pipe.zrem(key, *batch)
+        pipe.execute()
+    return len(batch)
+
+
+class Dupmigrate(ScrapyCommand):
+    requires_project = True
+    default_settings = {"LOG_ENABLED": False}
+
+    def syntax(self):
+        return "[options] <去重key，一般为爬虫类变量name>"
+
+    def short_desc(self):
+        return "把redis去重库中的十进制指纹原地迁移为二进制编码"
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument(
+            "--encoding",
+            choices=FP_ENCODINGS[1:],
+            help="目标编码，默认使用DUPEFILTER_FP_ENCODING",
+        )
+        parser.add_argument("--redis-url", help="redis地址，默认使用REDIS_URL")
+        parser.add_argument("--batch", type=int, default=1000, help="每批ZSCAN/改写的数量，默认1000")
+
+    def run(self, args, opts):
+        if len(args) != 1:
+            raise UsageError("参数数量不对")
+        encoding = opts.encoding or self.settings.get("DUPEFILTER_FP_ENCODING", "decimal")
+        if encoding not in FP_ENCODINGS[1:]:
+            raise UsageError(f"目标编码必须是{FP_ENCODINGS[1:]}之一")
+        client = Redis.from_url(opts.redis_url or self.settings.get("REDIS_URL"))
+        key = f"dupefilter:{args[0]}"
+        memory_before = client.memory_usage(key) or 0
+        start = time.time()
+        scanned, migrated = migrate_key(client, key, encoding, opts.batch)
+        memory_after = client.memory_usage(key) or 0
+        print(
+            f"\033[92m迁移完成: 扫描{scanned}个成员，改写{migrated}个，耗时{time.time() - start:.2f}秒，"
+            f"内存{memory_before / 1024 / 1024:.2f}MB -> {memory_after / 1024 / 1024:.2f}MB\033[0m"
+        )
+        print("\033[93m所有worker切换到新编码并迁移完成后，可以设置DUPEFILTER_FP_DUAL_READ = False\033[0m")
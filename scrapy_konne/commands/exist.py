@@ -4,7 +4,7 @@ import requests
 from scrapy.commands import ScrapyCommand
 from scrapy.exceptions import UsageError
 from scrapy.utils.project import get_project_settings
-from scrapy_konne.utils.fingerprint import get_url_fp
+from scrapy_konne.utils.fingerprint import encode_fp, get_url_fp
 
 settings = get_project_settings()
 
@@ -13,8 +13,10 @@ def redis_url_filter(url, source):
     redis_url = settings.get("REDIS_URL")
     client = Redis.from_url(redis_url)
     hash_value = get_url_fp(url)
-    result = client.zscore(f"dupefilter:{source}", hash_value)
-    return result//1000
+    member = encode_fp(hash_value, settings.get("DUPEFILTER_FP_ENCODING", "decimal"))
+    # 兼容迁移前的十进制成员
+    result = client.zscore(f"dupefilter:{source}", member) or client.zscore(f"dupefilter:{source}", hash_value)
+    return result//1000 if result else None
 
 
 
@@ -0,0 +1,149 @@
+import gzip
+import struct
+import time
+
+import ormsgpack
+from redis import Redis
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from scrapy.utils.misc import load_object
+from scrapy_konne.core.mq import RedisQueue
+
+FILE_VERSION = 1
+RECORD_SIZE = struct.Struct(">I")
+
+
+def write_record(file, record):
+    data = ormsgpack.packb(record)
+    file.write(RECORD_SIZE.pack(len(data)))
+    file.write(data)
+
+
+def read_records(file):
+    while header := file.read(RECORD_SIZE.size):
+        (size,) = RECORD_SIZE.unpack(header)
+        yield ormsgpack.unpackb(file.read(size))
+
+
+def queue_suffixes(client: Redis, key: str) -> list[str]:
+    """请求队列及其所有分片相对于队列key的后缀"""
+    return [""] + [f":shard:{shard.decode()}" for shard in client.smembers(f"{key}:shards")]
+
+
+def export_queue(client: Redis, key: str, file, batch_size: int) -> int:
+    """用ZSCAN流式导出队列和租约中的请求，租约中的请求按原分数导出"""
+    count = 0
+    for suffix in queue_suffixes(client, key):
+        queue_key = f"{key}{suffix}"
+        for member, score in client.zscan_iter(queue_key, count=batch_size):
+            write_record(file, [suffix, member, int(score)])
+            count += 1
+        leases = []
+        for member, _ in client.zscan_iter(f"{queue_key}:lease", count=batch_size):
+            leases.append(member)
+            if len(leases) >= batch_size:
+                count += export_leases(client, queue_key, suffix, leases, file)
+                leases = []
+        count += export_leases(client, queue_key, suffix, leases, file)
+    return count
+
+
+def export_leases(client: Redis, queue_key: str, suffix: str, members: list[bytes], file) -> int:
+    if not members:
+        return 0
+    # 缺少原分数时按默认优先级立即就绪
+    default_score = RedisQueue.PRIORITY_RANGE * RedisQueue.BAND_WIDTH + int(time.time() * 1000)
+    for member, score in zip(members, client.hmget(f"{queue_key}:lease_score", members)):
+        write_record(file, [suffix, member, default_score if score is None else int(float(score))])
+    return len(members)
+
+
+class Queue(ScrapyCommand):
+    requires_project = True
+    default_settings = {"LOG_ENABLED": False}
+
+    def syntax(self):
+        return "[options] export|import <爬虫类变量name> <文件路径>"
+
+    def short_desc(self):
+        return "导出或导入redis请求队列，用于热重启和迁移"
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument("--redis-url", help="redis地址，默认使用REDIS_URL")
+        parser.add_argument("--batch", type=int, default=1000, help="每批ZSCAN/ZADD的数量，默认1000")
+        parser.add_argument("--serializer", help="导入时用该序列化器重新编码请求，默认不重新编码")
+
+    def run(self, args, opts):
+        if len(args) != 3 or args[0] not in ("export", "import"):
+            raise UsageError("参数不对")
+        action, name, path = args
+        client = Redis.from_url(opts.redis_url or self.settings.get("REDIS_URL"))
+        key = f"request_queue:{name}"
+        start = time.time()
+        if action == "export":
+            count = self.export(client, key, name, path, opts)
+        else:
+            count = self.import_(client, key, name, path, opts)
+        elapsed = max(time.time() - start, 1e-6)
+        print(f"\033[92m{action}完成: {count}个请求，耗时{elapsed:.2f}秒，{count / elapsed:.0f}个/秒\033[0m")
+
+    def export(self, client, key, name, path, opts):
+        with gzip.open(path, "wb") as file:
+            header = {"version": FILE_VERSION, "spider": name, "serializer": self.settings.get("REDIS_SERIALIZER")}
+            write_record(file, header)
+            return export_queue(client, key, file, opts.batch)
+
+    def import_(self, client, key, name, path, opts):
+        reencode = None
+        with gzip.open(path, "rb") as file:
+            records = read_records(file)
+            header = next(records)
+            if header.get("version") != FILE_VERSION:
+                raise UsageError(f"不支持的文件版本: {header.get('version')}")
+            if opts.serializer and opts.serializer != header["serializer"]:
+                crawler = self.crawler_process.create_crawler(name)
+                spider = crawler.spidercls.from_crawler(crawler)
+                source = load_object(header["serializer"])(spider)
+                target = load_object(opts.serializer)(spider)
+
+                def reencode(member):
+                    return target.serialize(source.deserialize(member))
+
+            count = 0
+            failed = 0
+            batch = []
+            for suffix, member, score in records:
+                if reencode:
+                    try:
+                        member = reencode(member)
+                    except Exception as e:
+                        failed += 1
+                        print(f"\033[91m重新编码失败，跳过: {e}\033[0m")
+                        continue
+                batch.append((suffix, member, score))
+                if len(batch) >= opts.batch:
+                    count += self.restore(client, key, batch)
+                    batch = []
+            count += self.restore(client, key, batch)
+        if failed:
+            print(f"\033[91m共{failed}个请求重新编码失败\033[0m")
+        return count
+
+    def restore(self, client: Redis, key: str, batch) -> int:
+        """按队列分组，通过pipeline批量写入请求、分段和分片"""
+        if not batch:
+            return 0
+        queues = {}
+        for suffix, member, score in batch:
+            queues.setdefault(suffix, {})[member] = score
+        with client.pipeline(transaction=False) as pipe:
+            for suffix, members in queues.items():
+                queue_key = f"{key}{suffix}"
+                bands = {score // RedisQueue.BAND_WIDTH for score in members.values()}
+                pipe.zadd(queue_key, members)
+                pipe.zadd(f"{queue_key}:bands", {band: band for band in bands})
+                if suffix.startswith(":shard:"):
+                    pipe.sadd(f"{key}:shards", suffix[len(":shard:") :])
+            pipe.execute()
+        return len(batch)
@@ -0,0 +1,74 @@
+from pathlib import Path
+from redis import Redis
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from scrapy.utils.misc import load_object
+from scrapy.utils.project import data_path
+from scrapy_konne.core.serializer import ZstdSerializer
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def sample_requests(client: Redis, key: str, count: int) -> list[bytes]:
+    """从请求队列及其分片中随机采样请求"""
+    keys = [key, f"{key}:lease"]
+    for shard in client.smembers(f"{key}:shards"):
+        shard = shard.decode()
+        keys += [f"{key}:shard:{shard}", f"{key}:shard:{shard}:lease"]
+    samples = []
+    for queue_key in keys:
+        if len(samples) >= count:
+            break
+        samples += client.zrandmember(queue_key, count - len(samples)) or []
+    return samples
+
+
+class Zdict(ScrapyCommand):
+    requires_project = True
+    default_settings = {"LOG_ENABLED": False}
+
+    def syntax(self):
+        return "[options] <爬虫类变量name>"
+
+    def short_desc(self):
+        return "从redis请求队列中采样，训练爬虫的zstd压缩字典"
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument("--samples", type=int, default=5000, help="采样的请求数量，默认5000")
+        parser.add_argument("--size", type=int, default=112640, help="字典大小（字节），默认110KB")
+
+    def run(self, args, opts):
+        if len(args) != 1:
+            raise UsageError("参数数量不对")
+        if zstandard is None:
+            raise UsageError("训练字典需要安装zstandard: pip install scrapy-konne[zstd]")
+        name = args[0]
+        crawler = self.crawler_process.create_crawler(name)
+        spider = crawler.spidercls.from_crawler(crawler)
+        serializer = load_object(self.settings.get("REDIS_SERIALIZER"))(spider)
+        client = Redis.from_url(self.settings.get("REDIS_URL"))
+        members = sample_requests(client, f"request_queue:{name}", opts.samples)
+        if isinstance(serializer, ZstdSerializer):
+            samples = [serializer.unwrap(member) for member in members]
+        else:
+            samples = members
+        if len(samples) < 100:
+            print(f"\033[91m请求队列中只有{len(samples)}个请求，样本太少，无法训练字典\033[0m")
+            return
+        dictionary = zstandard.train_dictionary(opts.size, samples)
+        dict_dir = Path(self.settings.get("ZSTD_DICT_DIR") or data_path("zstd_dicts", createdir=True))
+        path = dict_dir / f"{name}.{dictionary.dict_id()}.zdict"
+        path.write_bytes(dictionary.as_bytes())
+        level = self.settings.getint("ZSTD_LEVEL", 3)
+        raw_size = sum(map(len, samples))
+        plain_size = sum(len(zstandard.ZstdCompressor(level=level).compress(sample)) for sample in samples)
+        compressor = zstandard.ZstdCompressor(level=level, dict_data=dictionary)
+        dict_size = sum(len(compressor.compress(sample)) for sample in samples)
+        print(f"样本{len(samples)}个，平均{raw_size / len(samples):.0f}字节")
+        print(f"无字典压缩后平均{plain_size / len(samples):.0f}字节，压缩率{plain_size / raw_size:.2%}")
+        print(f"字典压缩后平均{dict_size / len(samples):.0f}字节，压缩率{dict_size / raw_size:.2%}")
+        print(f"\033[92m字典已保存到{path}，分发到所有worker后生效\033[0m")
@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import math
+from typing import Optional
+
+import mmh3
+from redis import Redis
+from redis.exceptions import RedisError
+from scrapy import Request, Spider
+from scrapy.crawler import Crawler
+from scrapy.dupefilters import BaseDupeFilter
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.request import referer_str
+from scrapy_konne.utils.cache import MicroBatcher
+
+logger = logging.getLogger(__name__)
+
+
+class RedisBloomDupeFilter(BaseDupeFilter):
+    """
+    基于redis位图的布隆过滤器请求去重，不依赖RedisBloom模块，多个worker共享同一个过滤器。
+
+    位图大小和哈希函数个数由预期请求数``BLOOM_EXPECTED_ITEMS``和误判率``BLOOM_ERROR_RATE``计算，内存占用固定。
+    每次判断通过一条BITFIELD命令设置全部位，根据返回的旧值判断请求是否已存在，检查和写入原子完成。
+    位图超过redis字符串的上限（2^32位）时拆分为多个块，同一请求的所有位落在同一个块中。
+
+    RedisScheduler使用异步接口``async_request_seen``，``BLOOM_BATCH_WINDOW``秒内或攒够``BLOOM_BATCH_SIZE``个请求后
+    通过全局异步redis连接的一个pipeline批量判断，不阻塞事件循环；同步接口``request_seen``保留给其他调度器。
+
+    过滤器保存在``request_bloom:{爬虫名}``，爬虫正常结束时清空，设置``BLOOM_PERSIST``后保留到下次运行。
+    开启``SCHEDULER_COORDINATED``时其他worker可能仍在使用过滤器，默认保留。
+    使用时设置``DUPEFILTER_CLASS = "scrapy_konne.core.dupefilter.RedisBloomDupeFilter"``。
+    """
+
+    MAX_BLOCK_BITS = 2**32
+    """redis字符串最多能保存的位数"""
+
+    def __init__(
+        self,
+        crawler: Crawler,
+        redis_url: str,
+        expected_items=10_000_000,
+        error_rate=0.0001,
+        persist=False,
+        debug=False,
+        batch_window=0.002,
+        batch_size=500,
+    ) -> None:
+        self.crawler = crawler
+        self.redis_url = redis_url
+        self.persist = persist
+        # 同一批次中的相同请求按顺序执行，后一个能看到前一个设置的位，因此不共享查询
+        self.batcher = MicroBatcher(self.bitfield_batch, batch_window, batch_size, share=False)
+        self.debug = debug
+        self.logdupes = True
+        bits = math.ceil(-expected_items * math.log(error_rate) / math.log(2) ** 2)
+        self.hash_count = max(round(bits / expected_items * math.log(2)), 1)
+        self.block_count = math.ceil(bits / self.MAX_BLOCK_BITS)
+        self.block_bits = math.ceil(bits / self.block_count)
+        self.client: Optional[Redis] = None
+        self.key = None
+
+    @classmethod
+    def from_crawler(cls, crawler: Crawler):
+        settings = crawler.settings
+        redis_url = settings.get("REDIS_URL")
+        if not redis_url:
+            raise NotConfigured("REDIS_URL 未设置")
+        return cls(
+            crawler=crawler,
+            redis_url=redis_url,
+            expected_items=settings.getint("BLOOM_EXPECTED_ITEMS", 10_000_000),
+            error_rate=settings.getfloat("BLOOM_ERROR_RATE", 0.0001),
+            persist=settings.getbool("BLOOM_PERSIST", settings.getbool("SCHEDULER_COORDINATED", False)),
+            debug=settings.getbool("DUPEFILTER_DEBUG"),
+            batch_window=settings.getfloat("BLOOM_BATCH_WINDOW", 0.002),
+            batch_size=settings.getint("BLOOM_BATCH_SIZE", 500),
+        )
+
+    @property
+    def redis_client(self):
+        if not getattr(self, "_redis_client", None):
+            self._redis_client = getattr(self.crawler, "redis_client", None)
+            if self._redis_client is None:
+                raise RuntimeError("未找到全局redis连接，请开启GlobalAsyncRedisExtension拓展")
+        return self._redis_client
+
+    def open(self):
+        self.key = f"request_bloom:{self.crawler.spider.name}"
+        self.client = Redis.from_url(self.redis_url, socket_timeout=10)
+        logger.info(
+            f"布隆过滤器{self.key}: {self.block_count}个块，每块{self.block_bits}位，{self.hash_count}个哈希函数"
+        )
+
+    def close(self, reason):
+        if self.client is None:
+            return
+        if reason == "finished" and not self.persist:
+            self.client.delete(*self.block_keys())
+            logger.info(f"爬虫正常结束，清空布隆过滤器{self.key}")
+        self.client.close()
+
+    def block_keys(self) -> list[str]:
+        if self.block_count == 1:
+            return [self.key]
+        return [f"{self.key}:{block}" for block in range(self.block_count)]
+
+    def offsets(self, fingerprint: bytes) -> tuple[str, list[int]]:
+        """请求指纹所在的块和位偏移，使用双重哈希生成多个位置"""
+        h1, h2 = mmh3.hash64(fingerprint, signed=False)
+        block = h1 % self.block_count
+        key = self.key if self.block_count == 1 else f"{self.key}:{block}"
+        return key, [(h1 + i * h2) % self.block_bits for i in range(self.hash_count)]
+
+    @staticmethod
+    def bitfield_args(offsets: list[int]) -> list:
+        """一次设置全部位并返回旧值的BITFIELD参数"""
+        args = []
+        for offset in offsets:
+            args += ["SET", "u1", offset, 1]
+        return args
+
+    def request_seen(self, request: Request) -> bool:
+        fingerprint = self.crawler.request_fingerprinter.fingerprint(request)
+        key, offsets = self.offsets(fingerprint)
+        return all(self.client.execute_command("BITFIELD", key, *self.bitfield_args(offsets)))
+
+    def async_request_seen(self, request: Request) -> asyncio.Future:
+        """合并同一时间窗口内的判断，返回的future结果为请求是否已存在"""
+        fingerprint = self.crawler.request_fingerprinter.fingerprint(request)
+        return self.batcher.submit(self.offsets(fingerprint))
+
+    async def bitfield_batch(self, batch: list[tuple[str, list[int]]]) -> list[bool]:
+        """通过一个pipeline执行一批BITFIELD"""
+        try:
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                for key, offsets in batch:
+                    pipe.execute_command("BITFIELD", key, *self.bitfield_args(offsets))
+                results = await pipe.execute()
+        except (RedisError, RuntimeError) as e:
+            # 判断失败时放行请求，宁可重复抓取也不丢失请求
+            logger.error(f"布隆过滤器批量判断{len(batch)}个请求失败，全部放行: {e}")
+            results = [[0]] * len(batch)
+        self.crawler.stats.inc_value("dupefilter/bloom/batches", spider=self.crawler.spider)
+        return [all(old_bits) for old_bits in results]
+
+    def log(self, request: Request, spider: Spider):
+        if self.debug:
+            msg = "Filtered duplicate request: %(request)s (referer: %(referer)s)"
+            args = {"request": request, "referer": referer_str(request)}
+            logger.debug(msg, args, extra={"spider": spider})
+        elif self.logdupes:
+            msg = "Filtered duplicate request: %(request)s - no more duplicates will be shown (see DUPEFILTER_DEBUG to show all duplicates)"
+            logger.debug(msg, {"request": request}, extra={"spider": spider})
+            self.logdupes = False
+        self.crawler.stats.inc_value("dupefilter/filtered", spider=spider)
@@ -1,7 +1,21 @@
 from abc import ABCMeta, abstractmethod
+import asyncio
+from collections import defaultdict, deque
+from itertools import count, zip_longest
+from typing import Optional
+import heapq
+import logging
+import os
+import struct
+import tempfile
 import time
-import redis
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
 from scrapy.utils.misc import load_object
+from scrapy.utils.project import data_path
+from scrapy_konne.items import DetailDataItem
+
+logger = logging.getLogger(__name__)
 
 
 class Singleton(type):
@@ -12,8 +26,10 @@ class Singleton(type):
 
 
 class BaseMessageQueue(metaclass=ABCMeta):
-    def __init__(self, crawler, key, client, serializer=None) -> None:
-        self.client = client
+    requires_ack = False
+    """出队的请求是否需要ack，需要时调度器会检查是否开启了AckSignalMiddleware"""
+
+    def __init__(self, crawler, key, serializer=None) -> None:
         self.key = key
         self.serializer = serializer
         self.crawler = crawler
@@ -30,63 +46,910 @@ class BaseMessageQueue(metaclass=ABCMeta):
     def pop(self):
         raise NotImplementedError("pop method must be implemented")
 
+    @abstractmethod
+    def __len__(self):
+        raise NotImplementedError("__len__ method must be implemented")
+
+    def ack(self, request):
+        pass
+
+    def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def _wake_engine(self):
+        """有请求可以出队时唤醒引擎，避免等待引擎心跳"""
+        slot = getattr(self.crawler.engine, "slot", None)
+        if slot is not None:
+            slot.nextcall.schedule()
+
+
+class PriorityScoreMixin:
+    """
+    请求分数的计算规则，分数由优先级分段和就绪时间组成：``分段 * BAND_WIDTH + 就绪时间戳``，
+    优先级越高分段越小，同一分段内按就绪时间先进先出。
+    """
+
+    BAND_WIDTH = 10**13
+    """每个优先级分段的分数宽度，大于毫秒时间戳的取值范围"""
+    PRIORITY_RANGE = 400
+    """优先级的取值范围，超出范围的优先级会被截断"""
+
+    def priority_of(self, request) -> int:
+        """请求的有效优先级，深度优先时叠加请求深度，携带item的详情页请求再提升一级"""
+        priority = request.priority
+        if self.depth_first:
+            priority += request.meta.get("depth", 0)
+            if request.meta.get("filter_url") or request.meta.get("cursor") or any(
+                isinstance(value, DetailDataItem) for value in request.cb_kwargs.values()
+            ):
+                priority += 1
+        return priority
+
+    def ready_ms_of(self, request) -> int:
+        """请求的就绪时间，延迟重试的请求在meta中携带``mq_ready_at``"""
+        ready_at = request.meta.pop("mq_ready_at", None)
+        return int((ready_at or time.time()) * 1000)
+
+    def score_of(self, request) -> int:
+        priority = min(max(self.priority_of(request), -self.PRIORITY_RANGE), self.PRIORITY_RANGE)
+        band = self.PRIORITY_RANGE - priority
+        return band * self.BAND_WIDTH + self.ready_ms_of(request)
+
 
-class RedisQueue(BaseMessageQueue):
+class RedisQueue(PriorityScoreMixin, BaseMessageQueue):
+    """
+    基于redis有序集合的异步请求队列。
 
-    def __init__(self, crawler, key, client: redis.Redis, serializer=None) -> None:
-        BaseMessageQueue.__init__(self, crawler, key, client, serializer)
-        self._register_scripts()
-        self.send_buffer = client.pipeline()
-        self.recevie_buffer = client.pipeline()
+    复用GlobalAsyncRedisExtension挂载在crawler上的异步连接池，push时先写入本地缓冲区，
+    缓冲区达到``REDIS_MQ_BATCH_SIZE``或每隔``REDIS_MQ_FLUSH_INTERVAL``秒通过pipeline批量ZADD到redis，
+    pop时从本地接收缓冲区取出请求，缓冲区为空时在后台从redis拉取，拉取完成后唤醒引擎。
+
+    设置``REDIS_MQ_PREFETCH``大于1时开启预取，每次从redis租约多个请求到接收缓冲区，
+    缓冲区低于``REDIS_MQ_PREFETCH_LOW_WATERMARK``时在后台补充，关闭时未消费的请求会按原分数归还redis。
+
+    拉取的请求会从队列移入租约集合``{key}:lease``，租约时长为``REDIS_MQ_LEASE_DURATION``秒，
+    持有期间定时续约，请求处理完毕后ack删除租约；只有真正过期（持有者已失联）的租约才会被回收到队列。
+    ack依赖AckSignalMiddleware，离开引擎却没有被ack的租约（如下载中间件process_response中忽略的请求）会在续约时确认。
+
+    分数由优先级分段和就绪时间组成：``分段 * BAND_WIDTH + 就绪时间戳``，优先级越高分段越小，
+    拉取时按分段从小到大取出已就绪的请求，同一分段内按就绪时间先进先出，``{key}:bands``记录非空的分段。
+    开启``REDIS_MQ_DEPTH_FIRST``后，越深的请求和携带item的详情页请求优先级越高，使item尽早完成上传。
+    """
+
+    requires_ack = True
+
+    def __init__(
+        self,
+        crawler,
+        key,
+        serializer=None,
+        batch_size=100,
+        flush_interval=0.5,
+        prefetch=1,
+        low_watermark=0,
+        lease_duration=60,
+        depth_first=False,
+        size_sync_interval=5,
+    ) -> None:
+        BaseMessageQueue.__init__(self, crawler, key, serializer)
+        self.lease_key = f"{key}:lease"
+        self.lease_score_key = f"{key}:lease_score"
+        self.bands_key = f"{key}:bands"
+        self.seeder_key = f"{key}:seeder"
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.prefetch = max(prefetch, 1)
+        self.low_watermark = min(low_watermark, self.prefetch - 1)
+        self.lease_duration_ms = int(lease_duration * 1000)
+        self.depth_first = depth_first
+        self.size_sync_interval = size_sync_interval
+        # 待写入的请求，队列key -> {序列化数据: 分数}
+        self.send_buffer: defaultdict[str, dict[bytes, int]] = defaultdict(dict)
+        # 待确认的租约，元素为(队列key, 序列化数据)
+        self.ack_buffer: list[tuple[str, bytes]] = []
+        # 预取的请求，元素为(队列key, 序列化数据, 原分数)
+        self.recevie_buffer: deque[tuple[str, bytes, float]] = deque()
+        # 已交给引擎、尚未ack的租约，租约id -> (队列key, 序列化数据)
+        self.leases: dict[int, tuple[str, bytes]] = {}
+        self._lease_ids = count(1)
+        # 上次检查时已不在引擎中的租约id，连续两次检查都不在引擎中时视为泄漏
+        self._orphan_leases: set[int] = set()
+        # redis中的队列长度，本地随写入、拉取增减，定时与redis校正，None表示还未同步
+        self.remote_size = None
+        # redis中所有worker持有的租约数量，随队列长度一起校正
+        self.remote_leases = None
+        # 种子锁是否存在，存在时即使队列为空也不能结束
+        self.remote_seeding = 0
+        # 精确统计确认队列已空，本地计数归零时需要确认后才返回0
+        self.confirmed_empty = False
+        # 正在写入redis的请求数，写入完成前也计入队列长度
+        self.flushing_count = 0
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+        self._fetch_task = None
+        self._timer = None
+        self._lease_timer = None
+        self._size_timer = None
+        self._exact_task = None
 
     @classmethod
     def from_crawler(cls, crawler, key, *args, **kwargs):
-        redis_url = crawler.settings.get("REDIS_URL")
-        client = redis.Redis.from_url(redis_url)
-        serializer_class = load_object(crawler.settings.get("REDIS_SERIALIZER"))
+        settings = crawler.settings
+        serializer_class = load_object(settings.get("REDIS_SERIALIZER"))
         serializer = serializer_class(crawler.spider)
-        return cls(crawler=crawler, client=client, key=key, serializer=serializer)
+        prefetch = settings.getint("REDIS_MQ_PREFETCH", 1)
+        return cls(
+            crawler=crawler,
+            key=key,
+            serializer=serializer,
+            batch_size=settings.getint("REDIS_MQ_BATCH_SIZE", 100),
+            flush_interval=settings.getfloat("REDIS_MQ_FLUSH_INTERVAL", 0.5),
+            prefetch=prefetch,
+            low_watermark=settings.getint("REDIS_MQ_PREFETCH_LOW_WATERMARK", prefetch // 2),
+            lease_duration=settings.getfloat("REDIS_MQ_LEASE_DURATION", 60),
+            depth_first=settings.getbool("REDIS_MQ_DEPTH_FIRST", False),
+            size_sync_interval=settings.getfloat("REDIS_MQ_SIZE_SYNC_INTERVAL", 5),
+        )
+
+    @property
+    def redis_client(self) -> Redis:
+        if not getattr(self, "_redis_client", None):
+            self._redis_client = getattr(self.crawler, "redis_client", None)
+            if self._redis_client is None:
+                raise RuntimeError("未找到全局redis连接，请开启GlobalAsyncRedisExtension拓展")
+        return self._redis_client
 
     def _register_scripts(self):
+        # 取出到期的请求，移入租约集合并记录原分数
         pop_lt_score_scrpits = """
-        local elements = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[3])
-        if #elements > 0 then
-            redis.call('ZADD', KEYS[1], ARGV[2], unpack(elements))
+        local width = tonumber(ARGV[4])
+        local remaining = tonumber(ARGV[3])
+        local elements = {}
+        -- 队首所在的分段一定要登记，兼容旧版本仅以时间戳为分数的队列
+        local head = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+        if #head > 0 then
+            local head_band = math.floor(tonumber(head[2]) / width)
+            redis.call('ZADD', KEYS[4], head_band, head_band)
+        end
+        for _, band in ipairs(redis.call('ZRANGE', KEYS[4], 0, -1)) do
+            local base = tonumber(band) * width
+            local ready = redis.call(
+                'ZRANGEBYSCORE', KEYS[1], string.format('%.0f', base), string.format('%.0f', base + ARGV[1]),
+                'WITHSCORES', 'LIMIT', 0, remaining
+            )
+            for i = 1, #ready, 2 do
+                redis.call('ZREM', KEYS[1], ready[i])
+                redis.call('ZADD', KEYS[2], ARGV[2], ready[i])
+                redis.call('HSET', KEYS[3], ready[i], ready[i + 1])
+                elements[#elements + 1] = ready[i]
+                elements[#elements + 1] = ready[i + 1]
+            end
+            remaining = remaining - #ready / 2
+            local last = string.format('%.0f', base + width - 1)
+            if redis.call('ZCOUNT', KEYS[1], string.format('%.0f', base), last) == 0 then
+                redis.call('ZREM', KEYS[4], band)
+            end
+            if remaining <= 0 then
+                break
+            end
         end
         return elements
         """
-        self._execute_pop_lt_score = self.client.register_script(pop_lt_score_scrpits)
+        # 将过期的租约按原分数放回队列
+        requeue_expired_scripts = """
+        local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+        for _, member in ipairs(expired) do
+            local score = redis.call('HGET', KEYS[3], member) or ARGV[1]
+            local band = math.floor(tonumber(score) / ARGV[3])
+            redis.call('ZADD', KEYS[1], score, member)
+            redis.call('ZADD', KEYS[4], band, band)
+            redis.call('ZREM', KEYS[2], member)
+            redis.call('HDEL', KEYS[3], member)
+        end
+        return #expired
+        """
+        # 将租约按原分数归还队列
+        give_back_scripts = """
+        for i = 2, #ARGV do
+            local member = ARGV[i]
+            local score = redis.call('HGET', KEYS[3], member)
+            if score and redis.call('ZREM', KEYS[2], member) == 1 then
+                local band = math.floor(tonumber(score) / ARGV[1])
+                redis.call('ZADD', KEYS[1], score, member)
+                redis.call('ZADD', KEYS[4], band, band)
+            end
+            redis.call('HDEL', KEYS[3], member)
+        end
+        """
+        self._execute_pop_lt_score = self.redis_client.register_script(pop_lt_score_scrpits)
+        self._execute_requeue_expired = self.redis_client.register_script(requeue_expired_scripts)
+        self._execute_give_back = self.redis_client.register_script(give_back_scripts)
 
-    def pop_lt_score(self, key, score, count):
-        elements = self._execute_pop_lt_score(
-            keys=[key],
-            args=[score, score + 20000, count],
-            # client=self.client,
-        )
-        return elements[0] if elements else None
+    @staticmethod
+    def script_keys(queue_key):
+        return [queue_key, f"{queue_key}:lease", f"{queue_key}:lease_score", f"{queue_key}:bands"]
+
+    def open(self):
+        loop = asyncio.get_event_loop()
+        self._timer = loop.create_task(self.flush_timer())
+        self._lease_timer = loop.create_task(self.lease_timer())
+        self._size_timer = loop.create_task(self.size_timer())
+
+    async def wait_redis_client(self):
+        """全局redis连接在spider_opened中异步建立，可能晚于队列打开，访问redis前先等待其就绪"""
+        for _ in range(100):
+            if getattr(self.crawler, "redis_client", None) is not None:
+                return
+            await asyncio.sleep(0.1)
+
+    async def flush_timer(self):
+        """定时将缓冲区中的请求写入redis"""
+        await self.wait_redis_client()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def lease_timer(self):
+        """定时为持有的租约续约，并回收已过期的租约"""
+        await self.wait_redis_client()
+        while True:
+            await asyncio.sleep(self.lease_duration_ms / 3000)
+            try:
+                self.release_orphaned_leases()
+                await self.renew_leases()
+                await self.requeue_expired()
+            except (RedisError, RuntimeError) as e:
+                logger.error(f"请求租约续约失败: {e}")
+
+    async def size_timer(self):
+        """定时从redis校正队列长度，其他worker写入的请求也在此时计入"""
+        await self.wait_redis_client()
+        while True:
+            try:
+                await self.sync_size()
+            except (RedisError, RuntimeError) as e:
+                logger.error(f"同步请求队列长度失败: {e}")
+            await asyncio.sleep(self.size_sync_interval)
+
+    async def sync_size(self):
+        """统计redis中各队列的长度、租约数量，以及是否有worker正在写入种子请求"""
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for queue_key in self.queue_keys:
+                pipe.zcard(queue_key)
+                pipe.zcard(f"{queue_key}:lease")
+            pipe.exists(self.seeder_key)
+            *results, seeding = await pipe.execute()
+        self.remote_size = sum(results[0::2])
+        self.remote_leases = sum(results[1::2])
+        self.remote_seeding = seeding
+
+    def adjust_size(self, delta):
+        """按本地的写入、拉取和回收增减队列长度，校正前的误差由sync_size修正"""
+        if self.remote_size is not None:
+            self.remote_size = max(self.remote_size + delta, 0)
+
+    def queue_key_of(self, request) -> str:
+        """请求所属的队列key"""
+        return self.key
+
+    @property
+    def queue_keys(self) -> list[str]:
+        """当前所有的队列key"""
+        return [self.key]
+
+    def fetch_plan(self, fetch_count) -> list[tuple[str, int]]:
+        """本次拉取的队列key及各自的拉取数量"""
+        return [(self.key, fetch_count)]
 
     def push(self, request):
+        score = self.score_of(request)
         bindata = self.serializer.serialize(request)
-        timestamp = int(time.time() * 1000)
-        data = {bindata: timestamp}
-        self.client.zadd(self.key, data)
+        self.send_buffer[self.queue_key_of(request)][bindata] = score
+        delay = score % self.BAND_WIDTH / 1000 - time.time()
+        if delay > 0:
+            # 延迟重试的请求到期后主动拉取
+            asyncio.get_event_loop().call_later(delay, self._schedule_fetch)
+        self.confirmed_empty = False
+        self._schedule_flush()
+
+    @property
+    def send_count(self) -> int:
+        return sum(len(batch) for batch in self.send_buffer.values())
+
+    def _schedule_flush(self):
+        buffered = self.send_count + len(self.ack_buffer)
+        if buffered >= self.batch_size and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.get_event_loop().create_task(self.flush())
+
+    def _register_queue_keys(self, pipe, queue_keys):
+        """写入请求时登记队列key"""
+
+    async def flush(self):
+        """将缓冲区中的请求和ack通过pipeline批量写入redis"""
+        async with self._flush_lock:
+            if not self.send_buffer and not self.ack_buffer:
+                return
+            await self.wait_redis_client()
+            batches, self.send_buffer = self.send_buffer, defaultdict(dict)
+            acks, self.ack_buffer = self.ack_buffer, []
+            self.flushing_count = sum(map(len, batches.values()))
+            try:
+                async with self.redis_client.pipeline(transaction=False) as pipe:
+                    for queue_key, batch in batches.items():
+                        bands = {score // self.BAND_WIDTH for score in batch.values()}
+                        pipe.zadd(queue_key, batch)
+                        pipe.zadd(f"{queue_key}:bands", {band: band for band in bands})
+                    self._register_queue_keys(pipe, list(batches))
+                    ack_start = len(pipe)
+                    for queue_key, bindata in acks:
+                        pipe.zrem(f"{queue_key}:lease", bindata)
+                        pipe.hdel(f"{queue_key}:lease_score", bindata)
+                    results = await pipe.execute()
+            except (RedisError, RuntimeError) as e:
+                logger.error(f"批量写入请求队列失败，{len(batches)}个队列的请求、{len(acks)}个ack将在下次重试: {e}")
+                for queue_key, batch in batches.items():
+                    batch.update(self.send_buffer.get(queue_key, {}))
+                    self.send_buffer[queue_key] = batch
+                self.ack_buffer = acks + self.ack_buffer
+                return
+            finally:
+                self.flushing_count = 0
+            # ZADD只返回新增的成员数，已在队列中的请求不重复计数
+            self.adjust_size(sum(results[0 : len(batches) * 2 : 2]))
+            if acks:
+                ack_results = results[ack_start : ack_start + len(acks) * 2 : 2]
+                # 租约已过期被回收，说明该请求可能已被重复投递
+                duplicates = ack_results.count(0)
+                if duplicates:
+                    self.crawler.stats.inc_value(
+                        "scheduler/lease/duplicate", duplicates, spider=self.crawler.spider
+                    )
 
     def pop(self):
-        bindata = self.pop_lt_score(self.key, int(time.time() * 1000), 1)
-        if bindata:
+        stats = self.crawler.stats
+        if not self.recevie_buffer:
+            # 只有redis中还有请求、且没有正在进行的拉取时才算未命中，队列空闲时的轮询不计入
+            if self.remote_size and (self._fetch_task is None or self._fetch_task.done()):
+                stats.inc_value("scheduler/prefetch/miss", spider=self.crawler.spider)
+            self._schedule_fetch()
+            return None
+        queue_key, bindata, _ = self.recevie_buffer.popleft()
+        stats.inc_value("scheduler/prefetch/hit", spider=self.crawler.spider)
+        if len(self.recevie_buffer) < self.low_watermark:
+            # 低于水位线，后台补充
+            self._schedule_fetch()
+        try:
             request = self.serializer.deserialize(bindata)
-            request.bindata = bindata
-            return request
+        except ValueError as e:
+            # 回调等已不存在的请求无法还原，确认后丢弃，避免租约过期后反复投递
+            logger.error(f"请求反序列化失败，丢弃该请求: {e}")
+            stats.inc_value("scheduler/deserialize_error", spider=self.crawler.spider)
+            self.ack_buffer.append((queue_key, bindata))
+            self._schedule_flush()
+            return None
+        request.bindata = bindata
+        lease_id = next(self._lease_ids)
+        self.leases[lease_id] = (queue_key, bindata)
+        request.meta["mq_lease"] = lease_id
+        return request
+
+    def _schedule_fetch(self):
+        if self._fetch_task is None or self._fetch_task.done():
+            self._fetch_task = asyncio.get_event_loop().create_task(self.fetch())
+
+    async def _after_pop_commands(self, pipe, queue_key):
+        """在pipeline中每个队列的拉取命令之后添加的命令，返回添加的命令数"""
+        return 0
+
+    def _after_pop_results(self, queue_key, results):
+        """处理_after_pop_commands的返回结果"""
+
+    async def sync_queue_keys(self):
+        """拉取前同步队列key"""
+
+    async def fetch(self):
+        """从redis中拉取已到期的请求到接收缓冲区，拉取前先写入缓冲区中的请求以保证顺序"""
+        await self.wait_redis_client()
+        await self.flush()
+        await self.sync_queue_keys()
+        fetch_count = self.prefetch - len(self.recevie_buffer)
+        if fetch_count <= 0:
+            return
+        plan = self.fetch_plan(fetch_count)
+        if not plan:
+            return
+        score = int(time.time() * 1000)
+        try:
+            if not getattr(self, "_execute_pop_lt_score", None):
+                self._register_scripts()
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                extra_commands = []
+                for queue_key, queue_count in plan:
+                    await self._execute_pop_lt_score(
+                        keys=self.script_keys(queue_key),
+                        args=[score, score + self.lease_duration_ms, queue_count, self.BAND_WIDTH],
+                        client=pipe,
+                    )
+                    extra_commands.append(await self._after_pop_commands(pipe, queue_key))
+                results = await pipe.execute()
+        except (RedisError, RuntimeError) as e:
+            logger.error(f"从请求队列拉取请求失败: {e}")
+            return
+        popped = []
+        position = 0
+        for (queue_key, _), extra in zip(plan, extra_commands):
+            elements = results[position]
+            self._after_pop_results(queue_key, results[position + 1 : position + 1 + extra])
+            position += 1 + extra
+            popped.append([(queue_key, elements[i], float(elements[i + 1])) for i in range(0, len(elements), 2)])
+        # 多个队列的请求轮流放入接收缓冲区
+        for row in zip_longest(*popped):
+            self.recevie_buffer.extend(element for element in row if element is not None)
+        popped_count = sum(map(len, popped))
+        self.adjust_size(-popped_count)
+        if popped_count:
+            self.confirmed_empty = False
+            self._wake_engine()
+
+    def ack(self, request):
+        """确认请求已处理完毕，删除其租约。重试、重定向等复制出的请求在重新入队时也会确认原请求"""
+        lease_id = request.meta.pop("mq_lease", None)
+        lease = self.leases.pop(lease_id, None)
+        if lease is None:
+            return
+        self.ack_buffer.append(lease)
+        self._schedule_flush()
+
+    def held_leases(self) -> defaultdict[str, list[bytes]]:
+        """本进程持有的租约，包括预取缓冲区和处理中的请求，按队列key分组"""
+        held = defaultdict(list)
+        for queue_key, bindata, _ in self.recevie_buffer:
+            held[queue_key].append(bindata)
+        for queue_key, bindata in self.leases.values():
+            held[queue_key].append(bindata)
+        return held
+
+    def engine_lease_ids(self) -> Optional[set]:
+        """引擎中正在下载和解析的请求持有的租约id，无法获取引擎状态时返回None"""
+        engine = getattr(self.crawler, "engine", None)
+        engine_slot = getattr(engine, "slot", None)
+        scraper_slot = getattr(getattr(engine, "scraper", None), "slot", None)
+        if engine_slot is None or scraper_slot is None:
+            return None
+        requests = [*engine_slot.inprogress, *scraper_slot.active, *(request for _, request, _ in scraper_slot.queue)]
+        return {request.meta.get("mq_lease") for request in requests}
+
+    def release_orphaned_leases(self):
+        """
+        确认已经离开引擎却没有被ack的租约。
+
+        下载中间件process_response中抛出的IgnoreRequest（如重定向次数超限）不会经过ack中间件，
+        这类租约会一直续约，导致爬虫无法结束。连续两次检查都不在引擎中的租约视为已处理完毕。
+        """
+        in_engine = self.engine_lease_ids()
+        if in_engine is None:
+            return
+        orphans = {lease_id for lease_id in self.leases if lease_id not in in_engine}
+        released = orphans & self._orphan_leases
+        self._orphan_leases = orphans - released
+        for lease_id in released:
+            self.ack_buffer.append(self.leases.pop(lease_id))
+        if released:
+            self.crawler.stats.inc_value("scheduler/lease/orphaned", len(released), spider=self.crawler.spider)
+            logger.warning(f"确认{len(released)}个已离开引擎但未ack的请求租约")
+            self._schedule_flush()
+
+    async def renew_leases(self):
+        """为预取缓冲区和处理中的请求续约，已被回收的租约不会被重新创建"""
+        held = self.held_leases()
+        if not held:
+            return
+        deadline = int(time.time() * 1000) + self.lease_duration_ms
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for queue_key, members in held.items():
+                pipe.zadd(f"{queue_key}:lease", dict.fromkeys(members, deadline), xx=True)
+            await pipe.execute()
+
+    async def requeue_expired(self):
+        """回收已过期的租约，放回队列"""
+        if not getattr(self, "_execute_requeue_expired", None):
+            self._register_scripts()
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for queue_key in self.queue_keys:
+                await self._execute_requeue_expired(
+                    keys=self.script_keys(queue_key),
+                    args=[int(time.time() * 1000), 1000, self.BAND_WIDTH],
+                    client=pipe,
+                )
+            requeued = sum(await pipe.execute())
+        if requeued:
+            self.adjust_size(requeued)
+            self.confirmed_empty = False
+            self.crawler.stats.inc_value("scheduler/lease/requeued", requeued, spider=self.crawler.spider)
+            logger.warning(f"回收过期的请求租约{requeued}个")
 
-    def ack(self, bin_request):
-        self.client.zrem(self.key, bin_request)
+    async def give_back(self):
+        """将预取但未消费以及未ack的请求按原分数归还redis"""
+        held = self.held_leases()
+        if not held:
+            return
+        self.recevie_buffer.clear()
+        self.leases.clear()
+        try:
+            if not getattr(self, "_execute_give_back", None):
+                self._register_scripts()
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                for queue_key, members in held.items():
+                    await self._execute_give_back(
+                        keys=self.script_keys(queue_key),
+                        args=[self.BAND_WIDTH, *members],
+                        client=pipe,
+                    )
+                await pipe.execute()
+            self.adjust_size(sum(map(len, held.values())))
+            logger.info(f"归还未处理的请求{sum(map(len, held.values()))}个")
+        except (RedisError, RuntimeError) as e:
+            logger.error(f"归还未处理的请求失败: {e}")
+
+    def __len__(self):
+        """
+        近似的队列长度，由本地计数得出，不访问redis。
+
+        本地计数归零时不直接返回0，而是在后台精确统计一次，确认redis中没有待处理的请求和租约后才返回0，
+        避免计数误差或其他worker尚未完成的请求导致爬虫提前关闭。
+        """
+        size = self.send_count + self.flushing_count + len(self.recevie_buffer) + (self.remote_size or 0)
+        if size or self.remote_size is None:
+            # 还未与redis同步时视为有待处理的请求
+            return size or 1
+        if self.confirmed_empty:
+            return 0
+        if self._exact_task is None or self._exact_task.done():
+            self._exact_task = asyncio.get_event_loop().create_task(self.confirm_empty())
+        return 1
+
+    async def exact_size(self) -> int:
+        """精确的待处理数量，先写入缓冲区，再统计redis中的队列长度、所有worker持有的租约和种子锁"""
+        await self.flush()
+        await self.sync_size()
+        local = self.send_count + self.flushing_count + len(self.recevie_buffer)
+        return local + self.remote_size + self.remote_leases + self.remote_seeding
+
+    async def confirm_empty(self):
+        try:
+            size = await self.exact_size()
+        except (RedisError, RuntimeError) as e:
+            logger.error(f"精确统计请求队列长度失败: {e}")
+            return
+        self.crawler.stats.inc_value("scheduler/size/exact_checks", spider=self.crawler.spider)
+        if size == 0:
+            self.confirmed_empty = True
+            self._wake_engine()
+
+    async def close(self):
+        for timer in (self._timer, self._lease_timer, self._size_timer):
+            if timer:
+                timer.cancel()
+        if self._fetch_task:
+            # 等待进行中的拉取完成，以便归还其租约
+            await asyncio.gather(self._fetch_task, return_exceptions=True)
+        await self.flush()
+        await self.give_back()
+        self.log_hit_rate()
+
+    def log_hit_rate(self):
+        stats = self.crawler.stats
+        hits = stats.get_value("scheduler/prefetch/hit", 0, spider=self.crawler.spider)
+        misses = stats.get_value("scheduler/prefetch/miss", 0, spider=self.crawler.spider)
+        if hits + misses:
+            hit_rate = round(hits / (hits + misses), 4)
+            stats.set_value("scheduler/prefetch/hit_rate", hit_rate, spider=self.crawler.spider)
+            logger.info(f"预取命中率: {hit_rate:.2%}，命中{hits}次，未命中{misses}次")
+
+
+class ShardedRedisQueue(RedisQueue):
+    """
+    按下载slot（通常为域名）分片的请求队列。
+
+    每个slot的请求写入独立的有序集合``{key}:shard:{slot}``，非空分片登记在``{key}:shards``中。
+    拉取时按轮询顺序遍历分片，跳过下载slot并发已满或仍处于下载延迟窗口内的分片，
+    避免单个慢域名的请求占满预取缓冲区。分片内的优先级和租约规则与RedisQueue一致。
+
+    使用时设置``SCHEDULER_MESSAGE_QUEUE_CLASS = "scrapy_konne.core.mq.ShardedRedisQueue"``，
+    ``REDIS_MQ_SHARD_SYNC_INTERVAL``为从redis同步分片列表的间隔秒数。
+    """
+
+    def __init__(self, crawler, key, *args, shard_sync_interval=5, **kwargs) -> None:
+        super().__init__(crawler, key, *args, **kwargs)
+        self.shards_key = f"{key}:shards"
+        self.shard_sync_interval = shard_sync_interval
+        self.shards: set[str] = set()
+        self._shards_synced_at = 0
+        self._cursor = 0
+        self._retry_handle = None
+
+    @classmethod
+    def from_crawler(cls, crawler, key, *args, **kwargs):
+        queue = super().from_crawler(crawler, key, *args, **kwargs)
+        queue.shard_sync_interval = crawler.settings.getfloat("REDIS_MQ_SHARD_SYNC_INTERVAL", 5)
+        return queue
+
+    def _register_scripts(self):
+        super()._register_scripts()
+        # 分片的队列和租约都为空时才从分片列表中移除，避免误删其他worker刚写入的分片
+        prune_shard = """
+            if redis.call('zcard', KEYS[2]) == 0 and redis.call('zcard', KEYS[3]) == 0 then
+                redis.call('del', KEYS[4])
+                return redis.call('srem', KEYS[1], ARGV[1])
+            end
+            return 0
+        """
+        self._execute_prune_shard = self.redis_client.register_script(prune_shard)
+
+    def shard_key(self, slot: str) -> str:
+        return f"{self.key}:shard:{slot}"
+
+    def slot_of(self, request) -> str:
+        """请求所属的下载slot，与下载器的并发和延迟控制保持一致"""
+        downloader = self.crawler.engine.downloader
+        return downloader._get_slot_key(request, self.crawler.spider)
+
+    def queue_key_of(self, request) -> str:
+        return self.shard_key(self.slot_of(request))
 
     @property
-    def redis_mq_size(self):
-        return self.client.zcard(self.key)
+    def queue_keys(self) -> list[str]:
+        return [self.shard_key(slot) for slot in sorted(self.shards)]
+
+    def _register_queue_keys(self, pipe, queue_keys):
+        prefix = len(self.shard_key(""))
+        slots = {queue_key[prefix:] for queue_key in queue_keys}
+        if slots:
+            pipe.sadd(self.shards_key, *slots)
+            self.shards.update(slots)
+
+    async def sync_queue_keys(self):
+        """定期同步其他worker写入的分片"""
+        if time.time() - self._shards_synced_at < self.shard_sync_interval:
+            return
+        try:
+            slots = await self.redis_client.smembers(self.shards_key)
+        except (RedisError, RuntimeError) as e:
+            logger.error(f"同步请求队列分片失败: {e}")
+            return
+        self._shards_synced_at = time.time()
+        self.shards = {slot.decode() if isinstance(slot, bytes) else slot for slot in slots}
+
+    def fetch_plan(self, fetch_count) -> list[tuple[str, int]]:
+        """轮询可下载的分片，每个分片的拉取数量不超过其下载slot的空闲并发"""
+        slots = sorted(self.shards)
+        if not slots:
+            return []
+        downloader = self.crawler.engine.downloader
+        buffered = defaultdict(int)
+        for queue_key, _, _ in self.recevie_buffer:
+            buffered[queue_key] += 1
+        now = time.time()
+        ready, wait = [], None
+        start = self._cursor % len(slots)
+        self._cursor += 1
+        for slot in slots[start:] + slots[:start]:
+            queue_key = self.shard_key(slot)
+            download_slot = downloader.slots.get(slot)
+            if download_slot is None:
+                capacity = fetch_count
+            else:
+                capacity = download_slot.concurrency - len(download_slot.active) - buffered[queue_key]
+                ready_at = download_slot.lastseen + download_slot.delay
+                if ready_at > now:
+                    # 仍在下载延迟窗口内
+                    wait = ready_at - now if wait is None else min(wait, ready_at - now)
+                    continue
+            if capacity > 0:
+                ready.append((queue_key, capacity))
+        if wait is not None:
+            self._schedule_retry(wait)
+        plan = []
+        share = -(-fetch_count // max(len(ready), 1))
+        for queue_key, capacity in ready:
+            if fetch_count <= 0:
+                break
+            queue_count = min(capacity, share, fetch_count)
+            plan.append((queue_key, queue_count))
+            fetch_count -= queue_count
+        return plan
+
+    def _schedule_retry(self, wait):
+        """延迟窗口结束后重新拉取，不必等待引擎心跳"""
+        if self._retry_handle is None:
+            loop = asyncio.get_event_loop()
+            self._retry_handle = loop.call_later(wait, self._retry_fetch)
+
+    def _retry_fetch(self):
+        self._retry_handle = None
+        self._schedule_fetch()
+
+    async def _after_pop_commands(self, pipe, queue_key):
+        # 与拉取在同一pipeline中执行，保证判断时拉取已完成
+        await self._execute_prune_shard(
+            keys=[self.shards_key, *self.script_keys(queue_key)[:2], f"{queue_key}:bands"],
+            args=[queue_key[len(self.shard_key("")) :]],
+            client=pipe,
+        )
+        return 1
+
+    def _after_pop_results(self, queue_key, results):
+        if results and results[0]:
+            self.shards.discard(queue_key[len(self.shard_key("")) :])
+
+    async def close(self):
+        if self._retry_handle:
+            self._retry_handle.cancel()
+        await super().close()
+
+
+class _Segment:
+    """溢出文件中的一段有序请求，只在内存中保留少量预读的记录"""
+
+    __slots__ = ("offset", "remaining", "buffer")
+
+    def __init__(self, offset, remaining) -> None:
+        self.offset = offset
+        self.remaining = remaining
+        self.buffer: deque[tuple[int, bytes]] = deque()
+
+    def __len__(self):
+        return self.remaining + len(self.buffer)
+
+
+class DiskSpillQueue(PriorityScoreMixin, BaseMessageQueue):
+    """
+    不依赖redis的本地请求队列，用于本地调试和单机运行。
+
+    排序规则与RedisQueue一致，请求序列化后放入内存中的最小堆，堆的大小超过``DISK_MQ_MEMORY_SIZE``时，
+    将分数较大的一半排序后追加写入溢出文件，形成一个有序段。pop时在内存堆和各段的头部之间归并取出分数最小的请求，
+    每个段只预读``DISK_MQ_READ_AHEAD``条记录，百万级待处理请求时内存占用保持平稳。
+
+    溢出文件是``DISK_MQ_DIR``（默认为项目的.scrapy/disk_mq目录）下以队列key为前缀的临时文件，
+    同一爬虫同时运行多个进程时互不影响，所有段读完后文件会被截断，关闭时删除。
+    使用时设置``SCHEDULER_MESSAGE_QUEUE_CLASS = "scrapy_konne.core.mq.DiskSpillQueue"``。
+    """
+
+    RECORD_HEADER = struct.Struct(">qI")
+    """每条记录的头部：分数、序列化数据长度"""
+
+    def __init__(
+        self,
+        crawler,
+        key,
+        serializer=None,
+        memory_size=10000,
+        spill_dir=None,
+        read_ahead=64,
+        depth_first=False,
+    ) -> None:
+        BaseMessageQueue.__init__(self, crawler, key, serializer)
+        self.memory_size = max(memory_size, 2)
+        self.read_ahead = max(read_ahead, 1)
+        self.depth_first = depth_first
+        self.spill_dir = spill_dir
+        self.path = None
+        # 内存中的请求，元素为(分数, 序号, 序列化数据)
+        self.heap: list[tuple[int, int, bytes]] = []
+        # 未到就绪时间的请求，元素为(就绪时间, 序号, 分数, 序列化数据)
+        self.delayed: list[tuple[int, int, int, bytes]] = []
+        self.segments: list[_Segment] = []
+        # 各段的头部，元素为(分数, 序号, 段)
+        self.segment_heads: list[tuple[int, int, _Segment]] = []
+        self._seq = count()
+        self.file = None
+
+    @classmethod
+    def from_crawler(cls, crawler, key, *args, **kwargs):
+        settings = crawler.settings
+        serializer_class = load_object(settings.get("DISK_MQ_SERIALIZER", "scrapy_konne.core.serializer.MsgpackSerializer"))
+        return cls(
+            crawler=crawler,
+            key=key,
+            serializer=serializer_class(crawler.spider),
+            memory_size=settings.getint("DISK_MQ_MEMORY_SIZE", 10000),
+            spill_dir=settings.get("DISK_MQ_DIR"),
+            read_ahead=settings.getint("DISK_MQ_READ_AHEAD", 64),
+            depth_first=settings.getbool("REDIS_MQ_DEPTH_FIRST", False),
+        )
+
+    def open(self):
+        # 同一爬虫的多个进程各自使用独立的溢出文件，互不截断
+        fd, self.path = tempfile.mkstemp(
+            prefix=f"{self.key.replace(':', '_')}.",
+            suffix=".seg",
+            dir=self.spill_dir or data_path("disk_mq", createdir=True),
+        )
+        self.file = os.fdopen(fd, "w+b")
+
+    def push(self, request):
+        score = self.score_of(request)
+        bindata = self.serializer.serialize(request)
+        ready_ms = score % self.BAND_WIDTH
+        if ready_ms > time.time() * 1000:
+            # 延迟重试的请求先放入延迟堆，到期后再参与排序
+            heapq.heappush(self.delayed, (ready_ms, next(self._seq), score, bindata))
+            asyncio.get_event_loop().call_later(ready_ms / 1000 - time.time(), self._wake_engine)
+            return
+        heapq.heappush(self.heap, (score, next(self._seq), bindata))
+        if len(self.heap) > self.memory_size:
+            self.spill()
+
+    def spill(self):
+        """将内存中分数较大的一半请求写入溢出文件"""
+        entries = sorted(self.heap)
+        keep = self.memory_size // 2
+        # 有序列表本身就是合法的堆
+        self.heap, spilled = entries[:keep], entries[keep:]
+        self.file.seek(0, os.SEEK_END)
+        segment = _Segment(self.file.tell(), len(spilled))
+        self.file.write(
+            b"".join(self.RECORD_HEADER.pack(score, len(bindata)) + bindata for score, _, bindata in spilled)
+        )
+        self.file.flush()
+        self.segments.append(segment)
+        self._push_segment_head(segment)
+        stats = self.crawler.stats
+        stats.inc_value("scheduler/disk/spilled", len(spilled), spider=self.crawler.spider)
+        stats.max_value("scheduler/disk/max_segments", len(self.segments), spider=self.crawler.spider)
+
+    def _read_ahead(self, segment: _Segment):
+        self.file.seek(segment.offset)
+        for _ in range(min(self.read_ahead, segment.remaining)):
+            score, size = self.RECORD_HEADER.unpack(self.file.read(self.RECORD_HEADER.size))
+            segment.buffer.append((score, self.file.read(size)))
+            segment.offset += self.RECORD_HEADER.size + size
+            segment.remaining -= 1
+
+    def _push_segment_head(self, segment: _Segment):
+        if not segment.buffer:
+            if not segment.remaining:
+                self.segments.remove(segment)
+                if not self.segments:
+                    # 所有段都已读完，回收磁盘空间
+                    self.file.truncate(0)
+                return
+            self._read_ahead(segment)
+        heapq.heappush(self.segment_heads, (segment.buffer[0][0], next(self._seq), segment))
+
+    def pop(self):
+        now_ms = time.time() * 1000
+        while self.delayed and self.delayed[0][0] <= now_ms:
+            _, seq, score, bindata = heapq.heappop(self.delayed)
+            heapq.heappush(self.heap, (score, seq, bindata))
+        if self.segment_heads and (not self.heap or self.segment_heads[0][0] < self.heap[0][0]):
+            score = self.segment_heads[0][0]
+        elif self.heap:
+            score = self.heap[0][0]
+        else:
+            return None
+        if score % self.BAND_WIDTH > now_ms:
+            # 还未到就绪时间
+            return None
+        if self.heap and score == self.heap[0][0]:
+            _, _, bindata = heapq.heappop(self.heap)
+        else:
+            _, _, segment = heapq.heappop(self.segment_heads)
+            _, bindata = segment.buffer.popleft()
+            self._push_segment_head(segment)
+        return self.serializer.deserialize(bindata)
 
     def __len__(self):
-        return self.redis_mq_size
+        return len(self.heap) + len(self.delayed) + sum(map(len, self.segments))
 
-    def close(self):
-        self.client.close()
+    async def close(self):
+        pending = len(self)
+        if pending:
+            logger.warning(f"本地请求队列关闭，丢弃未处理的请求{pending}个")
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            os.remove(self.path)
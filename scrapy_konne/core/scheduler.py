@@ -1,6 +1,7 @@
+import asyncio
 import logging
 
-from scrapy import Spider
+from scrapy import Spider, signals
 from scrapy.core.scheduler import BaseScheduler
 from scrapy.crawler import Crawler
 from scrapy.http.request import Request
@@ -12,8 +13,10 @@ from typing import Optional, Type, TypeVar
 from scrapy.dupefilters import BaseDupeFilter
 
 from scrapy.statscollectors import StatsCollector
+from scrapy.utils.defer import deferred_from_coro
 from scrapy.utils.misc import create_instance, load_object
 from scrapy_konne.core.signals import Event
+from scrapy_konne.middlewares.mqack import AckSignalMiddleware
 
 logger = logging.getLogger(__name__)
 SchedulerTV = TypeVar("SchedulerTV", bound="RedisScheduler")
@@ -33,6 +36,8 @@ class RedisScheduler(BaseScheduler):
         self.logunser: bool = logunser
         self.stats: Optional[StatsCollector] = stats
         self.crawler: Optional[Crawler] = crawler
+        self.redis_mq = None
+        self.checking: set[asyncio.Task] = set()
         crawler.signals.connect(self.request_callback_done, signal=Event.REQUEST_ACK)
 
     @classmethod
@@ -54,23 +59,66 @@ class RedisScheduler(BaseScheduler):
 
     def open(self, spider: Spider) -> Optional[Deferred]:
         self.spider = spider
+        if getattr(self.rqclass, "requires_ack", False):
+            self.check_ack_middleware()
         self.redis_mq = self._mq()
+        self.redis_mq.open()
         return self.df.open()
 
     def close(self, reason: str) -> Optional[Deferred]:
+        return deferred_from_coro(self._close(reason))
+
+    async def _close(self, reason: str):
+        # 关闭前等待去重判断完成，并将缓冲区中的请求写入队列
+        if self.checking:
+            await asyncio.gather(*self.checking)
         if self.redis_mq is not None:
-            self.redis_mq.close()
+            await self.redis_mq.close()
         return self.df.close(reason)
 
     def enqueue_request(self, request: Request) -> bool:
-        if not request.dont_filter and self.df.request_seen(request):
+        # 重试、重定向的请求会携带原请求的租约，重新入队时确认原请求
+        self.redis_mq.ack(request)
+        if not request.dont_filter:
+            async_request_seen = getattr(self.df, "async_request_seen", None)
+            if async_request_seen is not None:
+                # 支持批量判断的去重器，判断完成后再入队，判断期间计入待处理数量
+                task = asyncio.get_event_loop().create_task(self.enqueue_checked(request, async_request_seen(request)))
+                self.checking.add(task)
+                task.add_done_callback(self.checking.discard)
+                return True
+            if self.df.request_seen(request):
+                self.df.log(request, self.spider)
+                return False
+        self.push(request)
+        return True
+
+    async def enqueue_checked(self, request: Request, seen):
+        if await seen:
             self.df.log(request, self.spider)
-            return False
+            self.crawler.signals.send_catch_log(signals.request_dropped, request=request, spider=self.spider)
+        else:
+            self.push(request)
+
+    def push(self, request: Request):
         self.redis_mq.push(request)
         assert self.stats is not None
         self.stats.inc_value("scheduler/enqueued/redis_mq", spider=self.spider)
         self.stats.inc_value("scheduler/enqueued", spider=self.spider)
-        return True
+
+    def check_ack_middleware(self):
+        """租约需要AckSignalMiddleware确认，未同时作为爬虫中间件和下载中间件开启时，请求会一直被租约占用导致爬虫无法结束"""
+        engine = self.crawler.engine
+        enabled = {
+            "SPIDER_MIDDLEWARES": engine.scraper.spidermw.middlewares,
+            "DOWNLOADER_MIDDLEWARES": engine.downloader.middleware.middlewares,
+        }
+        missing = [name for name, mws in enabled.items() if not any(isinstance(mw, AckSignalMiddleware) for mw in mws)]
+        if missing:
+            raise RuntimeError(
+                f"{self.rqclass.__name__}需要在{'和'.join(missing)}中开启"
+                "scrapy_konne.middlewares.mqack.AckSignalMiddleware，或启用scrapy_konne.addon.Addons"
+            )
 
     def next_request(self) -> Optional[Request]:
         request: Optional[Request] = self.redis_mq.pop()
@@ -81,7 +129,7 @@ class RedisScheduler(BaseScheduler):
         return request
 
     def __len__(self) -> int:
-        return len(self.redis_mq)
+        return len(self.redis_mq) + len(self.checking)
 
     def _mq(self):
         return create_instance(
@@ -92,5 +140,5 @@ class RedisScheduler(BaseScheduler):
         )
 
     def request_callback_done(self, signal, sender, request, spider):
-        # self.redis_mq.ack(request.bindata)
-        pass
+        if self.redis_mq is not None:
+            self.redis_mq.ack(request)
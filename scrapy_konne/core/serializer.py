@@ -1,8 +1,61 @@
+from datetime import datetime
+import inspect
+import mmh3
 import ormsgpack
 from abc import ABCMeta, abstractmethod
+from pathlib import Path
 from scrapy import Request
 import pickle
+from scrapy.utils.misc import load_object
+from scrapy.utils.project import data_path
 from scrapy.utils.request import request_from_dict
+from scrapy_konne.http import KRequest
+from scrapy_konne.items import DetailDataItem, IncreamentItem
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+EXT_DETAIL_DATA_ITEM = 1
+EXT_INCREAMENT_ITEM = 2
+EXT_DATETIME = 3
+
+ITEM_EXT_TYPES = {DetailDataItem: EXT_DETAIL_DATA_ITEM, IncreamentItem: EXT_INCREAMENT_ITEM}
+EXT_ITEM_CLASSES = {ext_type: item_class for item_class, ext_type in ITEM_EXT_TYPES.items()}
+
+PACK_OPTION = ormsgpack.OPT_NON_STR_KEYS | ormsgpack.OPT_PASSTHROUGH_DATACLASS | ormsgpack.OPT_PASSTHROUGH_DATETIME
+
+
+def pack_default(obj):
+    """将item和datetime打包为msgpack扩展类型，其他dataclass仍按字典打包"""
+    ext_type = ITEM_EXT_TYPES.get(type(obj))
+    if ext_type is not None:
+        return ormsgpack.Ext(ext_type, packb(obj.__dict__))
+    if isinstance(obj, datetime):
+        return ormsgpack.Ext(EXT_DATETIME, obj.isoformat().encode())
+    if hasattr(obj, "__dataclass_fields__"):
+        return obj.__dict__
+    raise TypeError(f"Type is not msgpack serializable: {type(obj).__name__}")
+
+
+def unpack_ext(ext_type, data):
+    """还原pack_default打包的扩展类型"""
+    if ext_type == EXT_DATETIME:
+        return datetime.fromisoformat(data.decode())
+    item_class = EXT_ITEM_CLASSES.get(ext_type)
+    if item_class is None:
+        raise ValueError(f"未知的msgpack扩展类型: {ext_type}")
+    return item_class(**unpackb(data))
+
+
+def packb(obj) -> bytes:
+    return ormsgpack.packb(obj, default=pack_default, option=PACK_OPTION)
+
+
+def unpackb(msg: bytes):
+    return ormsgpack.unpackb(msg, ext_hook=unpack_ext, option=ormsgpack.OPT_NON_STR_KEYS)
 
 
 class Serializer(metaclass=ABCMeta):
@@ -21,14 +74,16 @@ class Serializer(metaclass=ABCMeta):
 
 
 class MsgpackSerializer(Serializer):
+    """msgpack序列化器，DetailDataItem、IncreamentItem和datetime以扩展类型保存，反序列化后还原为原类型"""
+
     __slots__ = ("spider",)
 
     def serialize(self, request: Request):
         data = request.to_dict(spider=self.spider)
-        return ormsgpack.packb(data, option=ormsgpack.OPT_NON_STR_KEYS)
+        return packb(data)
 
     def deserialize(self, msg: bytes):
-        msg = ormsgpack.unpackb(msg)
+        msg = unpackb(msg)
         request = request_from_dict(msg, spider=self.spider)
         return request
 
@@ -44,3 +99,193 @@ class PickleSerializer(Serializer):
         msg = pickle.loads(msg)
         request = request_from_dict(msg, spider=self.spider)
         return request
+
+
+
+class CompactMsgpackSerializer(Serializer):
+    """
+    针对KRequest的紧凑msgpack序列化器。
+
+    字段使用整数键，省略与默认值相同的字段，不重复保存KRequest镜像到meta中的filter_url、cursor、rotate_proxy，
+    爬虫方法名按murmurhash映射为16位id，发生冲突的方法名仍以字符串保存。
+    反序列化结果与``request_from_dict``一致，也兼容MsgpackSerializer写入的旧数据。
+    与MsgpackSerializer一样，DetailDataItem、IncreamentItem和datetime以扩展类型保存，反序列化后还原为原类型。
+    """
+
+    __slots__ = ("spider", "method_ids", "method_names", "classes")
+
+    URL, CALLBACK, ERRBACK, METHOD, HEADERS, BODY, COOKIES, META = range(8)
+    ENCODING, PRIORITY, DONT_FILTER, FLAGS, CB_KWARGS, FILTER_URL, CURSOR, ROTATE_PROXY = range(8, 16)
+    CLASS, EXTRA = 16, 17
+
+    MIRRORED = ("filter_url", "cursor", "rotate_proxy")
+    # 字段: (整数键, 默认值)
+    FIELDS = {
+        "method": (METHOD, "GET"),
+        "body": (BODY, b""),
+        "cookies": (COOKIES, {}),
+        "encoding": (ENCODING, "utf-8"),
+        "priority": (PRIORITY, 0),
+        "dont_filter": (DONT_FILTER, False),
+        "flags": (FLAGS, []),
+        "cb_kwargs": (CB_KWARGS, {}),
+        "filter_url": (FILTER_URL, None),
+        "cursor": (CURSOR, None),
+        "rotate_proxy": (ROTATE_PROXY, False),
+    }
+    KEYS = {key: attr for attr, (key, _) in FIELDS.items()}
+    ENCODED = {"url", "callback", "errback", "headers", "meta", *FIELDS}
+
+    def __init__(self, spider) -> None:
+        super().__init__(spider)
+        self.method_ids = {}
+        self.method_names = {}
+        ids = {}
+        for name, method in inspect.getmembers(spider, predicate=inspect.ismethod):
+            ids.setdefault(mmh3.hash(name) & 0xFFFF, []).append((name, method.__func__))
+        for method_id, methods in ids.items():
+            for name, func in methods:
+                # 冲突的方法名以字符串保存
+                self.method_ids[func] = method_id if len(methods) == 1 else name
+            if len(methods) == 1:
+                self.method_names[method_id] = methods[0][0]
+        self.classes = {}
+
+    def _encode_method(self, method):
+        if not callable(method):
+            return method
+        if getattr(method, "__self__", None) is self.spider:
+            method_id = self.method_ids.get(method.__func__)
+            if method_id is not None:
+                return method_id
+        raise ValueError(f"Function {method} is not an instance method in: {self.spider}")
+
+    def _decode_method(self, method):
+        name = self.method_names.get(method) if isinstance(method, int) else method
+        if name is None:
+            raise ValueError(f"Method id {method} not found in: {self.spider}")
+        try:
+            return getattr(self.spider, name)
+        except AttributeError:
+            raise ValueError(f"Method {name!r} not found in: {self.spider}")
+
+    def serialize(self, request: Request):
+        data = {self.URL: request.url}
+        if request.callback is not None:
+            data[self.CALLBACK] = self._encode_method(request.callback)
+        if request.errback is not None:
+            data[self.ERRBACK] = self._encode_method(request.errback)
+        if request.headers:
+            data[self.HEADERS] = dict(request.headers)
+        is_krequest = isinstance(request, KRequest)
+        meta = request.meta
+        if is_krequest and any(key in meta for key in self.MIRRORED):
+            meta = {key: value for key, value in meta.items() if key not in self.MIRRORED}
+        if meta:
+            data[self.META] = meta
+        for attr, (key, default) in self.FIELDS.items():
+            if attr in self.MIRRORED and not is_krequest:
+                continue
+            value = getattr(request, attr)
+            if value != default:
+                data[key] = value
+        request_cls = type(request)
+        if request_cls is not KRequest:
+            data[self.CLASS] = f"{request_cls.__module__}.{request_cls.__name__}"
+            extra = {attr: getattr(request, attr) for attr in request.attributes if attr not in self.ENCODED}
+            if extra:
+                data[self.EXTRA] = extra
+        return packb(data)
+
+    def deserialize(self, msg: bytes):
+        data = unpackb(msg)
+        if "url" in data:
+            # MsgpackSerializer写入的旧数据
+            return request_from_dict(data, spider=self.spider)
+        class_path = data.pop(self.CLASS, None)
+        if class_path is None:
+            request_cls = KRequest
+        else:
+            request_cls = self.classes.get(class_path)
+            if request_cls is None:
+                request_cls = self.classes[class_path] = load_object(class_path)
+        kwargs = data.pop(self.EXTRA, {})
+        kwargs["url"] = data.pop(self.URL)
+        callback = data.pop(self.CALLBACK, None)
+        if callback is not None:
+            kwargs["callback"] = self._decode_method(callback)
+        errback = data.pop(self.ERRBACK, None)
+        if errback is not None:
+            kwargs["errback"] = self._decode_method(errback)
+        headers = data.pop(self.HEADERS, None)
+        if headers is not None:
+            kwargs["headers"] = headers
+        meta = data.pop(self.META, None)
+        if meta is not None:
+            kwargs["meta"] = meta
+        for key, value in data.items():
+            kwargs[self.KEYS[key]] = value
+        return request_cls(**kwargs)
+
+def load_zstd_dictionaries(dict_dir, name) -> list:
+    """加载爬虫的所有zstd字典，按修改时间排序，最新的在最后"""
+    paths = sorted(Path(dict_dir).glob(f"{name}.*.zdict"), key=lambda path: path.stat().st_mtime)
+    return [zstandard.ZstdCompressionDict(path.read_bytes()) for path in paths]
+
+
+class ZstdSerializer(Serializer):
+    """
+    zstd压缩的序列化器，先用``ZSTD_INNER_SERIALIZER``序列化，再用爬虫的字典压缩。
+
+    字典由``scrapy zdict <爬虫名>``从队列中采样训练，保存在``ZSTD_DICT_DIR``下的``{爬虫名}.{字典id}.zdict``，
+    压缩使用最新的字典，解压时按数据帧中的字典id选择字典，因此更换字典后旧字典文件需要保留到队列中的旧请求消费完。
+    序列化结果的第一个字节为版本号：``0x01``使用字典压缩，``0x02``无字典压缩，其他为未压缩的旧数据，直接交给内层序列化器。
+    """
+
+    __slots__ = ("spider", "inner", "compressor", "decompressors", "version")
+
+    WITH_DICT = b"\x01"
+    WITHOUT_DICT = b"\x02"
+
+    def __init__(self, spider) -> None:
+        if zstandard is None:
+            raise ImportError("ZstdSerializer需要安装zstandard: pip install scrapy-konne[zstd]")
+        super().__init__(spider)
+        settings = spider.settings
+        inner_class = load_object(settings.get("ZSTD_INNER_SERIALIZER", "scrapy_konne.core.serializer.MsgpackSerializer"))
+        self.inner: Serializer = inner_class(spider)
+        level = settings.getint("ZSTD_LEVEL", 3)
+        dict_dir = settings.get("ZSTD_DICT_DIR") or data_path("zstd_dicts", createdir=True)
+        dictionaries = load_zstd_dictionaries(dict_dir, spider.name)
+        self.decompressors = {0: zstandard.ZstdDecompressor()}
+        for dictionary in dictionaries:
+            self.decompressors[dictionary.dict_id()] = zstandard.ZstdDecompressor(dict_data=dictionary)
+        if dictionaries:
+            self.compressor = zstandard.ZstdCompressor(level=level, dict_data=dictionaries[-1])
+            self.version = self.WITH_DICT
+        else:
+            self.compressor = zstandard.ZstdCompressor(level=level)
+            self.version = self.WITHOUT_DICT
+
+    def serialize(self, request: Request):
+        return self.version + self.compressor.compress(self.inner.serialize(request))
+
+    def unwrap(self, msg: bytes) -> bytes:
+        """解压为内层序列化器的数据"""
+        version = msg[:1]
+        # 损坏的数据帧统一按ValueError抛出，由请求队列丢弃并ack
+        try:
+            if version == self.WITH_DICT:
+                dict_id = zstandard.get_frame_parameters(msg[1:]).dict_id
+                decompressor = self.decompressors.get(dict_id)
+                if decompressor is None:
+                    raise ValueError(f"缺少id为{dict_id}的zstd字典，无法解压请求")
+                return decompressor.decompress(msg[1:])
+            if version == self.WITHOUT_DICT:
+                return self.decompressors[0].decompress(msg[1:])
+        except zstandard.ZstdError as e:
+            raise ValueError(f"zstd解压请求失败: {e}") from e
+        return msg
+
+    def deserialize(self, msg: bytes):
+        return self.inner.deserialize(self.unwrap(msg))
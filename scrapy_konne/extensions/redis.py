@@ -4,7 +4,9 @@ from redis import Redis as SyncRedis
 from scrapy.crawler import Crawler
 from scrapy import signals
 from scrapy.exceptions import NotConfigured
+import asyncio
 from asyncio import Lock
+import time
 
 logger = getLogger(__name__)
 
@@ -14,17 +16,55 @@ class RedisExtensionError(Exception):
 
 
 class GlobalAsyncRedisExtension:
-    def __init__(self, redis_url):
+    """
+    挂载全局异步redis连接。
+
+    设置``DUPEFILTER_RETENTION_DAYS``（保留天数）或``DUPEFILTER_MAX_SIZE``（最多保留的指纹数）后，
+    后台每``DUPEFILTER_TRIM_INTERVAL``秒清理一次爬虫的去重库，最旧的指纹先删除，
+    每条命令最多删除``DUPEFILTER_TRIM_BATCH``个成员，避免大key删除时阻塞redis。
+    多个worker共享去重库时，通过``{去重key}:trim_lock``保证每个清理周期只有一个worker执行清理。
+    """
+
+    # 删除分数小于ARGV[1]的成员，最多ARGV[2]个，按分数删除，多个worker同时执行也不会多删
+    trim_below_script = """
+    local last = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', '(' .. ARGV[1], 'WITHSCORES', 'LIMIT', tonumber(ARGV[2]) - 1, 1)
+    if #last > 0 then
+        return redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', last[2])
+    end
+    return redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', '(' .. ARGV[1])
+    """
+    # 删除超出上限ARGV[1]的最旧成员，最多ARGV[2]个，在脚本内计算超出数量，保证不会删到上限以下
+    trim_excess_script = """
+    local excess = redis.call('ZCARD', KEYS[1]) - tonumber(ARGV[1])
+    if excess <= 0 then
+        return 0
+    end
+    return redis.call('ZREMRANGEBYRANK', KEYS[1], 0, math.min(excess, tonumber(ARGV[2])) - 1)
+    """
+
+    def __init__(self, redis_url, retention_days=0, max_size=0, trim_interval=600, trim_batch=10000):
         self.redis_url = redis_url
         self.client = None
         self._lock = Lock()
+        self.retention_days = retention_days
+        self.max_size = max_size
+        self.trim_interval = trim_interval
+        self.trim_batch = trim_batch
+        self._trim_task = None
 
     @classmethod
     def from_crawler(cls, crawler: Crawler):
-        redis_url = crawler.settings.get("REDIS_URL")
+        settings = crawler.settings
+        redis_url = settings.get("REDIS_URL")
         if not redis_url:
             raise NotConfigured("REDIS_URL 未设置")
-        ext = cls(redis_url)
+        ext = cls(
+            redis_url,
+            retention_days=settings.getfloat("DUPEFILTER_RETENTION_DAYS", 0),
+            max_size=settings.getint("DUPEFILTER_MAX_SIZE", 0),
+            trim_interval=settings.getfloat("DUPEFILTER_TRIM_INTERVAL", 600),
+            trim_batch=settings.getint("DUPEFILTER_TRIM_BATCH", 10000),
+        )
         crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
         crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
         return ext
@@ -57,8 +97,63 @@ class GlobalAsyncRedisExtension:
             except Exception as e:
                 logger.error("%(error)s", {"error": e})
                 spider.crawler.engine.close_spider(spider, "redis_error")
+                return
+        if self.retention_days or self.max_size:
+            self._trim_task = asyncio.get_event_loop().create_task(self.trim_timer(spider))
+
+    async def trim_timer(self, spider):
+        """定时清理去重库"""
+        dup_key = getattr(spider, "redis_dup_key", None)
+        redis_key = "dupefilter:" + (dup_key or spider.name)
+        while True:
+            try:
+                await self.trim_dupefilter(spider, redis_key)
+            except RedisError as e:
+                logger.warning(f"清理去重库{redis_key}失败: {e}")
+            await asyncio.sleep(self.trim_interval)
+
+    async def trim_dupefilter(self, spider, redis_key: str) -> int:
+        """按保留天数和数量上限分批删除最旧的指纹，返回删除的数量，其他worker正在清理时跳过"""
+        lock_key = f"{redis_key}:trim_lock"
+        # 锁在清理周期结束时自动过期，不主动释放，同一周期内其他worker不再重复清理
+        if not await self.client.set(lock_key, 1, nx=True, px=int(self.trim_interval * 1000)):
+            return 0
+        memory_before = await self.memory_usage(redis_key)
+        removed = 0
+        if self.retention_days:
+            cutoff = (time.time() - self.retention_days * 86400) * 1000
+            removed += await self.trim_oldest(self.trim_below_script, redis_key, f"{cutoff:.0f}")
+        if self.max_size:
+            removed += await self.trim_oldest(self.trim_excess_script, redis_key, self.max_size)
+        if removed:
+            reclaimed = max(memory_before - await self.memory_usage(redis_key), 0)
+            stats = spider.crawler.stats
+            stats.inc_value("dupefilter/trim/removed", removed, spider=spider)
+            stats.inc_value("dupefilter/trim/bytes_reclaimed", reclaimed, spider=spider)
+            logger.info(f"清理去重库{redis_key}: 删除{removed}个指纹，释放{reclaimed / 1024 / 1024:.2f}MB")
+        return removed
+
+    async def trim_oldest(self, script: str, redis_key: str, limit) -> int:
+        """分批执行清理脚本，每批最多删除trim_batch个成员，直到没有需要删除的成员"""
+        removed = 0
+        while True:
+            deleted = await self.client.eval(script, 1, redis_key, limit, self.trim_batch)
+            removed += deleted
+            if deleted < self.trim_batch:
+                break
+            # 让出事件循环，避免长时间占用
+            await asyncio.sleep(0)
+        return removed
+
+    async def memory_usage(self, redis_key: str) -> int:
+        try:
+            return await self.client.memory_usage(redis_key) or 0
+        except RedisError:
+            return 0
 
     async def spider_closed(self, spider):
+        if self._trim_task:
+            self._trim_task.cancel()
         if self.client:
             await self.client.close()
             logger.info("关闭redis连接")
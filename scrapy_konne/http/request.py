@@ -2,6 +2,7 @@ from typing import Callable, List, Optional, Tuple, Union
 from scrapy.http.request import Request as ScrapyRequest
 from scrapy.http.request.json_request import JsonRequest as ScrapyJsonRequest
 from scrapy.http.request.form import FormRequest as ScrapyFormRequest
+from scrapy_konne.utils.fingerprint import get_url_fp
 
 
 class KRequest(ScrapyRequest):
@@ -73,8 +74,16 @@ class KRequest(ScrapyRequest):
     @filter_url.setter
     def filter_url(self, filter_url: Optional[str]) -> None:
         self._filter_url = filter_url
+        self._url_fp = None
         self.meta["filter_url"] = filter_url
 
+    @property
+    def url_fp(self) -> Optional[int]:
+        """filter_url的指纹，第一次访问时计算"""
+        if self._url_fp is None and self._filter_url:
+            self._url_fp = get_url_fp(self._filter_url)
+        return self._url_fp
+
     @property
     def cursor(self) -> Optional[int]:
         return self._cursor
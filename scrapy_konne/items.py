@@ -2,6 +2,8 @@ from dataclasses import dataclass
 from dataclasses import field
 from datetime import datetime
 
+from scrapy_konne.utils.fingerprint import get_url_fp
+
 
 @dataclass
 class DetailDataItem:
@@ -50,6 +52,11 @@ class DetailDataItem:
     ip_area: str = field(default="")
     video_image: str = field(default="")
 
+    @property
+    def url_fp(self) -> int:
+        """source_url的指纹，由url_fingerprinter的LRU缓存，不会重复标准化"""
+        return get_url_fp(self.source_url)
+
 
 @dataclass
 class IncreamentItem(DetailDataItem):
@@ -1,4 +1,8 @@
-from .dupefilter import UrlRedisDupefilterMiddleware,UrlRedisDupefilterDownloaderMiddleware
+from .dupefilter import (
+    UrlRedisDupefilterMiddleware,
+    UrlRedisDupefilterDownloaderMiddleware,
+    UrlRedisBatchDupefilterSpiderMiddleware,
+)
 from .impersonate import ImpersonateDownloaderMiddleware
 from .proxypool import (
     RedisProxyPoolDownloaderMiddleware,
@@ -10,9 +14,10 @@ from .fakeua import FakeUADownloaderMiddleware
 
 __all__ = [
     "FakeUADownloaderMiddleware",
-    "ImpersonateDownloaderMiddleware"
+    "ImpersonateDownloaderMiddleware",
     "UrlRedisDupefilterMiddleware",
-    "UrlRedisDupefilterDownloaderMiddleware"
+    "UrlRedisDupefilterDownloaderMiddleware",
+    "UrlRedisBatchDupefilterSpiderMiddleware",
     "RedisProxyPoolDownloaderMiddleware",
     "ProxyPoolDownloaderMiddleware",
     "ExtraTerritoryProxyDownloaderMiddleware",
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+
+from redis import Redis
+from redis.exceptions import RedisError
+from scrapy import signals
+from scrapy.crawler import Crawler
+from scrapy.exceptions import NotConfigured
+
+logger = logging.getLogger(__name__)
+
+
+class SeederLockMiddleware:
+    """
+    多个worker共同消费同一个请求队列时，只由一个worker写入种子请求。
+
+    开启``SCHEDULER_COORDINATED``后，每个worker启动时尝试获取种子锁``request_queue:{爬虫名}:seeder``，
+    获取到锁的worker执行start_requests，执行期间每隔锁时长的三分之一续约，执行完毕后写入标记``:seeded``，锁在短暂保留后过期；
+    其他worker跳过start_requests，只消费队列。正在运行的worker不会接管种子写入：持有锁的worker失联后，
+    锁在``SCHEDULER_SEEDER_LOCK_TTL``秒后过期，之后新启动的worker会重新写入种子。
+    标记在``SCHEDULER_SEEDED_TTL``秒（默认一天）后过期，异常退出遗留的标记不会让之后的运行一直跳过种子。
+
+    RedisQueue在精确统计时会把种子锁计入待处理数量，因此只有队列为空、所有worker都没有租约且没有worker在写入种子时，
+    爬虫才会结束。爬虫关闭时释放自己仍持有的锁，正常结束时删除标记，下次运行重新写入种子。
+    """
+
+    RELEASE_GRACE_MS = 5000
+
+    RENEW_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) end return 0"
+    """只续约自己持有的锁"""
+
+    DELETE_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+    """只删除自己持有的锁"""
+
+    def __init__(self, crawler: Crawler, redis_url: str, lock_ttl=30, seeded_ttl=86400) -> None:
+        self.crawler = crawler
+        self.redis_url = redis_url
+        self.lock_ttl_ms = int(lock_ttl * 1000)
+        self.seeded_ttl_ms = int(seeded_ttl * 1000)
+        self.token = f"{socket.gethostname()}:{os.getpid()}:{time.time()}"
+        self.client = None
+        self.seeder_key = None
+        self.seeded_key = None
+        self._renew_task = None
+
+    @classmethod
+    def from_crawler(cls, crawler: Crawler):
+        settings = crawler.settings
+        if not settings.getbool("SCHEDULER_COORDINATED", False):
+            raise NotConfigured("SCHEDULER_COORDINATED 未开启")
+        redis_url = settings.get("REDIS_URL")
+        if not redis_url:
+            raise NotConfigured("REDIS_URL 未设置")
+        middleware = cls(
+            crawler,
+            redis_url,
+            lock_ttl=settings.getfloat("SCHEDULER_SEEDER_LOCK_TTL", 30),
+            seeded_ttl=settings.getfloat("SCHEDULER_SEEDED_TTL", 86400),
+        )
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        return middleware
+
+    @property
+    def redis_client(self):
+        """续约和释放锁使用全局异步redis连接，不阻塞事件循环"""
+        if not getattr(self, "_redis_client", None):
+            self._redis_client = getattr(self.crawler, "redis_client", None)
+            if self._redis_client is None:
+                raise RuntimeError("未找到全局redis连接，请开启GlobalAsyncRedisExtension拓展")
+            self._renew = self._redis_client.register_script(self.RENEW_SCRIPT)
+        return self._redis_client
+
+    def _connect(self, spider):
+        if self.client is None:
+            # 获取锁发生在start_requests开始前，只执行一次，使用同步连接
+            self.client = Redis.from_url(self.redis_url, socket_timeout=10)
+            self.seeder_key = f"request_queue:{spider.name}:seeder"
+            self.seeded_key = f"request_queue:{spider.name}:seeded"
+
+    def acquire(self) -> bool:
+        if self.client.exists(self.seeded_key):
+            logger.info("种子请求已由其他worker写入，当前worker只消费队列")
+            return False
+        if not self.client.set(self.seeder_key, self.token, nx=True, px=self.lock_ttl_ms):
+            logger.info("其他worker正在写入种子请求，当前worker只消费队列")
+            return False
+        logger.info("获取种子锁成功，开始写入种子请求")
+        return True
+
+    async def renew_timer(self):
+        """写入种子期间定时续约，引擎暂停消费start_requests时锁也不会过期"""
+        while True:
+            await asyncio.sleep(self.lock_ttl_ms / 3000)
+            try:
+                if not await self._renew(keys=[self.seeder_key], args=[self.token, self.lock_ttl_ms]):
+                    logger.warning("种子锁已过期，可能有其他worker重复写入种子请求")
+            except RedisError as e:
+                logger.error(f"种子锁续约失败: {e}")
+
+    async def release(self, seeded: bool):
+        """写入标记，锁保留一段时间后过期"""
+        try:
+            if seeded:
+                await self.redis_client.set(self.seeded_key, self.token, px=self.seeded_ttl_ms)
+            # 最后一批种子请求还在RedisQueue的写入缓冲区中，锁保留一段时间后再过期，避免其他worker误判队列已空
+            await self._renew(keys=[self.seeder_key], args=[self.token, self.RELEASE_GRACE_MS])
+        except RedisError as e:
+            logger.error(f"释放种子锁失败: {e}")
+
+    def process_start_requests(self, start_requests, spider):
+        self._connect(spider)
+        if not self.acquire():
+            return
+        self.redis_client  # 注册续约脚本
+        loop = asyncio.get_event_loop()
+        self._renew_task = loop.create_task(self.renew_timer())
+        seeded = False
+        try:
+            yield from start_requests
+            seeded = True
+            logger.info("种子请求写入完毕")
+        finally:
+            self._renew_task.cancel()
+            loop.create_task(self.release(seeded))
+
+    def spider_closed(self, spider, reason):
+        if self.client is None:
+            return
+        if self._renew_task is not None:
+            self._renew_task.cancel()
+        # 爬虫已关闭，不再需要保留锁；未写完种子就退出时，之后启动的worker可以立即重新写入
+        self.client.eval(self.DELETE_SCRIPT, 1, self.seeder_key, self.token)
+        if reason == "finished":
+            self.client.delete(self.seeded_key)
+        self.client.close()
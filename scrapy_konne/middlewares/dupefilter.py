@@ -4,17 +4,35 @@ from scrapy import Request
 from scrapy.crawler import Crawler
 import logging
 from scrapy_konne.exceptions import RedisDuplicateRequest
-from scrapy_konne.utils.fingerprint import get_url_fp
+from scrapy_konne.http import KRequest
+from scrapy_konne.utils.cache import FingerprintCache
+from scrapy_konne.utils.fingerprint import encode_fp, get_url_fp
 
 
 logger = logging.getLogger(__name__)
 
 
+def request_dup_key(request: Request):
+    """请求的去重指纹和用于日志的key，不需要去重时返回None"""
+    if request.dont_filter is False:
+        # 如果是自增id，则判断id是否存在
+        cursor = request.meta.get("cursor")
+        if cursor:
+            return cursor, cursor
+        # 如果是url，则判断url是否存在，KRequest上缓存了filter_url的指纹
+        if isinstance(request, KRequest) and request.filter_url:
+            return request.url_fp, request.filter_url
+        url = request.meta.get("filter_url") or request.url
+        return get_url_fp(url), url
+    return None
+
+
 class UrlRedisDupefilterDownloaderMiddleware:
     def __init__(self, crawler: Crawler):
         self.crawler = crawler
         dup_key = getattr(crawler.spider, "redis_dup_key", None)
         self.redis_key = "dupefilter:" + (dup_key or crawler.spider.name)
+        self.cache = FingerprintCache.from_crawler(crawler, self.redis_key)
         self.loop = asyncio.get_event_loop()
 
     @classmethod
@@ -23,19 +41,10 @@ class UrlRedisDupefilterDownloaderMiddleware:
         return object
 
     async def is_dup_request(self, request):
-        if request.dont_filter is False:
-            # 如果是自增id，则判断id是否存在
-            cursor = request.meta.get("cursor")
-            if cursor:
-                if await self.get_redis_client().zscore(self.redis_key, cursor):
-                    return cursor
-                return None
-            else:
-                # 如果是url，则判断url是否存在
-                url = request.meta.get("filter_url") or request.url
-                fp = get_url_fp(url)
-                if await self.get_redis_client().zscore(self.redis_key, fp):
-                    return url
+        if dup_key := request_dup_key(request):
+            fp, key = dup_key
+            if await self.cache.exists(fp):
+                return key
         return None
 
     async def process_request(self, request, spider):
@@ -50,6 +59,54 @@ class UrlRedisDupefilterDownloaderMiddleware:
         return self._async_redis_client
 
 
+class UrlRedisBatchDupefilterSpiderMiddleware:
+    """
+    在请求进入调度器之前，按响应批量去重。
+
+    收集同一个响应产出的所有请求，通过一次ZMSCORE查询它们的指纹，重复的请求直接丢弃，
+    避免重复请求经过序列化、入队和出队后才被下载中间件拒绝。item和不需要去重的请求不等待，直接产出。
+    每攒够``DEDUP_RESPONSE_BATCH_SIZE``个请求查询一次，防止超长的列表页延迟请求。
+    """
+
+    def __init__(self, crawler: Crawler, batch_size=200):
+        self.crawler = crawler
+        self.batch_size = batch_size
+        dup_key = getattr(crawler.spider, "redis_dup_key", None)
+        self.redis_key = "dupefilter:" + (dup_key or crawler.spider.name)
+        self.cache = FingerprintCache.from_crawler(crawler, self.redis_key)
+
+    @classmethod
+    def from_crawler(cls, crawler: Crawler):
+        return cls(crawler, crawler.settings.getint("DEDUP_RESPONSE_BATCH_SIZE", 200))
+
+    async def process_spider_output(self, response, result, spider):
+        batch = []
+        async for r in result:
+            if isinstance(r, Request) and (dup_key := request_dup_key(r)):
+                batch.append((r, *dup_key))
+                if len(batch) >= self.batch_size:
+                    for request in await self.filter_batch(batch, spider):
+                        yield request
+                    batch = []
+                continue
+            yield r
+        for request in await self.filter_batch(batch, spider):
+            yield request
+
+    async def filter_batch(self, batch, spider) -> list[Request]:
+        if not batch:
+            return []
+        exists = await self.cache.exists_many([fp for _, fp, _ in batch])
+        requests = []
+        for (request, _, key), dup in zip(batch, exists):
+            if dup:
+                self.crawler.stats.inc_value("dupefilter/redis", spider=spider)
+                logger.debug(f"去重key已存在 <{key}>")
+            else:
+                requests.append(request)
+        return requests
+
+
 @deprecated("使用 UrlRedisDupefilterDownloaderMiddleware 请求中间件以替代")
 class UrlRedisDupefilterMiddleware:
 
@@ -57,6 +114,7 @@ class UrlRedisDupefilterMiddleware:
         self.crawler = crawler
         dup_key = getattr(crawler.spider, "redis_dup_key", None)
         self.redis_key = "dupefilter:" + (dup_key or crawler.spider.name)
+        self.encoding = crawler.settings.get("DUPEFILTER_FP_ENCODING", "decimal")
         self.loop = asyncio.get_event_loop()
 
     @classmethod
@@ -105,7 +163,12 @@ class UrlRedisDupefilterMiddleware:
             url = request.meta.get("filter_url")
             if url:
                 hash_value = get_url_fp(request.meta["filter_url"])
-                if await self.get_redis_client().zscore(self.redis_key, hash_value):
+                member = encode_fp(hash_value, self.encoding)
+                client = self.get_redis_client()
+                # 兼容迁移前的十进制成员
+                if await client.zscore(self.redis_key, member) or (
+                    member != hash_value and await client.zscore(self.redis_key, hash_value)
+                ):
                     return url
         return None
 
@@ -119,6 +182,11 @@ class UrlRedisDupefilterMiddleware:
             url = request.meta.get("filter_url")
             if url:
                 hash_value = get_url_fp(request.meta["filter_url"])
-                if self.get_redis_client(sync=True).zscore(self.redis_key, hash_value):
-                    return cursor
+                member = encode_fp(hash_value, self.encoding)
+                client = self.get_redis_client(sync=True)
+                # 兼容迁移前的十进制成员
+                if client.zscore(self.redis_key, member) or (
+                    member != hash_value and client.zscore(self.redis_key, hash_value)
+                ):
+                    return url
         return None
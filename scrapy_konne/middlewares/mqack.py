@@ -1,19 +1,51 @@
+from scrapy import Request
 from scrapy.crawler import Crawler
 from scrapy_konne.core.signals import Event
 
 
 class AckSignalMiddleware:
+    """
+    请求处理完毕后发送ack信号，由调度器确认队列中的租约。
+
+    作为爬虫中间件时，在回调的输出全部消费后确认；作为下载中间件时，在下载失败（包括被去重中间件忽略）时确认，
+    两者需要同时开启。
+
+    回调中用``meta=response.meta``或``request.copy()``创建的请求会继承父请求的租约标记``mq_lease``，
+    作为爬虫中间件时在输出中清除该标记，避免子请求入队时提前确认父请求的租约；
+    重试、重定向等由下载中间件复制出的请求不经过这里，仍在入队时确认原请求。
+    """
 
     def __init__(self, crawler: Crawler) -> None:
         self.crawler = crawler
 
-    def process_spider_output(self, response, result, spider):
+    def send_ack(self, request, spider):
         self.crawler.signals.send_catch_log(
             signal=Event.REQUEST_ACK,
-            request=response.request,
+            request=request,
             spider=spider,
         )
-        return result
+
+    @staticmethod
+    def strip_lease(output):
+        if isinstance(output, Request):
+            output.meta.pop("mq_lease", None)
+        return output
+
+    def process_spider_output(self, response, result, spider):
+        for r in result:
+            yield self.strip_lease(r)
+        self.send_ack(response.request, spider)
+
+    async def process_spider_output_async(self, response, result, spider):
+        async for r in result:
+            yield self.strip_lease(r)
+        self.send_ack(response.request, spider)
+
+    def process_spider_exception(self, response, exception, spider):
+        self.send_ack(response.request, spider)
+
+    def process_exception(self, request, exception, spider):
+        self.send_ack(request, spider)
 
     @classmethod
     def from_crawler(cls, crawler):
@@ -9,6 +9,8 @@ from scrapy.exceptions import NotConfigured
 from scrapy_konne.constants import LOCALE
 from scrapy import signals
 from scrapy.exceptions import IgnoreRequest
+from scrapy_konne.middlewares.retry import delay_request
+from scrapy_konne.utils.retry import DEFAULT_BACKOFF_BASE, backoff_delay
 
 logger = logging.getLogger("代理池中间件")
 
@@ -54,6 +56,8 @@ class RedisProxyPoolDownloaderMiddleware:
         self.empty_wait_time = crawler.settings.getfloat("PROXY_EMPTY_WAIT_TIME", 5)
         self._sem = asyncio.Semaphore(1)
         self.crawler = crawler
+        self.backoff_base = {**DEFAULT_BACKOFF_BASE, **crawler.settings.getdict("RETRY_BACKOFF_BASE")}
+        self.backoff_max = crawler.settings.getfloat("RETRY_BACKOFF_MAX", 300)
 
     @classmethod
     def from_crawler(cls, crawler: Crawler):
@@ -81,7 +85,13 @@ class RedisProxyPoolDownloaderMiddleware:
             request.meta["proxy"] = await self.get_proxy()
             for Exce in self.catch_exceptions:
                 if isinstance(exception, Exce):
-                    return request
+                    # 代理隧道错误时换代理延迟重试，重试次数随请求一起序列化
+                    retry_times = request.meta.get("proxy_retry_times", 0) + 1
+                    retry_request = request.replace(dont_filter=True)
+                    retry_request.meta["proxy_retry_times"] = retry_times
+                    delay = backoff_delay(exception, retry_times, self.backoff_base, self.backoff_max)
+                    self.crawler.stats.inc_value("retry/delayed", spider=spider)
+                    return delay_request(retry_request, delay)
 
     async def get_proxy(self):
         fetch_failed_times = 0
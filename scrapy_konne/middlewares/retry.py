@@ -0,0 +1,39 @@
+import logging
+import time
+
+from scrapy.downloadermiddlewares.retry import RetryMiddleware
+from scrapy_konne.utils.retry import DEFAULT_BACKOFF_BASE, backoff_delay
+
+logger = logging.getLogger(__name__)
+
+
+def delay_request(request, delay: float):
+    """设置请求的就绪时间，RedisQueue会以未来的分数写入，到期后才会被拉取"""
+    request.meta["mq_ready_at"] = time.time() + delay
+    return request
+
+
+class DelayedRetryMiddleware(RetryMiddleware):
+    """
+    延迟重试中间件，替代Scrapy的RetryMiddleware。
+
+    重试请求不再立即重新调度，而是按错误类别指数退避加随机抖动，以未来的就绪时间写回请求队列，
+    重试次数保存在请求的``retry_times``中，随请求一起序列化，进程重启后待重试的请求仍在队列中。
+    各类错误的退避基数由``RETRY_BACKOFF_BASE``配置，最大延迟为``RETRY_BACKOFF_MAX``秒。
+
+    使用时在DOWNLOADER_MIDDLEWARES中禁用``scrapy.downloadermiddlewares.retry.RetryMiddleware``，并以相同顺序启用本中间件。
+    """
+
+    def __init__(self, settings):
+        super().__init__(settings)
+        self.backoff_base = {**DEFAULT_BACKOFF_BASE, **settings.getdict("RETRY_BACKOFF_BASE")}
+        self.backoff_max = settings.getfloat("RETRY_BACKOFF_MAX", 300)
+
+    def _retry(self, request, reason, spider):
+        retry_request = super()._retry(request, reason, spider)
+        if retry_request is None:
+            return None
+        delay = backoff_delay(reason, retry_request.meta["retry_times"], self.backoff_base, self.backoff_max)
+        logger.debug(f"{delay:.1f}秒后重试 {request}: {reason}")
+        spider.crawler.stats.inc_value("retry/delayed", spider=spider)
+        return delay_request(retry_request, delay)
@@ -1,6 +1,8 @@
+import asyncio
+from collections import OrderedDict
 from scrapy_konne.utils.retry import async_retry
 import time
-from aiohttp import ClientSession
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
 import logging
 from datetime import datetime, timedelta
 from scrapy import Spider, signals
@@ -9,20 +11,25 @@ from scrapy_konne.constants import LOCALE
 from scrapy_konne.items import DetailDataItem, IncreamentItem
 from scrapy_konne.exceptions import MemorySetDuplicateItem, RedisDuplicateItem, RemoteDuplicateItem
 from scrapy_konne.exceptions import ExpriedItem
-from scrapy_konne.utils.fingerprint import get_url_fp
+from scrapy_konne.utils.cache import FingerprintCache, MicroBatcher
 from redis.asyncio import Redis
 
 logger = logging.getLogger(__name__)
 
 
-async def add_fp_to_redis(redis_key: str, redis_client, item: DetailDataItem | IncreamentItem):
-    """将指纹添加到redis缓存"""
+async def add_fp_to_redis(
+    redis_key: str, redis_client, item: DetailDataItem | IncreamentItem, cache: FingerprintCache = None
+):
+    """将指纹添加到redis缓存，同时写入本地缓存"""
     if isinstance(item, IncreamentItem):
         fp = item.increment_id
     else:
-        fp = get_url_fp(item.source_url)
-    hash_mapping = {fp: int(time.time() * 1000)}
+        fp = item.url_fp
+    member = fp if cache is None else cache.member(fp)
+    hash_mapping = {member: int(time.time() * 1000)}
     await redis_client.zadd(redis_key, hash_mapping, nx=True)
+    if cache is not None:
+        cache.set_present(fp)
 
 
 class RedisFilterPipeline:
@@ -34,6 +41,7 @@ class RedisFilterPipeline:
         self.crawler = crawler
         dup_key = getattr(crawler.spider, "redis_dup_key", None)
         self.redis_key = "dupefilter:" + (dup_key or crawler.spider.name)
+        self.cache = FingerprintCache.from_crawler(crawler, self.redis_key)
 
     @classmethod
     def from_crawler(cls, crawler: Crawler):
@@ -47,7 +55,7 @@ class RedisFilterPipeline:
         return self._redis_client
 
     async def process_item(self, item: DetailDataItem, spider: Spider):
-        if await self.redis_client.zscore(self.redis_key, get_url_fp(item.source_url)):
+        if await self.cache.exists(item.url_fp):
             raise RedisDuplicateItem(f"url已经在redis中存在，不需要上传: {item.source_url}")
         return item
 
@@ -61,6 +69,7 @@ class RedisFilteredUrlUploaderPipeline:
         self.crawler = crawler
         dup_key = getattr(crawler.spider, "redis_dup_key", None)
         self.redis_key = "dupefilter:" + (dup_key or crawler.spider.name)
+        self.cache = FingerprintCache.from_crawler(crawler, self.redis_key)
 
     @classmethod
     def from_crawler(cls, crawler: Crawler):
@@ -74,24 +83,53 @@ class RedisFilteredUrlUploaderPipeline:
         return self._redis_client
 
     async def process_item(self, item: DetailDataItem, spider: Spider):
-        await add_fp_to_redis(self.redis_key, self.redis_client, item)
+        await add_fp_to_redis(self.redis_key, self.redis_client, item, self.cache)
         return item
 
 
 class SetFilterPipeline:
-    """在本地进行预去重，避免重复上传。"""
+    """
+    在本地进行预去重，避免重复上传。
+
+    每个爬虫单独保存source_url的128位指纹，最多保存``SET_FILTER_SIZE``个（默认20万），超过后淘汰最久未出现的指纹，内存占用有上限。
+    每个指纹连同OrderedDict节点约占135字节，默认容量约27MB，100万个约135MB。
+    128位指纹的碰撞概率可以忽略，误判率上界记录在``set_filter/false_positive_rate``统计中。
+    """
+
+    def __init__(self, crawler: Crawler, max_size=200_000) -> None:
+        self.crawler = crawler
+        self.max_size = max_size
+        self.fp_seen: OrderedDict[int, None] = OrderedDict()
+        self.evicted = 0
 
-    url_seen = set()
+    @classmethod
+    def from_crawler(cls, crawler: Crawler):
+        pipeline = cls(crawler, crawler.settings.getint("SET_FILTER_SIZE", 200_000))
+        crawler.signals.connect(pipeline.spider_closed, signal=signals.spider_closed)
+        return pipeline
 
     def process_item(self, item: DetailDataItem, spider: Spider):
-        url = item.source_url
-        if url in self.url_seen:
-            raise MemorySetDuplicateItem(f"url已经在本地存在，不需要上传: {url}")
-        self.url_seen.add(url)
+        fp = item.url_fp
+        if fp in self.fp_seen:
+            self.fp_seen.move_to_end(fp)
+            raise MemorySetDuplicateItem(f"url已经在本地存在，不需要上传: {item.source_url}")
+        self.fp_seen[fp] = None
+        if len(self.fp_seen) > self.max_size:
+            self.fp_seen.popitem(last=False)
+            self.evicted += 1
+        self.update_stats(spider)
         return item
 
+    def update_stats(self, spider: Spider):
+        stats = self.crawler.stats
+        stats.set_value("set_filter/size", len(self.fp_seen), spider=spider)
+        stats.set_value("set_filter/evicted", self.evicted, spider=spider)
+        # 每次判断与已有指纹碰撞的概率上界
+        stats.set_value("set_filter/false_positive_rate", len(self.fp_seen) / 2**128, spider=spider)
+
     def spider_closed(self, spider: Spider):
-        logger.debug(f"内存set数量『{len(self.url_seen)}』：{self.url_seen}")
+        logger.debug(f"内存指纹数量『{len(self.fp_seen)}』，淘汰『{self.evicted}』")
+        self.fp_seen.clear()
 
 
 class TimeFilterPipeline:
@@ -121,6 +159,7 @@ class TimeFilterWithAddToRedisPipeline(TimeFilterPipeline):
         self.crawler = crawler
         dup_key = getattr(crawler.spider, "redis_dup_key", None)
         self.redis_key = "dupefilter:" + (dup_key or crawler.spider.name)
+        self.cache = FingerprintCache.from_crawler(crawler, self.redis_key)
 
     @classmethod
     def from_crawler(cls, crawler: Crawler):
@@ -136,7 +175,7 @@ class TimeFilterWithAddToRedisPipeline(TimeFilterPipeline):
         # 时区转换
         dis_time = datetime.now().astimezone() - timedelta(hours=self.expired_time)
         if item.publish_time < dis_time:
-            await add_fp_to_redis(self.redis_key, self.redis_client, item)
+            await add_fp_to_redis(self.redis_key, self.redis_client, item, self.cache)
             raise ExpriedItem(f"发布时间超过{self.expired_time}小时，不需要上传: {item}")
         return item
 
@@ -169,15 +208,47 @@ class KonneExtraTerritoryFilterPipeline:
 
 
 class KonneTerritoryFilterPipeline:
-    """对konne国内库中已存在的url进行过滤, 并加入redis缓存"""
+    """
+    对konne国内库中已存在的url进行过滤, 并加入redis缓存
+
+    按 本地缓存 -> redis去重库 -> konne去重接口 的顺序分级查询，前一级能确定结果时不再查询后面的级别。
+    接口返回已存在的url写回redis，下次运行直接在redis命中；接口返回不存在的url在本地缓存
+    ``KONNE_DEDUP_NEGATIVE_TTL``秒（默认60），期间不会重复请求接口，同一个url的并发查询只请求一次接口。
+
+    同时请求接口的数量不超过``KONNE_DEDUP_CONCURRENCY``（默认16），连接池复用长连接并缓存DNS。
+    设置了批量接口``KONNE_DEDUP_BULK_API``时，``KONNE_DEDUP_BATCH_WINDOW``秒内的查询合并为一次请求，
+    每批最多``KONNE_DEDUP_BATCH_SIZE``个url。批量接口接收POST的json ``{"urls": [...]}``，
+    按顺序返回每个url是否存在的json数组，例如``[1, 0]``。
+    """
 
     uri_deduplication_api: str
+    bulk_api: str | None = None
+
+    def __init__(self, negative_ttl=60, max_size=100000, concurrency=16, batch_size=50, batch_window=0.01) -> None:
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.concurrency = concurrency
+        # 指纹 -> 过期时间
+        self.remote_missing: OrderedDict[int, float] = OrderedDict()
+        self.inflight: dict[int, asyncio.Future] = {}
+        self.bulk_batcher = MicroBatcher(self.bulk_exist, batch_window, batch_size)
+        self.semaphore = asyncio.Semaphore(concurrency)
 
     async def spider_opened(self, spider: Spider):
         self.crawler = spider.crawler
         dup_key = getattr(spider, "redis_dup_key", None)
         self.redis_key = "dupefilter:" + (dup_key or spider.name)
-        self.session = ClientSession()
+        self.cache = FingerprintCache.from_crawler(self.crawler, self.redis_key)
+        self.session = self.create_session()
+
+    def create_session(self) -> ClientSession:
+        connector = TCPConnector(
+            limit=self.concurrency,
+            limit_per_host=self.concurrency,
+            ttl_dns_cache=300,
+            keepalive_timeout=30,
+        )
+        return ClientSession(connector=connector, timeout=ClientTimeout(total=10))
 
     async def spider_closed(self, spider: Spider):
         await self.session.close()
@@ -185,12 +256,32 @@ class KonneTerritoryFilterPipeline:
     @classmethod
     def from_crawler(cls, crawler: Crawler):
         upload_ip = crawler.settings.get("DEDUP_DATA_IP")
-        filter = cls()
+        filter = cls(
+            negative_ttl=crawler.settings.getfloat("KONNE_DEDUP_NEGATIVE_TTL", 60),
+            max_size=crawler.settings.getint("DEDUP_CACHE_SIZE", 100000),
+            concurrency=crawler.settings.getint("KONNE_DEDUP_CONCURRENCY", 16),
+            batch_size=crawler.settings.getint("KONNE_DEDUP_BATCH_SIZE", 50),
+            batch_window=crawler.settings.getfloat("KONNE_DEDUP_BATCH_WINDOW", 0.01),
+        )
         filter.uri_deduplication_api = f"http://{upload_ip}/BanKuaiQuChong/ExistUrl"
+        filter.bulk_api = crawler.settings.get("KONNE_DEDUP_BULK_API")
         crawler.signals.connect(filter.spider_opened, signal=signals.spider_opened)
         crawler.signals.connect(filter.spider_closed, signal=signals.spider_closed)
         return filter
 
+    async def remote_exist(self, url: str) -> bool:
+        """查询konne去重库，有批量接口时合并查询，否则限制并发逐个查询"""
+        if self.bulk_api:
+            return await self.bulk_batcher.submit(url)
+        async with self.semaphore:
+            return await self.is_url_exist(url)
+
+    async def bulk_exist(self, urls: list[str]) -> list[bool]:
+        self.crawler.stats.inc_value("dupefilter/konne/bulk_request", spider=self.crawler.spider)
+        async with self.semaphore:
+            results = await self.are_urls_exist(urls)
+        return [bool(result) for result in results]
+
     @async_retry()
     async def is_url_exist(self, url):
         filter_url = self.uri_deduplication_api
@@ -201,15 +292,63 @@ class KonneTerritoryFilterPipeline:
             result = int(await response.text())
             return bool(result)
 
+    @async_retry()
+    async def are_urls_exist(self, urls: list[str]) -> list:
+        async with self.session.post(self.bulk_api, json={"urls": urls}) as response:
+            if not response.status == 200:
+                raise Exception(f"konne批量去重接口错误：{response.status}")
+            results = await response.json(content_type=None)
+            if len(results) != len(urls):
+                raise Exception(f"konne批量去重接口返回数量错误：{len(results)}/{len(urls)}")
+            return results
+
     @property
     def redis_client(self):
         if not getattr(self, "_redis_client", None):
             self._redis_client = getattr(self.crawler, "redis_client", None)
         return self._redis_client
 
+    def is_remote_missing(self, fp) -> bool:
+        """接口最近是否返回过该url不存在"""
+        expire_at = self.remote_missing.get(fp)
+        if expire_at is None:
+            return False
+        if expire_at > time.monotonic():
+            return True
+        del self.remote_missing[fp]
+        return False
+
+    def set_remote_missing(self, fp):
+        self.remote_missing[fp] = time.monotonic() + self.negative_ttl
+        self.remote_missing.move_to_end(fp)
+        if len(self.remote_missing) > self.max_size:
+            self.remote_missing.popitem(last=False)
+
     async def process_item(self, item: DetailDataItem, spider: Spider):
         url = item.source_url
-        if await self.is_url_exist(url):
-            await add_fp_to_redis(self.redis_key, self.redis_client, item)
+        fp = item.url_fp
+        stats = self.crawler.stats
+        if await self.cache.exists(fp):
+            raise RedisDuplicateItem(f"url已经在redis中存在，不需要上传: {url}")
+        if self.is_remote_missing(fp):
+            stats.inc_value("dupefilter/konne/negative_hit", spider=spider)
+            return item
+        # 同一个url的并发查询共享一次接口请求
+        task = self.inflight.get(fp)
+        if task is None:
+            task = self.inflight[fp] = asyncio.ensure_future(self.lookup_remote(item, spider))
+            task.add_done_callback(lambda _: self.inflight.pop(fp, None))
+        if await asyncio.shield(task):
             raise RemoteDuplicateItem(f"url已经在http去重库存在，不需要上传: {url}")
         return item
+
+    async def lookup_remote(self, item: DetailDataItem, spider: Spider) -> bool:
+        """请求konne去重接口，存在时写回redis，不存在时缓存否定结果"""
+        stats = self.crawler.stats
+        stats.inc_value("dupefilter/konne/request", spider=spider)
+        if await self.remote_exist(item.source_url):
+            stats.inc_value("dupefilter/konne/exist", spider=spider)
+            await add_fp_to_redis(self.redis_key, self.redis_client, item, self.cache)
+            return True
+        self.set_remote_missing(item.url_fp)
+        return False
@@ -8,7 +8,7 @@ from scrapy_konne.exceptions import ItemFieldError
 from w3lib.html import replace_entities
 from dateutil.parser import parse as time_parse
 from scrapy_konne.utils.tools import format_time
-from w3lib.url import canonicalize_url
+from scrapy_konne.utils.fingerprint import canonical_url
 
 logger = logging.getLogger(__name__)
 
@@ -89,7 +89,7 @@ class UrlCanonicalizationPipeline:
     """
 
     def process_item(self, item: DetailDataItem, spider: Spider):
-        item.source_url = canonicalize_url(item.source_url, keep_fragments=True)
+        item.source_url = canonical_url(item.source_url)
         return item
 
 
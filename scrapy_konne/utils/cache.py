@@ -0,0 +1,333 @@
+import asyncio
+import bisect
+from collections import OrderedDict
+from itertools import takewhile
+import logging
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+from scrapy import signals
+from scrapy.crawler import Crawler
+from scrapy_konne.utils.fingerprint import FP_ENCODINGS, FP_SIZES, decode_fp, encode_fp, fp_key, is_url_fp, url_fingerprinter
+
+logger = logging.getLogger(__name__)
+
+
+class SortedFingerprints:
+    """
+    排序后的指纹数组，每个指纹以``fp_size``字节大端序连续保存在一个bytes中，通过二分查找判断是否存在。
+
+    大端序字节的比较顺序和无符号整数一致，128位指纹只占16字节，64位模式下只占8字节。
+    """
+
+    def __init__(self, fps=(), fp_size=16) -> None:
+        self.fp_size = fp_size
+        self.data = b"".join(sorted(fp.to_bytes(fp_size, "big") for fp in fps))
+
+    def __len__(self):
+        return len(self.data) // self.fp_size
+
+    def __getitem__(self, index: int) -> bytes:
+        start = index * self.fp_size
+        return self.data[start : start + self.fp_size]
+
+    def __contains__(self, fp) -> bool:
+        if not isinstance(fp, int) or not 0 <= fp < 1 << self.fp_size * 8:
+            return False
+        target = fp.to_bytes(self.fp_size, "big")
+        index = bisect.bisect_left(self, target)
+        return index < len(self) and self[index] == target
+
+    @classmethod
+    async def load(
+        cls, redis_client, redis_key: str, min_score: float, chunk_size=10000, encoding="decimal"
+    ) -> "SortedFingerprints":
+        """
+        用ZRANGEBYSCORE分批读取分数不小于min_score的指纹，游标、自增id等不是url指纹的成员跳过。
+
+        下一批从上一批的最后一个分数开始读取，只跳过该分数上已经读过的成员，不使用随批数增长的偏移量。
+        """
+        fp_size = FP_SIZES[encoding]
+        fps = []
+        offset = 0
+        while True:
+            chunk = await redis_client.zrangebyscore(
+                redis_key, min_score, "+inf", start=offset, num=chunk_size, withscores=True
+            )
+            for member, _ in chunk:
+                fp = decode_fp(member, encoding)
+                if fp is not None:
+                    fps.append(fp)
+            if len(chunk) < chunk_size:
+                break
+            # 分数相同的成员按字典序排列，已读过的成员一定排在最前面
+            last_score = chunk[-1][1]
+            ties = sum(1 for _ in takewhile(lambda entry: entry[1] == last_score, reversed(chunk)))
+            if last_score == min_score:
+                offset += ties
+            else:
+                min_score, offset = last_score, ties
+        return cls(set(fps), fp_size)
+
+
+class MicroBatcher:
+    """
+    合并同一时间窗口内的并发查询，第一个查询到来后等待``window``秒或攒够``batch_size``个再交给``resolver``一次处理。
+
+    ``resolver``是接收查询列表、按顺序返回每个结果的协程函数，抛出的异常传给这一批的所有调用方。
+    ``share``为True时同一批中相同的查询共享一个future，查询必须可哈希；
+    为False时每次查询单独排队，按提交顺序交给resolver。
+    """
+
+    def __init__(self, resolver: Callable[[list], Awaitable[list]], window=0.002, batch_size=500, share=True) -> None:
+        self.resolver = resolver
+        self.window = window
+        self.batch_size = batch_size
+        self.share = share
+        self.pending: list[tuple[Any, asyncio.Future]] = []
+        self.shared: dict[Any, asyncio.Future] = {}
+        self._handle: Optional[asyncio.TimerHandle] = None
+
+    def submit(self, query) -> asyncio.Future:
+        """提交查询，返回的future结果为resolver对该查询返回的结果"""
+        if self.share and query in self.shared:
+            return self.shared[query]
+        future = asyncio.get_event_loop().create_future()
+        self.pending.append((query, future))
+        if self.share:
+            self.shared[query] = future
+        if len(self.pending) >= self.batch_size:
+            self.dispatch()
+        elif self._handle is None:
+            self._handle = asyncio.get_event_loop().call_later(self.window, self.dispatch)
+        return future
+
+    def dispatch(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if self.pending:
+            batch, self.pending, self.shared = self.pending, [], {}
+            asyncio.get_event_loop().create_task(self.resolve(batch))
+
+    async def resolve(self, batch: list[tuple[Any, asyncio.Future]]):
+        try:
+            results = await self.resolver([query for query, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+class ScoreBatcher(MicroBatcher):
+    """
+    合并并发的ZSCORE查询，同一时间窗口内的查询通过一次ZMSCORE完成。
+
+    第一个查询到来后等待``window``秒或攒够``batch_size``个指纹再发送，相同指纹的并发查询共享结果。
+    """
+
+    def __init__(self, crawler: Crawler, redis_key: str, window=0.002, batch_size=500) -> None:
+        super().__init__(self.zmscore, window, batch_size)
+        self.crawler = crawler
+        self.redis_key = redis_key
+
+    @property
+    def redis_client(self):
+        if not getattr(self, "_redis_client", None):
+            self._redis_client = getattr(self.crawler, "redis_client", None)
+        return self._redis_client
+
+    def score(self, fp) -> asyncio.Future:
+        """查询指纹的分数，返回的future结果为分数或None"""
+        return self.submit(fp)
+
+    async def zmscore(self, members: list) -> list:
+        scores = await self.redis_client.zmscore(self.redis_key, members)
+        self.crawler.stats.inc_value("dupefilter/redis/batches", spider=self.crawler.spider)
+        return scores
+
+
+class FingerprintCache:
+    """
+    redis去重库前的本地两级缓存，同一个crawler内的中间件和pipeline共享。
+
+    已确认存在的指纹放入容量为``DEDUP_CACHE_SIZE``的LRU缓存，指纹只会被添加，因此不需要过期；
+    确认不存在的指纹放入负缓存，``DEDUP_NEGATIVE_TTL``秒后过期，避免其他worker写入后长时间误判。
+    自己通过add_fp_to_redis写入的指纹会直接进入正缓存并移出负缓存。
+    缓存未命中的查询交给ScoreBatcher合并，窗口和批大小由``DEDUP_BATCH_WINDOW``和``DEDUP_BATCH_SIZE``设置。
+
+    设置``DEDUP_PRELOAD_DAYS``后，爬虫启动时在后台把最近几天写入的指纹分批读入SortedFingerprints，
+    加载完成后这部分指纹直接在本地判断，redis只用于未命中的查询；加载期间的查询照常走缓存和redis，不等待加载。
+
+    ``DUPEFILTER_FP_ENCODING``设置redis中指纹成员的编码方式，见``fingerprint.FP_ENCODINGS``。
+    迁移期间``DUPEFILTER_FP_DUAL_READ``（默认开启）同时查询新编码和旧的十进制成员，迁移完成后可以关闭。
+    """
+
+    def __init__(
+        self,
+        crawler: Crawler,
+        redis_key: str,
+        size=100000,
+        negative_ttl=10,
+        batch_window=0.002,
+        batch_size=500,
+        preload_days=0,
+        preload_chunk=10000,
+        encoding="decimal",
+        dual_read=True,
+    ) -> None:
+        if encoding not in FP_ENCODINGS:
+            raise ValueError(f"不支持的指纹编码: {encoding}，可选: {FP_ENCODINGS}")
+        self.crawler = crawler
+        self.redis_key = redis_key
+        self.encoding = encoding
+        self.dual_read = dual_read and encoding != "decimal"
+        self.preload_days = preload_days
+        self.preload_chunk = preload_chunk
+        self.preloaded: Optional[SortedFingerprints] = None
+        self._preload_task: Optional[asyncio.Task] = None
+        self.batcher = ScoreBatcher(crawler, redis_key, batch_window, batch_size)
+        self.size = size
+        self.negative_ttl = negative_ttl
+        self.present: OrderedDict[int, None] = OrderedDict()
+        # 指纹 -> 过期时间
+        self.missing: OrderedDict[int, float] = OrderedDict()
+
+    @classmethod
+    def from_crawler(cls, crawler: Crawler, redis_key: str) -> "FingerprintCache":
+        """获取crawler上该去重key共享的缓存"""
+        caches = getattr(crawler, "fingerprint_caches", None)
+        if caches is None:
+            caches = crawler.fingerprint_caches = {}
+            url_fingerprinter.track(crawler)
+        if redis_key not in caches:
+            caches[redis_key] = cls(
+                crawler,
+                redis_key,
+                size=crawler.settings.getint("DEDUP_CACHE_SIZE", 100000),
+                negative_ttl=crawler.settings.getfloat("DEDUP_NEGATIVE_TTL", 10),
+                batch_window=crawler.settings.getfloat("DEDUP_BATCH_WINDOW", 0.002),
+                batch_size=crawler.settings.getint("DEDUP_BATCH_SIZE", 500),
+                preload_days=crawler.settings.getfloat("DEDUP_PRELOAD_DAYS", 0),
+                preload_chunk=crawler.settings.getint("DEDUP_PRELOAD_CHUNK", 10000),
+                encoding=crawler.settings.get("DUPEFILTER_FP_ENCODING", "decimal"),
+                dual_read=crawler.settings.getbool("DUPEFILTER_FP_DUAL_READ", True),
+            )
+            crawler.signals.connect(caches[redis_key].spider_opened, signal=signals.spider_opened)
+            crawler.signals.connect(caches[redis_key].spider_closed, signal=signals.spider_closed)
+        return caches[redis_key]
+
+    def spider_opened(self, spider):
+        self.start_preload()
+
+    def spider_closed(self, spider):
+        if self._preload_task is not None:
+            self._preload_task.cancel()
+
+    def start_preload(self):
+        """在后台开始预加载，只执行一次；spider_opened之后才创建的缓存在第一次查询时开始"""
+        if self.preload_days and self._preload_task is None:
+            self._preload_task = asyncio.get_event_loop().create_task(self.preload())
+
+    async def preload(self):
+        """读取最近``preload_days``天的指纹"""
+        # 全局redis连接在spider_opened中异步建立，可能晚于预加载开始
+        for _ in range(100):
+            if self.batcher.redis_client is not None:
+                break
+            await asyncio.sleep(0.1)
+        start = time.time()
+        min_score = (start - self.preload_days * 86400) * 1000
+        try:
+            if self.batcher.redis_client is None:
+                raise RuntimeError("未找到全局redis连接，请开启GlobalAsyncRedisExtension拓展")
+            preloaded = await SortedFingerprints.load(
+                self.batcher.redis_client, self.redis_key, min_score, self.preload_chunk, self.encoding
+            )
+        except Exception as e:
+            logger.error(f"预加载{self.redis_key}失败，全部查询redis: {e}")
+            return
+        self.preloaded = preloaded
+        self.crawler.stats.set_value("dupefilter/preload/size", len(self.preloaded), spider=self.crawler.spider)
+        logger.info(
+            f"预加载{self.redis_key}最近{self.preload_days}天的{len(self.preloaded)}个指纹，"
+            f"占用{len(self.preloaded.data) / 1024 / 1024:.1f}MB，耗时{time.time() - start:.2f}秒"
+        )
+
+    def get(self, fp) -> Optional[bool]:
+        """查询本地缓存，存在返回True，确认不存在返回False，未知返回None"""
+        stats = self.crawler.stats
+        if self.preloaded is not None and is_url_fp(fp) and fp_key(fp, self.encoding) in self.preloaded:
+            stats.inc_value("dupefilter/preload/hit", spider=self.crawler.spider)
+            return True
+        if fp in self.present:
+            self.present.move_to_end(fp)
+            stats.inc_value("dupefilter/cache/hit", spider=self.crawler.spider)
+            return True
+        expire_at = self.missing.get(fp)
+        if expire_at is not None:
+            if expire_at > time.monotonic():
+                stats.inc_value("dupefilter/cache/negative_hit", spider=self.crawler.spider)
+                return False
+            del self.missing[fp]
+        stats.inc_value("dupefilter/cache/miss", spider=self.crawler.spider)
+        return None
+
+    def member(self, fp):
+        """指纹写入redis时使用的成员，只有url指纹会被编码"""
+        return encode_fp(fp, self.encoding)
+
+    def members(self, fp) -> list:
+        """查询指纹时需要检查的成员，迁移期间包含旧的十进制成员"""
+        if self.dual_read and is_url_fp(fp):
+            return [self.member(fp), fp]
+        return [self.member(fp)]
+
+    def set_present(self, fp):
+        self.missing.pop(fp, None)
+        self.present[fp] = None
+        self.present.move_to_end(fp)
+        if len(self.present) > self.size:
+            self.present.popitem(last=False)
+
+    def set_missing(self, fp):
+        self.missing[fp] = time.monotonic() + self.negative_ttl
+        self.missing.move_to_end(fp)
+        if len(self.missing) > self.size:
+            self.missing.popitem(last=False)
+
+    async def exists(self, fp) -> bool:
+        """指纹是否在redis去重库中，优先使用本地缓存"""
+        self.start_preload()
+        cached = self.get(fp)
+        if cached is not None:
+            return cached
+        scores = await asyncio.gather(*(self.batcher.score(member) for member in self.members(fp)))
+        if any(scores):
+            self.set_present(fp)
+            return True
+        self.set_missing(fp)
+        return False
+
+    async def exists_many(self, fps: list) -> list[bool]:
+        """批量查询指纹是否在redis去重库中，缓存未命中的指纹通过一次ZMSCORE查询"""
+        self.start_preload()
+        results = [self.get(fp) for fp in fps]
+        unknown = list(dict.fromkeys(fp for fp, cached in zip(fps, results) if cached is None))
+        if unknown:
+            members = [self.members(fp) for fp in unknown]
+            flat = [member for fp_members in members for member in fp_members]
+            scores = iter(await self.batcher.redis_client.zmscore(self.redis_key, flat))
+            found = {}
+            for fp, fp_members in zip(unknown, members):
+                found[fp] = any([next(scores) for _ in fp_members])
+                if found[fp]:
+                    self.set_present(fp)
+                else:
+                    self.set_missing(fp)
+            results = [found[fp] if cached is None else cached for fp, cached in zip(fps, results)]
+        return results
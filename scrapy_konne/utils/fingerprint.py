@@ -1,7 +1,164 @@
+from collections import OrderedDict
+import re
+from urllib.parse import unquote_to_bytes
+
 import mmh3
+from scrapy import signals
+from scrapy.utils.project import get_project_settings
 from w3lib.url import canonicalize_url
 
+# 只匹配标准化后不会改变（除了host大小写和query顺序）的纯ASCII url：
+# path中不含参数分隔符";"，百分号编码只允许大写的非ASCII字节（解码后会原样编码回来），
+# query中每个参数都是k=v形式，只含urlencode不会转义的字符，fragment只含w3lib的安全字符
+_PCT_HIGH = r"%[89A-F][0-9A-F]"
+_FAST_URL_RE = re.compile(
+    rf"""
+    ((?i:https?))://
+    ([A-Za-z0-9.\-]+(?::[0-9]+)?)
+    ((?:/(?:[A-Za-z0-9\-._~!$&'()*+,=:@/|]|{_PCT_HIGH})*)?)
+    (?:\?((?:[A-Za-z0-9\-._~+=&]|{_PCT_HIGH})+))?
+    (?:\#([A-Za-z0-9\-._~:/?\#\[\]@!$&'()*+,;=|%]+))?
+    """,
+    re.VERBOSE,
+)
+
+
+def _query_sort_key(pair: str) -> tuple[bytes, bytes]:
+    """和w3lib一样按解码后的字节排序，"+"解码为空格"""
+    name, value = pair.split("=")
+    if "%" in pair or "+" in pair:
+        return unquote_to_bytes(name.replace("+", " ")), unquote_to_bytes(value.replace("+", " "))
+    return name.encode(), value.encode()
+
+
+def _fast_canonicalize_url(url: str):
+    """常见的简单url直接标准化，不符合快速路径条件时返回None"""
+    match = _FAST_URL_RE.fullmatch(url)
+    if match is None:
+        return None
+    scheme, netloc, path, query, fragment = match.groups()
+    parts = [scheme.lower(), "://", netloc.lower(), path or "/"]
+    if query:
+        pairs = query.split("&")
+        # 空参数、没有值或值中含"="的参数会被w3lib改写，交给w3lib处理
+        if any(pair.count("=") != 1 for pair in pairs):
+            return None
+        if len(pairs) > 1:
+            pairs.sort(key=_query_sort_key)
+            query = "&".join(pairs)
+        parts += ["?", query]
+    if fragment:
+        parts += ["#", fragment]
+    return "".join(parts)
+
+
+def fast_canonicalize_url(url: str) -> str:
+    """
+    与``canonicalize_url(url, keep_fragments=True)``结果逐字节一致的快速实现。
+
+    纯ASCII且已经基本标准化的url只做一次正则匹配和query排序，其他情况交给w3lib处理。
+    """
+    return _fast_canonicalize_url(url) or canonicalize_url(url, keep_fragments=True)
+
+
+class UrlFingerprinter:
+    """
+    带LRU缓存的url标准化和指纹计算，同一个url在整个进程中只标准化一次。
+
+    进程内只有一个实例``url_fingerprinter``，多个crawler共享，缓存容量在创建时从项目设置``FINGERPRINT_CACHE_SIZE``读取。
+    ``computed``为实际标准化的次数，``saved``为命中缓存节省的次数。
+    """
+
+    def __init__(self, maxsize=100000) -> None:
+        self.maxsize = maxsize
+        self.entries: OrderedDict[str, tuple[str, int]] = OrderedDict()
+        self.computed = 0
+        self.saved = 0
+
+    def entry(self, url: str) -> tuple[str, int]:
+        """url标准化后的结果和指纹"""
+        entry = self.entries.get(url)
+        if entry is not None:
+            self.entries.move_to_end(url)
+            self.saved += 1
+            return entry
+        canonical = fast_canonicalize_url(url)
+        entry = self.entries[url] = (canonical, mmh3.hash128(canonical))
+        self.computed += 1
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return entry
+
+    def track(self, crawler):
+        """爬虫结束时把本次运行中标准化和节省的次数写入统计"""
+        computed, saved = self.computed, self.saved
+
+        def spider_closed(spider):
+            crawler.stats.set_value("fingerprint/canonicalize/computed", self.computed - computed, spider=spider)
+            crawler.stats.set_value("fingerprint/canonicalize/saved", self.saved - saved, spider=spider)
+
+        crawler.signals.connect(spider_closed, signal=signals.spider_closed, weak=False)
+
+    def canonical_url(self, url: str) -> str:
+        return self.entry(url)[0]
+
+    def fingerprint(self, url: str) -> int:
+        return self.entry(url)[1]
+
+
+url_fingerprinter = UrlFingerprinter(get_project_settings().getint("FINGERPRINT_CACHE_SIZE", 100000))
+
 
 def get_url_fp(url: str):
-    """对url标准化后进行hash计算，返回128位的hash值"""
-    return mmh3.hash128(canonicalize_url(url, keep_fragments=True))
+    """对url标准化后进行hash计算，返回128位的hash值，结果由url_fingerprinter缓存"""
+    return url_fingerprinter.fingerprint(url)
+
+
+def canonical_url(url: str) -> str:
+    """标准化url，保留fragment，结果由url_fingerprinter缓存"""
+    return url_fingerprinter.canonical_url(url)
+
+
+FP_ENCODINGS = ("decimal", "binary", "binary64")
+"""去重库成员的编码方式: 十进制字符串（默认）、16字节二进制、8字节二进制（取高64位，适合数据量小的key）"""
+
+FP_SIZES = {"decimal": 16, "binary": 16, "binary64": 8}
+"""各编码方式下指纹的字节数"""
+
+
+URL_FP_MIN = 1 << 64
+"""url指纹是128位hash，小于该值的整数视为游标、自增id，始终以十进制保存"""
+
+
+def is_url_fp(value) -> bool:
+    """是否为url指纹，运行时编码、预加载和迁移命令都按这个规则区分指纹与游标、自增id"""
+    return isinstance(value, int) and abs(value) >= URL_FP_MIN
+
+
+def fp_key(fp: int, encoding="decimal") -> int:
+    """指纹在该编码方式下保留的整数部分，64位模式只保留高64位"""
+    fp %= 1 << 128
+    return fp >> 64 if encoding == "binary64" else fp
+
+
+def encode_fp(fp, encoding="decimal"):
+    """把url指纹编码为redis去重库中的成员，游标、自增id等原样返回（按十进制保存）"""
+    if not is_url_fp(fp) or encoding == "decimal":
+        return fp
+    return fp_key(fp, encoding).to_bytes(FP_SIZES[encoding], "big")
+
+
+def is_encoded_fp(member: bytes, encoding: str) -> bool:
+    """成员是否为二进制编码的指纹，长度恰好相同的十进制游标、自增id按十进制处理"""
+    return encoding != "decimal" and len(member) == FP_SIZES[encoding] and not member.isdigit()
+
+
+def decode_fp(member: bytes, encoding="decimal"):
+    """把redis去重库中的url指纹成员解码为fp_key，兼容旧的十进制成员，游标、自增id等返回None"""
+    if is_encoded_fp(member, encoding):
+        return int.from_bytes(member, "big")
+    try:
+        fp = int(member)
+    except ValueError:
+        return None
+    return fp_key(fp, encoding) if is_url_fp(fp) else None
@@ -1,5 +1,6 @@
 # 异步重试装饰器
 import asyncio
+import random
 
 
 def async_retry(retry_times: int = 3, delay: int = 1):
@@ -15,4 +16,37 @@ def async_retry(retry_times: int = 3, delay: int = 1):
 
         return wrapped
 
-    return wrapper
\ No newline at end of file
+    return wrapper
+
+# 各类错误的退避基数（秒），键为异常类的完整路径或``http_状态码``，可通过RETRY_BACKOFF_BASE覆盖
+DEFAULT_BACKOFF_BASE = {
+    "default": 1,
+    "http_429": 10,
+    "http_503": 5,
+    "twisted.internet.error.TimeoutError": 3,
+    "twisted.internet.error.TCPTimedOutError": 3,
+    "scrapy.core.downloader.handlers.http11.TunnelError": 2,
+}
+
+
+def error_class(reason) -> str:
+    """重试原因对应的错误类别，异常取类的完整路径，响应状态取``http_状态码``"""
+    if isinstance(reason, BaseException):
+        return f"{type(reason).__module__}.{type(reason).__qualname__}"
+    if isinstance(reason, type) and issubclass(reason, BaseException):
+        return f"{reason.__module__}.{reason.__qualname__}"
+    code = str(reason).split(" ", 1)[0]
+    return f"http_{code}" if code.isdigit() else str(reason)
+
+
+def backoff_delay(reason, attempt: int, backoff_base: dict, max_delay: float = 300) -> float:
+    """
+    指数退避加随机抖动的重试延迟（秒）。
+
+    延迟为``基数 * 2^(attempt-1)``，不超过max_delay，实际取值在一半到全部之间随机，避免大量请求同时重试。
+    异常按继承链查找基数，都没有时使用``default``。
+    """
+    classes = [error_class(cls) for cls in type(reason).__mro__] if isinstance(reason, BaseException) else [error_class(reason)]
+    base = next((backoff_base[name] for name in classes if name in backoff_base), backoff_base.get("default", 1))
+    delay = min(base * 2 ** max(attempt - 1, 0), max_delay)
+    return delay / 2 + random.random() * delay / 2
@@ -0,0 +1,39 @@
+"""
+对比w3lib和快速路径标准化的耗时，直接运行: python tests/benchmark_canonicalize.py
+
+语料是tests/data/make_canonicalize_urls.py生成的合成url，结果只反映这些url形态下的相对耗时。
+"""
+
+import sys
+import timeit
+from pathlib import Path
+
+# 未安装scrapy_konne时直接运行也能导入
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from w3lib.url import canonicalize_url
+
+from scrapy_konne.utils.fingerprint import _fast_canonicalize_url, fast_canonicalize_url
+
+CORPUS = Path(__file__).parent / "data" / "canonicalize_urls.txt"
+
+
+def bench(name, func, urls, number=5):
+    seconds = min(timeit.repeat(lambda: [func(url) for url in urls], number=1, repeat=number))
+    print(f"{name:<24}{len(urls):>8}个url  {seconds / len(urls) * 1e6:8.2f}微秒/个")
+    return seconds
+
+
+def main():
+    urls = CORPUS.read_text(encoding="utf-8").splitlines()
+    fast_urls = [url for url in urls if _fast_canonicalize_url(url) is not None]
+    print(f"快速路径覆盖 {len(fast_urls)}/{len(urls)}")
+    for title, sample in (("全部语料", urls), ("快速路径语料", fast_urls)):
+        print(title)
+        base = bench("  w3lib", lambda url: canonicalize_url(url, keep_fragments=True), sample)
+        fast = bench("  fast_canonicalize_url", fast_canonicalize_url, sample)
+        print(f"  加速 {base / fast:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+"""
+在本地桩服务上测量konne去重查询的吞吐量，直接运行: python tests/benchmark_konne_filter.py
+"""
+
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+# 未安装scrapy_konne时直接运行也能导入
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from test_konne_filter import check_urls
+
+URLS = [f"https://news.example.com/{i}" for i in range(2000)]
+LATENCY = 0.01
+
+
+async def main():
+    print(f"{len(URLS)}个url，接口延迟{LATENCY * 1000:.0f}毫秒")
+    modes = [
+        ("逐个查询 并发1", {"concurrency": 1}),
+        ("逐个查询 并发16", {"concurrency": 16}),
+        ("逐个查询 并发64", {"concurrency": 64}),
+        ("批量接口 每批50", {"bulk": True, "batch_size": 50}),
+    ]
+    for name, kwargs in modes:
+        urls = URLS[:200] if kwargs.get("concurrency") == 1 else URLS
+        start = time.perf_counter()
+        _, state = await check_urls(urls, LATENCY, **kwargs)
+        elapsed = time.perf_counter() - start
+        print(f"{name:<16}{len(urls) / elapsed:10.0f}个/秒  接口请求{state.requests}次  最大并发{state.max_active}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,180 @@
+"""
+生成tests/data/canonicalize_urls.txt，直接运行: python tests/data/make_canonicalize_urls.py
+
+语料是合成的，不是真实抓取的url：按常见新闻、政务站点的url形态随机组合域名、路径、查询参数和fragment，
+并混入大写scheme和域名、中文和GBK编码、重复参数、空参数、``;``分隔、端口、用户信息等w3lib需要特殊处理的情况。
+随机种子固定，重复运行生成的文件不变。
+"""
+
+import random
+from pathlib import Path
+from urllib.parse import quote
+
+CORPUS = Path(__file__).parent / "canonicalize_urls.txt"
+rnd = random.Random(20241018)
+domains = [
+    "news.sina.com.cn",
+    "www.people.com.cn",
+    "politics.people.com.cn",
+    "www.xinhuanet.com",
+    "news.163.com",
+    "www.thepaper.cn",
+    "new.qq.com",
+    "www.chinanews.com.cn",
+    "m.weibo.cn",
+    "www.toutiao.com",
+    "baijiahao.baidu.com",
+    "www.gov.cn",
+    "gd.gov.cn",
+    "www.sohu.com",
+    "news.ifeng.com",
+    "www.zhihu.com",
+    "mp.weixin.qq.com",
+    "tieba.baidu.com",
+    "www.bjnews.com.cn",
+    "www.jiemian.com",
+    "static.cdn-news.cn:8080",
+    "bbs.tianya.cn",
+    "www.dahe.cn",
+    "xw.qq.com",
+]
+words = ["新闻", "政策", "北京", "疫情防控", "经济", "科技创新", "乡村振兴", "教育", "两会", "通知公告"]
+segs = ["c", "n1", "2024", "0518", "content", "article", "detail", "news", "a", "html", "doc", "list", "p", "s", "gov"]
+keys = ["id", "page", "aid", "tid", "from", "utm_source", "spm", "keyword", "q", "cat", "type", "t", "_", "sn", "ch"]
+
+
+def rid():
+    return str(rnd.randint(10**5, 10**12))
+
+
+def path():
+    kind = rnd.random()
+    parts = [rnd.choice(segs) for _ in range(rnd.randint(0, 4))]
+    if kind < 0.15:
+        parts.append(rnd.choice(words) if rnd.random() < 0.5 else quote(rnd.choice(words)))
+    elif kind < 0.2:
+        parts.append(quote(rnd.choice(words)).lower())
+    elif kind < 0.23:
+        parts.append(quote(rnd.choice(words), encoding="gbk"))
+    last = rnd.choice(
+        [
+            f"{rid()}.html",
+            f"doc-i{rid()}.shtml",
+            f"{rid()}",
+            "",
+            "index.htm",
+            f"t20240518_{rid()}.html",
+            f"{rid()}.html;jsessionid=ABC{rid()}",
+        ]
+    )
+    parts.append(last)
+    p = "/" + "/".join(parts)
+    r = rnd.random()
+    if r < 0.03:
+        p = p.replace("/", "//", 1)
+    elif r < 0.05:
+        p += " "
+    elif r < 0.07:
+        p = p.replace("-", "%2d")
+    elif r < 0.08:
+        p = ""
+    elif r < 0.09:
+        p += "%2Fx%3f"
+    elif r < 0.10:
+        p += "/./../a b"
+    return p
+
+
+def value(v):
+    """按随机数v选择参数值的形态"""
+    if v < 0.5:
+        return rid()
+    if v < 0.6:
+        return rnd.choice(words)
+    if v < 0.7:
+        return quote(rnd.choice(words))
+    if v < 0.73:
+        return quote(rnd.choice(words), encoding="gbk")
+    if v < 0.76:
+        return quote(rnd.choice(words)).lower()
+    if v < 0.8:
+        return ""
+    if v < 0.83:
+        return "a+b c"
+    if v < 0.85:
+        return "x=y"
+    if v < 0.87:
+        return "1.2.3~-_"
+    if v < 0.89:
+        return "%41%2B"
+    return rnd.choice(["news", "pc", "m", "wap", "share", "timeline"])
+
+
+def query():
+    r = rnd.random()
+    if r < 0.35:
+        return ""
+    pairs = []
+    for _ in range(rnd.randint(1, 6)):
+        k = rnd.choice(keys)
+        v = rnd.random()
+        val = value(v)
+        pairs.append(k if v > 0.985 else f"{k}={val}")
+    q = "&".join(pairs)
+    r = rnd.random()
+    if r < 0.05:
+        q = q.replace("&", ";", 1)
+    elif r < 0.08:
+        q += "&"
+    elif r < 0.1:
+        q = "&" + q
+    return "?" + q
+
+
+def fragment():
+    r = rnd.random()
+    if r < 0.6:
+        return ""
+    choices = [
+        "comment",
+        "p=2",
+        "/detail/" + rid(),
+        "",
+        "top",
+        rnd.choice(words),
+        quote(rnd.choice(words)),
+        "%e4%b8%ad",
+        "a b",
+        "section-1",
+        "!/share?x=1",
+        "#double",
+        "frag;x",
+    ]
+    return "#" + rnd.choice(choices)
+
+
+def main():
+    urls = set()
+    while len(urls) < 3000:
+        scheme = rnd.choice(["https", "https", "http", "HTTPS", "http"])
+        host = rnd.choice(domains)
+        r = rnd.random()
+        if r < 0.06:
+            host = host.upper()
+        elif r < 0.08:
+            host = "中文网.中国"
+        elif r < 0.09:
+            host = "user:pw@" + host
+        elif r < 0.1:
+            host += ":"
+        url = f"{scheme}://{host}{path()}{query()}{fragment()}"
+        if rnd.random() < 0.02:
+            url = " " + url + "\n"
+        urls.add(url)
+    with open(CORPUS, "w", encoding="utf-8") as f:
+        for url in sorted(urls):
+            f.write(url.strip() + "\n")
+
+
+if __name__ == "__main__":
+    main()
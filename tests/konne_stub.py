@@ -0,0 +1,70 @@
+"""
+konne去重接口的本地桩服务，用于离线测试和压测。
+
+单个查询: GET /BanKuaiQuChong/ExistUrl?url=...，返回"1"或"0"
+批量查询: POST /BanKuaiQuChong/ExistUrls，json ``{"urls": [...]}``，返回json数组
+以偶数数字结尾的url视为已存在。直接运行可以启动独立服务: python tests/konne_stub.py 8080
+"""
+
+import asyncio
+import sys
+
+from aiohttp import web
+
+
+def url_exists(url: str) -> bool:
+    return url[-1:] in "02468" and url[-1:] != ""
+
+
+class StubState:
+    def __init__(self, latency=0.0) -> None:
+        self.latency = latency
+        self.requests = 0
+        self.active = 0
+        self.max_active = 0
+
+    async def handle(self, coro):
+        self.requests += 1
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            return await coro
+        finally:
+            self.active -= 1
+
+
+def create_app(state: StubState) -> web.Application:
+    async def exist_url(request: web.Request):
+        async def respond():
+            return web.Response(text="1" if url_exists(request.query.get("url", "")) else "0")
+
+        return await state.handle(respond())
+
+    async def exist_urls(request: web.Request):
+        async def respond():
+            urls = (await request.json())["urls"]
+            return web.json_response([int(url_exists(url)) for url in urls])
+
+        return await state.handle(respond())
+
+    app = web.Application()
+    app.router.add_get("/BanKuaiQuChong/ExistUrl", exist_url)
+    app.router.add_post("/BanKuaiQuChong/ExistUrls", exist_urls)
+    return app
+
+
+async def start_stub(latency=0.0, port=0) -> tuple[web.AppRunner, str, StubState]:
+    """启动桩服务，返回(runner, 地址host:port, 状态)，port为0时随机选择端口"""
+    state = StubState(latency)
+    runner = web.AppRunner(create_app(state))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", port)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"{host}:{port}", state
+
+
+if __name__ == "__main__":
+    web.run_app(create_app(StubState()), host="127.0.0.1", port=int(sys.argv[1]) if len(sys.argv) > 1 else 8080)
@@ -0,0 +1,148 @@
+import asyncio
+
+import fakeredis
+import pytest
+from scrapy import Spider
+from scrapy.utils.test import get_crawler
+
+from scrapy_konne.utils.cache import FingerprintCache, MicroBatcher
+from scrapy_konne.utils.fingerprint import encode_fp, get_url_fp
+
+KEY = "dupefilter:t"
+FPS = [get_url_fp(f"https://a.com/{i}") for i in range(10)]
+
+
+class TSpider(Spider):
+    name = "t"
+
+
+def make_cache(**kwargs):
+    crawler = get_crawler(TSpider)
+    crawler.spider = TSpider.from_crawler(crawler)
+    crawler.stats.open_spider(crawler.spider)
+    crawler.redis_client = fakeredis.aioredis.FakeRedis()
+    return FingerprintCache(crawler, KEY, **kwargs)
+
+
+def stat(cache, name):
+    return cache.crawler.stats.get_value(name, 0)
+
+
+def test_micro_batcher_shares_queries_within_window():
+    async def main():
+        batches = []
+
+        async def resolver(queries):
+            batches.append(queries)
+            return [query * 2 for query in queries]
+
+        batcher = MicroBatcher(resolver, window=0.01, batch_size=100)
+        results = await asyncio.gather(*(batcher.submit(i % 3) for i in range(9)))
+        assert results == [i % 3 * 2 for i in range(9)]
+        assert batches == [[0, 1, 2]]
+
+    asyncio.run(main())
+
+
+def test_micro_batcher_unshared_keeps_order_and_splits_full_batches():
+    async def main():
+        batches = []
+
+        async def resolver(queries):
+            batches.append(queries)
+            return list(range(len(queries)))
+
+        batcher = MicroBatcher(resolver, window=10, batch_size=3, share=False)
+        futures = [batcher.submit("a") for _ in range(6)]
+        # 攒够batch_size时立即发送，不等待窗口
+        assert await asyncio.gather(*futures) == [0, 1, 2, 0, 1, 2]
+        assert batches == [["a"] * 3, ["a"] * 3]
+
+    asyncio.run(main())
+
+
+def test_micro_batcher_passes_errors_to_every_caller():
+    async def main():
+        async def resolver(queries):
+            raise ConnectionError("down")
+
+        batcher = MicroBatcher(resolver, window=0.001)
+        futures = [batcher.submit(i) for i in range(3)]
+        for future in futures:
+            with pytest.raises(ConnectionError):
+                await future
+
+    asyncio.run(main())
+
+
+def test_cache_evicts_least_recently_used():
+    cache = make_cache(size=3)
+    for fp in FPS[:3]:
+        cache.set_present(fp)
+    # 命中的指纹移到最新，之后写入的指纹淘汰最久未使用的
+    assert cache.get(FPS[0]) is True
+    cache.set_present(FPS[3])
+    assert cache.get(FPS[1]) is None
+    assert all(cache.get(fp) is True for fp in (FPS[0], FPS[2], FPS[3]))
+    assert stat(cache, "dupefilter/cache/hit") == 4
+    assert stat(cache, "dupefilter/cache/miss") == 1
+
+
+def test_negative_cache_expires():
+    async def main():
+        cache = make_cache(negative_ttl=0.2)
+        assert await cache.exists(FPS[0]) is False
+        # 其他worker写入后，负缓存过期前仍判断为不存在
+        await cache.crawler.redis_client.zadd(KEY, {cache.member(FPS[0]): 1})
+        assert await cache.exists(FPS[0]) is False
+        assert stat(cache, "dupefilter/cache/negative_hit") == 1
+        await asyncio.sleep(0.25)
+        assert await cache.exists(FPS[0]) is True
+        assert stat(cache, "dupefilter/redis/batches") == 2
+
+    asyncio.run(main())
+
+
+def test_set_present_invalidates_cached_miss():
+    async def main():
+        cache = make_cache(negative_ttl=60)
+        assert await cache.exists(FPS[0]) is False
+        cache.set_present(FPS[0])
+        assert FPS[0] not in cache.missing
+        assert await cache.exists(FPS[0]) is True
+        assert stat(cache, "dupefilter/redis/batches") == 1
+
+    asyncio.run(main())
+
+
+def test_concurrent_lookups_share_one_zmscore():
+    async def main():
+        cache = make_cache(batch_window=0.01, encoding="binary64")
+        client = cache.crawler.redis_client
+        # 新编码的成员和迁移前的十进制成员都能查到
+        await client.zadd(KEY, {encode_fp(FPS[0], "binary64"): 1, FPS[1]: 1})
+        calls = []
+        zmscore = client.zmscore
+
+        async def counting_zmscore(key, members):
+            calls.append(members)
+            return await zmscore(key, members)
+
+        client.zmscore = counting_zmscore
+        results = await asyncio.gather(*(cache.exists(fp) for fp in FPS + FPS[:5]))
+        assert results == [True, True] + [False] * 8 + [True, True] + [False] * 3
+        assert len(calls) == 1
+        # 每个指纹查询新编码和十进制两个成员，重复的查询共享结果
+        assert len(calls[0]) == 2 * len(FPS)
+        assert stat(cache, "dupefilter/redis/batches") == 1
+
+    asyncio.run(main())
+
+
+def test_score_batcher_splits_full_batches():
+    async def main():
+        cache = make_cache(batch_window=10, batch_size=4)
+        assert not any(await asyncio.gather(*(cache.exists(fp) for fp in FPS[:8])))
+        assert stat(cache, "dupefilter/redis/batches") == 2
+
+    asyncio.run(main())
@@ -0,0 +1,102 @@
+import asyncio
+
+import fakeredis
+import pytest
+from scrapy import Request, Spider
+from scrapy.utils.test import get_crawler
+
+from scrapy_konne.middlewares import coordination
+from scrapy_konne.middlewares.coordination import SeederLockMiddleware
+
+SEEDER_KEY = "request_queue:t:seeder"
+SEEDED_KEY = "request_queue:t:seeded"
+
+
+class TSpider(Spider):
+    name = "t"
+
+
+@pytest.fixture
+def server(monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(
+        coordination.Redis, "from_url", classmethod(lambda cls, url, **kwargs: fakeredis.FakeRedis(server=server))
+    )
+    return server
+
+
+def make_worker(server, lock_ttl=30):
+    crawler = get_crawler(
+        TSpider,
+        {"SCHEDULER_COORDINATED": True, "REDIS_URL": "redis://localhost", "SCHEDULER_SEEDER_LOCK_TTL": lock_ttl},
+    )
+    crawler.spider = TSpider.from_crawler(crawler)
+    crawler.redis_client = fakeredis.aioredis.FakeRedis(server=server)
+    return SeederLockMiddleware.from_crawler(crawler)
+
+
+def seeds(count=3):
+    return (Request(f"https://a.com/{i}") for i in range(count))
+
+
+def test_second_worker_skips_seeding_while_locked(server):
+    async def main():
+        first, second = make_worker(server), make_worker(server)
+        spider = first.crawler.spider
+        seeding = first.process_start_requests(seeds(), spider)
+        assert next(seeding).url == "https://a.com/0"
+        assert list(second.process_start_requests(seeds(), spider)) == []
+        assert len(list(seeding)) == 2
+        await asyncio.sleep(0.05)
+        # 写入完毕后留下标记，之后启动的worker同样跳过
+        client = fakeredis.FakeRedis(server=server)
+        assert client.get(SEEDED_KEY) == first.token.encode()
+        assert 0 < client.pttl(SEEDER_KEY) <= SeederLockMiddleware.RELEASE_GRACE_MS
+        assert list(make_worker(server).process_start_requests(seeds(), spider)) == []
+
+    asyncio.run(main())
+
+
+def test_lock_renewed_while_seeding(server):
+    async def main():
+        worker = make_worker(server, lock_ttl=0.3)
+        seeding = worker.process_start_requests(seeds(), worker.crawler.spider)
+        next(seeding)
+        # 引擎暂停消费start_requests的时间超过锁时长，锁仍然有效
+        await asyncio.sleep(0.8)
+        client = fakeredis.FakeRedis(server=server)
+        assert client.get(SEEDER_KEY) == worker.token.encode()
+        assert 0 < client.pttl(SEEDER_KEY) <= 300
+        assert list(make_worker(server).process_start_requests(seeds(), worker.crawler.spider)) == []
+        seeding.close()
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize("reason, seeded_kept", [("finished", False), ("shutdown", True)])
+def test_spider_closed_releases_lock_and_marker(server, reason, seeded_kept):
+    async def main():
+        worker = make_worker(server)
+        spider = worker.crawler.spider
+        assert len(list(worker.process_start_requests(seeds(), spider))) == 3
+        await asyncio.sleep(0.05)
+        worker.spider_closed(spider, reason)
+        client = fakeredis.FakeRedis(server=server)
+        assert not client.exists(SEEDER_KEY)
+        assert bool(client.exists(SEEDED_KEY)) is seeded_kept
+
+    asyncio.run(main())
+
+
+def test_spider_closed_keeps_lock_of_other_worker(server):
+    async def main():
+        seeder, consumer = make_worker(server), make_worker(server)
+        spider = seeder.crawler.spider
+        seeding = seeder.process_start_requests(seeds(), spider)
+        next(seeding)
+        assert list(consumer.process_start_requests(seeds(), spider)) == []
+        consumer.spider_closed(spider, "shutdown")
+        assert fakeredis.FakeRedis(server=server).get(SEEDER_KEY) == seeder.token.encode()
+        seeding.close()
+
+    asyncio.run(main())
@@ -0,0 +1,159 @@
+import asyncio
+import math
+
+import fakeredis
+import pytest
+from scrapy import Request, Spider
+from scrapy.utils.test import get_crawler
+
+from scrapy_konne.core.dupefilter import RedisBloomDupeFilter
+from scrapy_konne.core.scheduler import RedisScheduler
+from scrapy_konne.http import KRequest
+from scrapy_konne.middlewares.dupefilter import UrlRedisBatchDupefilterSpiderMiddleware
+from scrapy_konne.utils.fingerprint import get_url_fp
+
+
+class TSpider(Spider):
+    name = "t"
+
+
+def make_bloom(settings=None):
+    crawler = get_crawler(TSpider, {"REDIS_URL": "redis://localhost", **(settings or {})})
+    crawler.spider = TSpider.from_crawler(crawler)
+    crawler.stats.open_spider(crawler.spider)
+    server = fakeredis.FakeServer()
+    crawler.redis_client = fakeredis.aioredis.FakeRedis(server=server)
+    bloom = RedisBloomDupeFilter.from_crawler(crawler)
+    bloom.open()
+    bloom.client = fakeredis.FakeRedis(server=server)
+    return bloom
+
+
+class RecordingQueue:
+    def __init__(self):
+        self.pushed = []
+
+    def __len__(self):
+        return len(self.pushed)
+
+    def ack(self, request):
+        pass
+
+    def push(self, request):
+        self.pushed.append(request)
+
+
+def make_scheduler(bloom):
+    scheduler = RedisScheduler(bloom, stats=bloom.crawler.stats, crawler=bloom.crawler)
+    scheduler.spider = bloom.crawler.spider
+    scheduler.redis_mq = RecordingQueue()
+    return scheduler
+
+
+@pytest.mark.parametrize(
+    "expected_items, error_rate", [(1000, 0.01), (10_000_000, 0.0001), (2_000_000_000, 0.001)]
+)
+def test_bloom_sizing(expected_items, error_rate):
+    bloom = make_bloom({"BLOOM_EXPECTED_ITEMS": expected_items, "BLOOM_ERROR_RATE": error_rate})
+    bits = math.ceil(-expected_items * math.log(error_rate) / math.log(2) ** 2)
+    assert bloom.hash_count == round(bits / expected_items * math.log(2))
+    assert bloom.block_bits <= RedisBloomDupeFilter.MAX_BLOCK_BITS
+    assert bits <= bloom.block_bits * bloom.block_count < bits + bloom.block_count
+    assert len(bloom.block_keys()) == bloom.block_count
+
+
+def test_bloom_request_seen():
+    bloom = make_bloom({"BLOOM_EXPECTED_ITEMS": 1000, "BLOOM_ERROR_RATE": 0.001})
+    requests = [Request(f"https://a.com/{i}") for i in range(200)]
+    assert not any(bloom.request_seen(r) for r in requests)
+    assert all(bloom.request_seen(r) for r in requests)
+
+
+def test_bloom_async_request_seen_batched():
+    async def main():
+        bloom = make_bloom({"BLOOM_EXPECTED_ITEMS": 1000, "BLOOM_ERROR_RATE": 0.001, "BLOOM_BATCH_WINDOW": 0.01})
+        requests = [Request(f"https://a.com/{i}") for i in range(50)]
+        # 同一批次中重复的请求能看到前一个设置的位
+        seen = await asyncio.gather(*(bloom.async_request_seen(r) for r in requests + requests[:10]))
+        assert seen == [False] * 50 + [True] * 10
+        assert bloom.crawler.stats.get_value("dupefilter/bloom/batches") == 1
+        # 同步和异步接口共享同一个位图
+        assert all(bloom.request_seen(r) for r in requests)
+        assert not bloom.request_seen(Request("https://a.com/new"))
+
+    asyncio.run(main())
+
+
+def test_bloom_batch_size_splits_batches():
+    async def main():
+        bloom = make_bloom({"BLOOM_EXPECTED_ITEMS": 1000, "BLOOM_BATCH_WINDOW": 10, "BLOOM_BATCH_SIZE": 20})
+        seen = await asyncio.gather(*(bloom.async_request_seen(Request(f"https://a.com/{i}")) for i in range(60)))
+        assert not any(seen)
+        assert bloom.crawler.stats.get_value("dupefilter/bloom/batches") == 3
+
+    asyncio.run(main())
+
+
+def test_scheduler_drops_seen_and_bypasses_dont_filter():
+    async def main():
+        bloom = make_bloom({"BLOOM_EXPECTED_ITEMS": 1000})
+        scheduler = make_scheduler(bloom)
+        first, again = Request("https://a.com/1"), Request("https://a.com/1")
+        forced = Request("https://a.com/1", dont_filter=True)
+        for request in (first, again, forced):
+            assert scheduler.enqueue_request(request)
+        # dont_filter的请求不经过过滤器，直接入队
+        assert scheduler.redis_mq.pushed == [forced]
+        assert len(scheduler) == 3
+        await asyncio.gather(*scheduler.checking)
+        assert scheduler.redis_mq.pushed == [forced, first]
+        assert bloom.crawler.stats.get_value("dupefilter/filtered") == 1
+
+    asyncio.run(main())
+
+
+def test_bloom_cleared_on_finish_unless_persist():
+    bloom = make_bloom({"BLOOM_EXPECTED_ITEMS": 1000})
+    client = bloom.client
+    bloom.request_seen(Request("https://a.com/1"))
+    bloom.close("shutdown")
+    assert client.exists(bloom.key)
+    bloom.close("finished")
+    assert not client.exists(bloom.key)
+    persist = make_bloom({"BLOOM_EXPECTED_ITEMS": 1000, "SCHEDULER_COORDINATED": True})
+    persist.request_seen(Request("https://a.com/1"))
+    client = persist.client
+    persist.close("finished")
+    assert client.exists(persist.key)
+
+
+def test_batch_spider_middleware_drops_seen_requests():
+    async def main():
+        crawler = get_crawler(TSpider, {"DEDUP_RESPONSE_BATCH_SIZE": 3})
+        crawler.spider = TSpider.from_crawler(crawler)
+        crawler.stats.open_spider(crawler.spider)
+        crawler.redis_client = fakeredis.aioredis.FakeRedis()
+        await crawler.redis_client.zadd(
+            "dupefilter:t", {get_url_fp("https://a.com/seen"): 1, get_url_fp("https://a.com/filter"): 1, 42: 1}
+        )
+        middleware = UrlRedisBatchDupefilterSpiderMiddleware.from_crawler(crawler)
+        outputs = [
+            Request("https://a.com/seen"),
+            {"title": "item"},
+            Request("https://a.com/new"),
+            KRequest("https://a.com/other", filter_url="https://a.com/filter"),
+            Request("https://a.com/seen", dont_filter=True),
+            Request("https://a.com/cursor", meta={"cursor": 42}),
+            Request("https://a.com/new2"),
+        ]
+
+        async def result():
+            for output in outputs:
+                yield output
+
+        passed = [r async for r in middleware.process_spider_output(None, result(), crawler.spider)]
+        # item直接产出，前三个请求攒满一批后查询，剩余的请求在结果结束时查询
+        assert passed == [outputs[1], outputs[2], outputs[4], outputs[6]]
+        assert crawler.stats.get_value("dupefilter/redis") == 3
+
+    asyncio.run(main())
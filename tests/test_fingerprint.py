@@ -0,0 +1,172 @@
+import asyncio
+import random
+from pathlib import Path
+
+import fakeredis
+import pytest
+from scrapy import Request, Spider, signals
+from scrapy.utils.test import get_crawler
+from w3lib.url import canonicalize_url
+
+from scrapy_konne.commands.dupmigrate import migrate_key
+from scrapy_konne.middlewares.dupefilter import UrlRedisDupefilterMiddleware
+from scrapy_konne.utils.cache import SortedFingerprints
+from scrapy_konne.utils.fingerprint import (
+    FP_ENCODINGS,
+    FP_SIZES,
+    UrlFingerprinter,
+    _fast_canonicalize_url,
+    decode_fp,
+    encode_fp,
+    fast_canonicalize_url,
+    fp_key,
+    get_url_fp,
+)
+
+# 合成语料，由tests/data/make_canonicalize_urls.py生成，不是真实抓取的url
+CORPUS = Path(__file__).parent / "data" / "canonicalize_urls.txt"
+
+
+def load_corpus():
+    return CORPUS.read_text(encoding="utf-8").splitlines()
+
+
+@pytest.mark.parametrize("url", load_corpus())
+def test_corpus_identical_to_w3lib(url):
+    assert fast_canonicalize_url(url) == canonicalize_url(url, keep_fragments=True)
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        "https://news.sina.com.cn/c/2024-05-18/doc-inaxyz1234567.shtml",
+        "http://www.people.com.cn/n1/2024/0518/c1001-40238417.html?from=timeline&id=1",
+        "https://www.gov.cn/zhengce/%E9%80%9A%E7%9F%A5.htm#comment",
+        "HTTPS://News.163.com/24/0518/10/J2ABCDEF.html?spm=a&aid=2+3",
+    ],
+)
+def test_fast_path_taken(url):
+    assert _fast_canonicalize_url(url) == canonicalize_url(url, keep_fragments=True)
+
+
+def outcome(canonicalize, url):
+    """标准化结果，出错时返回异常类型"""
+    try:
+        return canonicalize(url)
+    except ValueError as e:
+        return type(e)
+
+
+def test_random_urls_identical_to_w3lib():
+    rnd = random.Random(0)
+    alphabet = "aZ09-._~!$&'()*+,;=:@/?#[]|% \t%2f%2F%e4%E4%41中文\\^`{}\"<>"
+    for _ in range(20000):
+        tail = "".join(rnd.choice(alphabet) for _ in range(rnd.randint(0, 20)))
+        url = rnd.choice(["http://a.com/", "https://A.com:8080/x", "http://a.com", "HTTP://b.cn/p?"]) + tail
+        expected = outcome(lambda url: canonicalize_url(url, keep_fragments=True), url)
+        assert outcome(fast_canonicalize_url, url) == expected, url
+
+
+URL_FPS = [get_url_fp(f"https://a.com/{i}") for i in range(50)]
+
+
+@pytest.mark.parametrize("encoding", FP_ENCODINGS)
+def test_encode_decode_round_trip(encoding):
+    for fp in URL_FPS:
+        member = encode_fp(fp, encoding)
+        stored = str(member).encode() if encoding == "decimal" else member
+        assert decode_fp(stored, encoding) == fp_key(fp, encoding)
+        # 迁移前的十进制成员也能解码
+        assert decode_fp(str(fp).encode(), encoding) == fp_key(fp, encoding)
+
+
+@pytest.mark.parametrize("encoding", FP_ENCODINGS)
+def test_cursors_stay_decimal(encoding):
+    cursors = [0, 1, 12345, 99999, (1 << 64) - 1]
+    assert [encode_fp(cursor, encoding) for cursor in cursors] == cursors
+    assert encode_fp("cursor-1", encoding) == "cursor-1"
+    # 长度恰好等于二进制指纹的十进制游标也不会被当作指纹
+    for cursor in [*cursors, 12345678, 1234567890123456]:
+        assert decode_fp(str(cursor).encode(), encoding) is None
+    assert decode_fp(b"cursor-12", encoding) is None
+
+
+def test_binary64_keeps_high_bits():
+    fp = URL_FPS[0]
+    assert len(encode_fp(fp, "binary64")) == FP_SIZES["binary64"]
+    assert decode_fp(encode_fp(fp, "binary64"), "binary64") == fp >> 64
+
+
+@pytest.mark.parametrize("encoding", FP_ENCODINGS[1:])
+def test_migrate_key(encoding):
+    client = fakeredis.FakeRedis()
+    key = "dupefilter:t"
+    client.zadd(key, {fp: 1000 + i for i, fp in enumerate(URL_FPS)})
+    client.zadd(key, {12345: 1, 1234567890123456: 1, "cursor-1": 2})
+    # 已经按新编码写入的指纹保留较早的分数
+    client.zadd(key, {encode_fp(URL_FPS[0], encoding): 1})
+    scanned, migrated = migrate_key(client, key, encoding, batch_size=7)
+    # 改写后的成员可能在同一次ZSCAN中再次被扫描到
+    assert scanned >= len(URL_FPS) + 4
+    assert migrated == len(URL_FPS)
+    assert client.zcard(key) == len(URL_FPS) + 3
+    assert client.zscore(key, encode_fp(URL_FPS[0], encoding)) == 1
+    assert client.zscore(key, encode_fp(URL_FPS[1], encoding)) == 1001
+    assert client.zscore(key, str(URL_FPS[1])) is None
+    assert client.zscore(key, 12345) == 1 and client.zscore(key, 1234567890123456) == 1
+    assert client.zscore(key, "cursor-1") == 2
+    # 再次迁移不会改写任何成员
+    assert migrate_key(client, key, encoding, batch_size=7)[1] == 0
+
+
+def test_sorted_fingerprints_preload_skips_cursors():
+    async def main():
+        client = fakeredis.aioredis.FakeRedis()
+        key = "dupefilter:t"
+        await client.zadd(key, {encode_fp(fp, "binary64"): 1000 for fp in URL_FPS})
+        await client.zadd(key, {1: 1000, 12345678: 1000, "cursor-12": 1000})
+        loaded = await SortedFingerprints.load(client, key, 0, chunk_size=7, encoding="binary64")
+        assert len(loaded) == len(URL_FPS)
+        assert all(fp_key(fp, "binary64") in loaded for fp in URL_FPS)
+        assert 0 not in loaded
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize("encoding", FP_ENCODINGS)
+def test_deprecated_middleware_reads_encoded_and_decimal_members(encoding):
+    async def main():
+        server = fakeredis.FakeServer()
+        crawler = get_crawler(Spider, {"DUPEFILTER_FP_ENCODING": encoding})
+        crawler.spider = crawler._create_spider("t")
+        crawler.redis_client = fakeredis.aioredis.FakeRedis(server=server)
+        crawler.sync_redis_client = fakeredis.FakeRedis(server=server)
+        with pytest.warns(DeprecationWarning):
+            middleware = UrlRedisDupefilterMiddleware.from_crawler(crawler)
+        encoded, legacy, missing = (f"https://a.com/{i}" for i in range(3))
+        await crawler.redis_client.zadd(
+            "dupefilter:t", {encode_fp(get_url_fp(encoded), encoding): 1, get_url_fp(legacy): 1}
+        )
+        for url, expected in ((encoded, encoded), (legacy, legacy), (missing, None)):
+            request = Request(url, meta={"filter_url": url})
+            assert await middleware.is_dup_request(request) == expected
+            assert middleware.is_dup_request_sync(request) == expected
+
+    asyncio.run(main())
+
+
+def test_fingerprinter_stats_per_crawler():
+    fingerprinter = UrlFingerprinter(maxsize=2)
+    fingerprinter.fingerprint("https://a.com/before")
+    crawler = get_crawler(Spider, {"FINGERPRINT_CACHE_SIZE": 10})
+    spider = crawler._create_spider("t")
+    crawler.stats.open_spider(spider)
+    fingerprinter.track(crawler)
+    for url in ("https://a.com/1", "https://a.com/2", "https://a.com/1", "https://a.com/1", "https://a.com/3"):
+        fingerprinter.fingerprint(url)
+    crawler.signals.send_catch_log(signals.spider_closed, spider=spider, reason="finished")
+    # 只统计track之后的次数，容量不受crawler设置影响
+    assert crawler.stats.get_value("fingerprint/canonicalize/computed") == 3
+    assert crawler.stats.get_value("fingerprint/canonicalize/saved") == 2
+    assert fingerprinter.maxsize == 2
+    assert list(fingerprinter.entries) == ["https://a.com/1", "https://a.com/3"]
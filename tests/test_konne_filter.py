@@ -0,0 +1,136 @@
+import asyncio
+
+import fakeredis
+import pytest
+from scrapy import Spider
+from scrapy.utils.test import get_crawler
+
+from scrapy_konne.exceptions import RedisDuplicateItem, RemoteDuplicateItem
+from scrapy_konne.items import DetailDataItem
+from scrapy_konne.pipelines.filter import KonneTerritoryFilterPipeline
+from scrapy_konne.utils.fingerprint import get_url_fp
+from konne_stub import start_stub, url_exists
+
+URLS = [f"https://news.example.com/{i}" for i in range(120)]
+
+
+async def check_urls(urls, latency=0.005, bulk=False, **kwargs):
+    """在桩服务上查询urls，返回(结果, 桩服务状态)"""
+    runner, address, state = await start_stub(latency)
+    pipeline = KonneTerritoryFilterPipeline(**kwargs)
+    pipeline.crawler = get_crawler()
+    pipeline.crawler.stats.open_spider(None)
+    pipeline.uri_deduplication_api = f"http://{address}/BanKuaiQuChong/ExistUrl"
+    if bulk:
+        pipeline.bulk_api = f"http://{address}/BanKuaiQuChong/ExistUrls"
+    pipeline.session = pipeline.create_session()
+    try:
+        results = await asyncio.gather(*(pipeline.remote_exist(url) for url in urls))
+    finally:
+        await pipeline.session.close()
+        await runner.cleanup()
+    return results, state
+
+
+def test_fanout_concurrency_bounded():
+    results, state = asyncio.run(check_urls(URLS, concurrency=4))
+    assert results == [url_exists(url) for url in URLS]
+    assert state.requests == len(URLS)
+    assert state.max_active <= 4
+
+
+def test_bulk_requests_batched():
+    results, state = asyncio.run(check_urls(URLS, bulk=True, concurrency=4, batch_size=50))
+    assert results == [url_exists(url) for url in URLS]
+    assert state.requests == 3
+
+
+class TSpider(Spider):
+    name = "t"
+
+
+async def open_pipeline(address, **kwargs):
+    """在桩服务上打开使用fakeredis的pipeline"""
+    crawler = get_crawler(TSpider)
+    spider = crawler.spider = TSpider.from_crawler(crawler)
+    crawler.stats.open_spider(spider)
+    crawler.redis_client = fakeredis.aioredis.FakeRedis()
+    pipeline = KonneTerritoryFilterPipeline(**kwargs)
+    pipeline.uri_deduplication_api = f"http://{address}/BanKuaiQuChong/ExistUrl"
+    await pipeline.spider_opened(spider)
+    return pipeline
+
+
+async def process(pipeline, url):
+    """返回item通过或被哪一级去重"""
+    try:
+        await pipeline.process_item(DetailDataItem(source_url=url), pipeline.crawler.spider)
+    except RedisDuplicateItem:
+        return "redis"
+    except RemoteDuplicateItem:
+        return "remote"
+    return "passed"
+
+
+@pytest.fixture
+def stub():
+    def run(test, **kwargs):
+        async def main():
+            runner, address, state = await start_stub()
+            pipeline = await open_pipeline(address, **kwargs)
+            try:
+                await test(pipeline, state)
+            finally:
+                await pipeline.spider_closed(pipeline.crawler.spider)
+                await runner.cleanup()
+
+        asyncio.run(main())
+
+    return run
+
+
+def test_process_item_tier_order(stub):
+    async def test(pipeline, state):
+        stats = pipeline.crawler.stats
+        await pipeline.redis_client.zadd(pipeline.redis_key, {get_url_fp("https://a.com/in-redis"): 1})
+        # redis中已存在时不请求接口
+        assert await process(pipeline, "https://a.com/in-redis") == "redis"
+        assert state.requests == 0
+        # 接口返回存在的url写回redis，之后在本地缓存命中
+        assert await process(pipeline, "https://a.com/2") == "remote"
+        assert state.requests == 1
+        assert await pipeline.redis_client.zscore(pipeline.redis_key, get_url_fp("https://a.com/2"))
+        batches = stats.get_value("dupefilter/redis/batches")
+        assert await process(pipeline, "https://a.com/2") == "redis"
+        assert stats.get_value("dupefilter/redis/batches") == batches
+        assert stats.get_value("dupefilter/cache/hit") == 1
+        assert await process(pipeline, "https://a.com/1") == "passed"
+        assert state.requests == 2
+        assert stats.get_value("dupefilter/konne/exist") == 1
+
+    stub(test)
+
+
+def test_process_item_shares_inflight_lookups(stub):
+    async def test(pipeline, state):
+        missing = await asyncio.gather(*(process(pipeline, "https://a.com/1") for _ in range(10)))
+        existing = await asyncio.gather(*(process(pipeline, "https://a.com/2") for _ in range(10)))
+        assert missing == ["passed"] * 10
+        assert existing == ["remote"] * 10
+        assert state.requests == 2
+        assert not pipeline.inflight
+
+    stub(test)
+
+
+def test_process_item_negative_ttl_expires(stub):
+    async def test(pipeline, state):
+        assert await process(pipeline, "https://a.com/1") == "passed"
+        assert await process(pipeline, "https://a.com/1") == "passed"
+        assert state.requests == 1
+        assert pipeline.crawler.stats.get_value("dupefilter/konne/negative_hit") == 1
+        await asyncio.sleep(0.25)
+        assert await process(pipeline, "https://a.com/1") == "passed"
+        assert state.requests == 2
+
+    stub(test, negative_ttl=0.2)
@@ -0,0 +1,386 @@
+import asyncio
+import os
+import random
+import time
+from types import SimpleNamespace
+from urllib.parse import urlparse
+
+import fakeredis
+from scrapy import Spider
+from scrapy.http import HtmlResponse
+from scrapy.utils.test import get_crawler
+
+from scrapy_konne.core.mq import DiskSpillQueue, PriorityScoreMixin, RedisQueue, ShardedRedisQueue
+from scrapy_konne.core.serializer import MsgpackSerializer
+from scrapy_konne.http import KRequest
+from scrapy_konne.middlewares.mqack import AckSignalMiddleware
+from scrapy_konne.middlewares.retry import DelayedRetryMiddleware, delay_request
+
+KEY = "request_queue:t"
+BAND_WIDTH = PriorityScoreMixin.BAND_WIDTH
+
+
+class TSpider(Spider):
+    name = "t"
+
+
+def make_queue(queue_cls=RedisQueue, redis_client=None, **kwargs):
+    spider = TSpider()
+    crawler = get_crawler(TSpider)
+    crawler.spider = spider
+    spider.crawler = crawler
+    crawler.stats.open_spider(spider)
+    crawler.redis_client = redis_client or fakeredis.aioredis.FakeRedis()
+    # 分片队列按域名划分下载slot
+    crawler.engine = SimpleNamespace(
+        downloader=SimpleNamespace(slots={}, _get_slot_key=lambda request, spider: urlparse(request.url).hostname)
+    )
+    return queue_cls(crawler, KEY, serializer=MsgpackSerializer(spider), **kwargs)
+
+
+def request(url, priority=0, ready_at=None):
+    meta = {} if ready_at is None else {"mq_ready_at": ready_at}
+    return KRequest(url, priority=priority, meta=meta)
+
+
+async def pop_all(queue):
+    """拉取并取出队列中所有已就绪的请求"""
+    popped = []
+    while True:
+        await queue.fetch()
+        result = queue.pop()
+        if result is None:
+            return popped
+        popped.append(result)
+
+
+def test_push_buffered_until_flush():
+    async def main():
+        queue = make_queue(batch_size=100)
+        for i in range(3):
+            queue.push(request(f"https://a.com/{i}"))
+        assert queue.send_count == 3
+        assert await queue.redis_client.zcard(KEY) == 0
+        await queue.flush()
+        assert queue.send_count == 0
+        assert await queue.redis_client.zcard(KEY) == 3
+
+    asyncio.run(main())
+
+
+def test_push_flushes_when_batch_full():
+    async def main():
+        queue = make_queue(batch_size=2)
+        queue.push(request("https://a.com/1"))
+        queue.push(request("https://a.com/2"))
+        await queue._flush_task
+        assert await queue.redis_client.zcard(KEY) == 2
+        assert [r.url for r in await pop_all(queue)] == ["https://a.com/1", "https://a.com/2"]
+
+    asyncio.run(main())
+
+
+def test_give_back_on_close():
+    async def main():
+        queue = make_queue(prefetch=5)
+        redis = queue.redis_client
+        for i in range(8):
+            queue.push(request(f"https://a.com/{i}", priority=i % 3))
+        await queue.flush()
+        original = await redis.zrange(KEY, 0, -1, withscores=True)
+        await queue.fetch()
+        assert queue.pop() is not None
+        assert await redis.zcard(KEY) == 3
+        await queue.close()
+        # 预取未消费和处理中未ack的请求都按原分数归还
+        assert await redis.zrange(KEY, 0, -1, withscores=True) == original
+        assert await redis.zcard(f"{KEY}:lease") == 0
+        assert not queue.leases and not queue.recevie_buffer
+
+    asyncio.run(main())
+
+
+def test_prefetch_miss_not_counted_while_idle():
+    async def main():
+        queue = make_queue(prefetch=2)
+        stats = queue.crawler.stats
+        await queue.sync_size()
+        # 队列为空时的轮询不算未命中
+        for _ in range(5):
+            assert queue.pop() is None
+            await queue._fetch_task
+        assert stats.get_value("scheduler/prefetch/miss") is None
+        for i in range(3):
+            queue.push(request(f"https://a.com/{i}"))
+        await queue.flush()
+        # 缓冲区为空而redis中还有请求，拉取进行中的重复轮询只计一次
+        assert queue.pop() is None
+        assert queue.pop() is None
+        await queue._fetch_task
+        assert stats.get_value("scheduler/prefetch/miss") == 1
+        assert queue.pop() is not None and queue.pop() is not None
+        assert stats.get_value("scheduler/prefetch/hit") == 2
+
+    asyncio.run(main())
+
+
+def test_expired_lease_requeued_with_original_score():
+    async def main():
+        queue = make_queue(lease_duration=0.05)
+        redis = queue.redis_client
+        queue.push(request("https://a.com/1", priority=3))
+        await queue.flush()
+        (member, score), = await redis.zrange(KEY, 0, -1, withscores=True)
+        await queue.fetch()
+        assert queue.pop() is not None
+        assert await redis.zcard(KEY) == 0
+        assert await redis.zcard(f"{KEY}:lease") == 1
+        await asyncio.sleep(0.1)
+        await queue.requeue_expired()
+        assert await redis.zrange(KEY, 0, -1, withscores=True) == [(member, score)]
+        assert await redis.zcard(f"{KEY}:lease") == 0
+        assert await redis.hlen(f"{KEY}:lease_score") == 0
+        assert queue.crawler.stats.get_value("scheduler/lease/requeued") == 1
+
+    asyncio.run(main())
+
+
+def test_renewed_lease_not_requeued():
+    async def main():
+        queue = make_queue(lease_duration=0.2)
+        queue.push(request("https://a.com/1"))
+        await queue.fetch()
+        assert queue.pop() is not None
+        for _ in range(3):
+            await asyncio.sleep(0.1)
+            await queue.renew_leases()
+            await queue.requeue_expired()
+        assert await queue.redis_client.zcard(KEY) == 0
+
+    asyncio.run(main())
+
+
+def test_retried_request_acks_original_lease():
+    async def main():
+        queue = make_queue()
+        queue.push(request("https://a.com/1"))
+        original, = await pop_all(queue)
+        retry = original.replace(dont_filter=True)
+        queue.ack(retry)
+        queue.push(delay_request(retry, 60))
+        assert await queue.exact_size() == 1
+        assert await queue.redis_client.zcard(f"{KEY}:lease") == 0
+
+    asyncio.run(main())
+
+
+def test_child_request_does_not_ack_parent_lease():
+    async def main():
+        queue = make_queue()
+        queue.push(request("https://a.com/1"))
+        parent, = await pop_all(queue)
+        response = HtmlResponse(parent.url, request=parent)
+        children = [KRequest("https://a.com/2", meta=response.meta), parent.copy()]
+        middleware = AckSignalMiddleware(queue.crawler)
+        for child in middleware.process_spider_output(response, children[:], queue.crawler.spider):
+            assert "mq_lease" not in child.meta
+            queue.ack(child)
+            queue.push(child)
+        # 子请求入队不会确认父请求的租约，父请求由回调输出消费完后的ack确认
+        assert parent.meta["mq_lease"] in queue.leases
+        queue.ack(parent)
+        assert queue.leases == {}
+        assert await queue.exact_size() == 2
+
+    asyncio.run(main())
+
+
+def test_priority_bands_then_fifo():
+    async def main():
+        queue = make_queue(prefetch=10)
+        now = time.time() - 10
+        # 同一优先级内按就绪时间先进先出，不受写入顺序影响
+        queue.push(request("https://a.com/low-2", priority=-5, ready_at=now + 2))
+        queue.push(request("https://a.com/high-2", priority=10, ready_at=now + 2))
+        queue.push(request("https://a.com/mid-1", priority=0, ready_at=now + 1))
+        queue.push(request("https://a.com/high-1", priority=10, ready_at=now + 1))
+        queue.push(request("https://a.com/low-1", priority=-5, ready_at=now + 1))
+        return [r.url.rsplit("/", 1)[1] for r in await pop_all(queue)]
+
+    assert asyncio.run(main()) == ["high-1", "high-2", "mid-1", "low-1", "low-2"]
+
+
+def test_shard_pruned_only_when_queue_and_leases_empty():
+    async def main():
+        queue = make_queue(ShardedRedisQueue, prefetch=10)
+        redis = queue.redis_client
+        queue.push(request("https://a.com/1"))
+        queue.push(request("https://b.com/1"))
+        queue.push(request("https://b.com/2"))
+        await queue.flush()
+        assert await redis.smembers(f"{KEY}:shards") == {b"a.com", b"b.com"}
+        requests = await pop_all(queue)
+        assert sorted(r.url for r in requests) == ["https://a.com/1", "https://b.com/1", "https://b.com/2"]
+        # 分片已空但租约还在，不能移除
+        assert await redis.smembers(f"{KEY}:shards") == {b"a.com", b"b.com"}
+        for r in requests:
+            queue.ack(r)
+        await queue.flush()
+        await queue.fetch()
+        assert await redis.smembers(f"{KEY}:shards") == set()
+        assert queue.shards == set()
+        assert await redis.exists(f"{KEY}:shard:a.com:bands", f"{KEY}:shard:b.com:bands") == 0
+
+    asyncio.run(main())
+
+
+def test_shard_fetch_round_robin():
+    async def main():
+        queue = make_queue(ShardedRedisQueue, prefetch=4)
+        for i in range(6):
+            queue.push(request(f"https://a.com/{i}"))
+        queue.push(request("https://b.com/1"))
+        await queue.fetch()
+        # 一个域名的请求不会占满预取缓冲区
+        hosts = [urlparse(r.url).hostname for r in (queue.pop() for _ in range(4)) if r is not None]
+        assert "b.com" in hosts
+
+    asyncio.run(main())
+
+
+def test_disk_spill_merge_order(tmp_path):
+    async def main():
+        queue = make_queue(DiskSpillQueue, memory_size=8, spill_dir=str(tmp_path), read_ahead=3)
+        queue.open()
+        rnd = random.Random(1)
+        now = time.time() - 100
+        pushed = []
+        for i in range(200):
+            r = request(f"https://a.com/{i}", priority=rnd.randint(-3, 3), ready_at=now + rnd.random() * 50)
+            pushed.append((queue.score_of(r.copy()), r.url))
+            queue.push(r)
+        assert len(queue) == 200
+        assert queue.crawler.stats.get_value("scheduler/disk/spilled") > 0
+        assert queue.crawler.stats.get_value("scheduler/disk/max_segments") > 1
+        popped = []
+        while (r := queue.pop()) is not None:
+            popped.append(r.url)
+        assert popped == [url for _, url in sorted(pushed)]
+        assert len(queue) == 0
+        assert os.path.getsize(queue.path) == 0
+        await queue.close()
+        assert not os.path.exists(queue.path)
+
+    asyncio.run(main())
+
+
+def test_disk_spill_files_not_shared(tmp_path):
+    async def main():
+        first = make_queue(DiskSpillQueue, memory_size=2, spill_dir=str(tmp_path))
+        second = make_queue(DiskSpillQueue, memory_size=2, spill_dir=str(tmp_path))
+        first.open()
+        second.open()
+        assert first.path != second.path
+        now = time.time() - 10
+        for i in range(5):
+            first.push(request(f"https://a.com/first-{i}", ready_at=now + i))
+        # 第二个进程打开同名队列不会截断第一个进程的溢出数据
+        for i in range(5):
+            second.push(request(f"https://a.com/second-{i}", ready_at=now + i))
+        assert [first.pop().url for _ in range(5)] == [f"https://a.com/first-{i}" for i in range(5)]
+        assert [second.pop().url for _ in range(5)] == [f"https://a.com/second-{i}" for i in range(5)]
+        await first.close()
+        await second.close()
+        assert list(tmp_path.iterdir()) == []
+
+    asyncio.run(main())
+
+
+def test_exact_size_reaches_zero_after_ack():
+    async def main():
+        queue = make_queue(prefetch=10)
+        for i in range(3):
+            queue.push(request(f"https://a.com/{i}"))
+        requests = await pop_all(queue)
+        assert len(requests) == 3
+        # 处理中的请求仍持有租约，计入待处理数量
+        assert await queue.exact_size() == 3
+        for r in requests:
+            queue.ack(r)
+        assert await queue.exact_size() == 0
+        await queue.confirm_empty()
+        assert len(queue) == 0
+
+    asyncio.run(main())
+
+
+def test_open_before_redis_client_attached(caplog):
+    async def main():
+        queue = make_queue(size_sync_interval=0.05)
+        redis_client, queue.crawler.redis_client = queue.crawler.redis_client, None
+        queue.open()
+        queue.push(request("https://a.com/1"))
+        assert queue.pop() is None
+        await asyncio.sleep(0.2)
+        # 全局redis连接晚于队列打开建立
+        queue.crawler.redis_client = redis_client
+        popped = None
+        for _ in range(20):
+            await asyncio.sleep(0.1)
+            popped = queue.pop()
+            if popped is not None:
+                break
+        assert popped.url == "https://a.com/1"
+        queue.ack(popped)
+        await queue.close()
+
+    with caplog.at_level("ERROR"):
+        asyncio.run(main())
+    assert not [record for record in caplog.records if record.levelname == "ERROR"]
+
+
+def test_delayed_retry_score():
+    queue = make_queue()
+    now = time.time()
+    score = queue.score_of(delay_request(request("https://a.com/1", priority=2), 30))
+    assert score // BAND_WIDTH == queue.score_of(request("https://a.com/2", priority=2)) // BAND_WIDTH
+    assert abs(score % BAND_WIDTH - (now + 30) * 1000) < 1000
+
+
+def test_delayed_retry_middleware_sets_ready_time():
+    queue = make_queue()
+    middleware = DelayedRetryMiddleware(queue.crawler.settings)
+    now = time.time()
+    retry = middleware._retry(request("https://a.com/1"), "503 Service Unavailable", queue.crawler.spider)
+    assert retry.meta["retry_times"] == 1
+    # http_503的退避基数为5秒，第一次重试在2.5到5秒之间
+    assert now + 2.5 <= retry.meta["mq_ready_at"] <= time.time() + 5
+    assert queue.crawler.stats.get_value("retry/delayed") == 1
+
+
+def test_delayed_request_fetched_when_ready():
+    async def main():
+        queue = make_queue(prefetch=10)
+        queue.push(delay_request(request("https://a.com/later"), 0.2))
+        queue.push(request("https://a.com/now"))
+        assert [r.url for r in await pop_all(queue)] == ["https://a.com/now"]
+        await asyncio.sleep(0.25)
+        assert [r.url for r in await pop_all(queue)] == ["https://a.com/later"]
+
+    asyncio.run(main())
+
+
+def test_disk_spill_delayed_request(tmp_path):
+    async def main():
+        queue = make_queue(DiskSpillQueue, memory_size=4, spill_dir=str(tmp_path))
+        queue.open()
+        queue.push(delay_request(request("https://a.com/later", priority=10), 0.2))
+        queue.push(request("https://a.com/now"))
+        assert queue.pop().url == "https://a.com/now"
+        assert queue.pop() is None
+        assert len(queue) == 1
+        await asyncio.sleep(0.25)
+        assert queue.pop().url == "https://a.com/later"
+        await queue.close()
+
+    asyncio.run(main())
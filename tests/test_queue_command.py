@@ -0,0 +1,89 @@
+from argparse import Namespace
+from types import SimpleNamespace
+
+import fakeredis
+import pytest
+from scrapy import Spider
+from scrapy.settings import Settings
+from scrapy.utils.test import get_crawler
+
+from scrapy_konne.commands import queue as queue_command
+from scrapy_konne.core.mq import RedisQueue
+from scrapy_konne.core.serializer import CompactMsgpackSerializer, MsgpackSerializer
+from scrapy_konne.http import KRequest
+
+KEY = "request_queue:t"
+MSGPACK = "scrapy_konne.core.serializer.MsgpackSerializer"
+COMPACT = "scrapy_konne.core.serializer.CompactMsgpackSerializer"
+
+
+class TSpider(Spider):
+    name = "t"
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(queue_command.Redis, "from_url", classmethod(lambda cls, url, **kwargs: client))
+    return client
+
+
+def make_command():
+    command = queue_command.Queue()
+    command.settings = Settings({"REDIS_URL": "redis://localhost", "REDIS_SERIALIZER": MSGPACK})
+    command.crawler_process = SimpleNamespace(create_crawler=lambda name: get_crawler(TSpider))
+    return command
+
+
+def score(priority, ready_ms):
+    return (RedisQueue.PRIORITY_RANGE - priority) * RedisQueue.BAND_WIDTH + ready_ms
+
+
+def fill_queue(client):
+    """写入普通队列、分片队列和租约中的请求，返回每个队列key应有的 url -> 分数"""
+    serializer = MsgpackSerializer(TSpider())
+    expected = {}
+    for queue_key, host, leased in ((KEY, "a.com", False), (f"{KEY}:shard:b.com", "b.com", True)):
+        expected[queue_key] = {}
+        for i in range(5):
+            url = f"https://{host}/{i}"
+            member = serializer.serialize(KRequest(url, priority=i % 2))
+            expected[queue_key][url] = score(i % 2, 1000 + i)
+            if leased and i < 2:
+                # 租约中的请求以租约到期时间为分数，原分数保存在lease_score
+                client.zadd(f"{queue_key}:lease", {member: 99999})
+                client.hset(f"{queue_key}:lease_score", member, expected[queue_key][url])
+            else:
+                client.zadd(queue_key, {member: expected[queue_key][url]})
+    client.sadd(f"{KEY}:shards", "b.com")
+    return expected
+
+
+def restored(client, serializer_cls):
+    serializer = serializer_cls(TSpider())
+    queues = {}
+    for queue_key in (KEY, f"{KEY}:shard:b.com"):
+        queues[queue_key] = {}
+        for member, score in client.zrange(queue_key, 0, -1, withscores=True):
+            request = serializer.deserialize(member)
+            # 成员按目标序列化器编码
+            assert serializer.serialize(request) == member
+            queues[queue_key][request.url] = int(score)
+    return queues
+
+
+@pytest.mark.parametrize("serializer, serializer_cls", [(None, MsgpackSerializer), (COMPACT, CompactMsgpackSerializer)])
+def test_export_import_round_trip(client, tmp_path, serializer, serializer_cls):
+    expected = fill_queue(client)
+    path = str(tmp_path / "t.queue.gz")
+    opts = Namespace(redis_url=None, batch=3, serializer=serializer)
+    make_command().run(["export", "t", path], opts)
+    client.flushall()
+    make_command().run(["import", "t", path], opts)
+    assert restored(client, serializer_cls) == expected
+    # 租约中的请求导入后回到队列，分片和分段一并恢复
+    assert client.smembers(f"{KEY}:shards") == {b"b.com"}
+    assert not client.exists(f"{KEY}:shard:b.com:lease")
+    for queue_key, scores in expected.items():
+        bands = {str(s // RedisQueue.BAND_WIDTH).encode() for s in scores.values()}
+        assert set(client.zrange(f"{queue_key}:bands", 0, -1)) == bands
@@ -0,0 +1,75 @@
+import asyncio
+
+import fakeredis
+from scrapy import Spider
+from scrapy.utils.test import get_crawler
+
+from scrapy_konne.extensions.redis import GlobalAsyncRedisExtension
+
+KEY = "dupefilter:t"
+DAY_MS = 86400000
+
+
+class TSpider(Spider):
+    name = "t"
+
+
+def make_extension(client, **settings):
+    crawler = get_crawler(TSpider, {"REDIS_URL": "redis://localhost", **settings})
+    extension = GlobalAsyncRedisExtension.from_crawler(crawler)
+    extension.client = client
+    return extension
+
+
+def test_trim_below_in_batches_keeps_cutoff_ties():
+    async def main():
+        client = fakeredis.aioredis.FakeRedis()
+        await client.zadd(KEY, {f"old{i}": i // 3 for i in range(30)})
+        await client.zadd(KEY, {f"cutoff{i}": 10 for i in range(5)})
+        extension = make_extension(client, DUPEFILTER_TRIM_BATCH=4)
+        # 按分数删除，批次边界上分数相同的成员一起删除，分数等于截止时间的成员保留
+        assert await client.eval(extension.trim_below_script, 1, KEY, 10, 4) == 6
+        assert await extension.trim_oldest(extension.trim_below_script, KEY, 10) == 24
+        assert await client.zcard(KEY) == 5
+        assert await client.zrangebyscore(KEY, "-inf", "(10") == []
+
+    asyncio.run(main())
+
+
+def test_trim_excess_in_batches_never_below_max_size():
+    async def main():
+        client = fakeredis.aioredis.FakeRedis()
+        await client.zadd(KEY, {f"m{i}": i // 10 for i in range(100)})
+        extension = make_extension(client, DUPEFILTER_TRIM_BATCH=7)
+        assert await client.eval(extension.trim_excess_script, 1, KEY, 30, 7) == 7
+        # 多个worker同时执行也不会删到上限以下
+        removed = await asyncio.gather(
+            *(extension.trim_oldest(extension.trim_excess_script, KEY, 30) for _ in range(4))
+        )
+        assert sum(removed) == 63
+        assert await client.zcard(KEY) == 30
+        assert await client.zrange(KEY, 0, 0) == [b"m70"]
+        assert await extension.trim_oldest(extension.trim_excess_script, KEY, 30) == 0
+
+    asyncio.run(main())
+
+
+def test_trim_lock_skips_second_worker():
+    async def main():
+        client = fakeredis.aioredis.FakeRedis()
+        now = await client.time()
+        now_ms = now[0] * 1000
+        await client.zadd(KEY, {f"m{i}": now_ms - i * DAY_MS for i in range(60)})
+        settings = {"DUPEFILTER_RETENTION_DAYS": 30, "DUPEFILTER_MAX_SIZE": 20, "DUPEFILTER_TRIM_BATCH": 5}
+        first, second = make_extension(client, **settings), make_extension(client, **settings)
+        spider = TSpider.from_crawler(get_crawler(TSpider))
+        spider.crawler.stats.open_spider(spider)
+        removed = await asyncio.gather(first.trim_dupefilter(spider, KEY), second.trim_dupefilter(spider, KEY))
+        assert sorted(removed) == [0, 40]
+        assert await client.zcard(KEY) == 20
+        assert 0 < await client.pttl(f"{KEY}:trim_lock") <= 600000
+        assert spider.crawler.stats.get_value("dupefilter/trim/removed") == 40
+        # 同一周期内再次执行也跳过
+        assert await first.trim_dupefilter(spider, KEY) == 0
+
+    asyncio.run(main())
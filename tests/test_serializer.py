@@ -0,0 +1,185 @@
+from datetime import datetime
+
+import pytest
+from scrapy import FormRequest, Request, Spider
+from scrapy.http import JsonRequest
+from scrapy.utils.request import request_from_dict
+from scrapy.utils.test import get_crawler
+
+from scrapy_konne.core.serializer import (
+    CompactMsgpackSerializer,
+    MsgpackSerializer,
+    ZstdSerializer,
+    packb,
+    unpack_ext,
+    unpackb,
+)
+from scrapy_konne.http import KFormRequest, KJsonRequest, KRequest
+from scrapy_konne.items import DetailDataItem, IncreamentItem
+
+
+class TSpider(Spider):
+    name = "t"
+
+    def parse_detail(self, response):
+        pass
+
+    def handle_error(self, failure):
+        pass
+
+
+spider = TSpider()
+item = DetailDataItem(title="标题", publish_time=datetime(2024, 4, 12, 23, 20, 50), source_url="https://a.com/1")
+
+REQUESTS = {
+    "krequest": KRequest("https://a.com/list"),
+    "krequest_full": KRequest(
+        "https://a.com/detail?id=1",
+        callback=spider.parse_detail,
+        errback=spider.handle_error,
+        method="POST",
+        headers={"User-Agent": "konne"},
+        body=b"a=1",
+        cookies={"sid": "1"},
+        meta={"depth": 2, "fetched_at": datetime(2024, 1, 1, 8, 0)},
+        priority=5,
+        dont_filter=True,
+        flags=["retry"],
+        cb_kwargs={"item": item, "increment": IncreamentItem(source_url="https://a.com/2", increment_id=2)},
+        filter_url="https://a.com/1",
+        cursor=12345,
+        rotate_proxy=True,
+    ),
+    "request": Request("https://a.com/plain", callback=spider.parse_detail, meta={"k": [1, 2]}),
+    "form_request": FormRequest("https://a.com/form", formdata={"q": "关键词", "page": "2"}, callback=spider.parse_detail),
+    "json_request": JsonRequest("https://a.com/api", data={"page": 1}, dumps_kwargs={"ensure_ascii": False}),
+    "kform_request": KFormRequest("https://a.com/form", formdata={"q": "1"}, filter_url="https://a.com/3"),
+    "kjson_request": KJsonRequest("https://a.com/api", data={"ids": [1, 2]}, cursor=7),
+}
+
+
+def expected_of(request):
+    return request_from_dict(request.to_dict(spider=spider), spider=spider)
+
+
+def assert_same(restored, expected):
+    assert type(restored) is type(expected)
+    assert restored.to_dict(spider=spider) == expected.to_dict(spider=spider)
+
+
+@pytest.mark.parametrize("name", REQUESTS)
+def test_compact_round_trip(name):
+    serializer = CompactMsgpackSerializer(spider)
+    request = REQUESTS[name]
+    assert_same(serializer.deserialize(serializer.serialize(request)), expected_of(request))
+
+
+@pytest.mark.parametrize("name", REQUESTS)
+def test_msgpack_round_trip(name):
+    serializer = MsgpackSerializer(spider)
+    request = REQUESTS[name]
+    assert_same(serializer.deserialize(serializer.serialize(request)), expected_of(request))
+
+
+def test_compact_reads_msgpack_data():
+    request = REQUESTS["krequest_full"]
+    restored = CompactMsgpackSerializer(spider).deserialize(MsgpackSerializer(spider).serialize(request))
+    assert_same(restored, expected_of(request))
+
+
+def test_items_restored_as_items():
+    serializer = CompactMsgpackSerializer(spider)
+    restored = serializer.deserialize(serializer.serialize(REQUESTS["krequest_full"]))
+    assert restored.cb_kwargs["item"] == item
+    assert type(restored.cb_kwargs["increment"]) is IncreamentItem
+    assert restored.meta["fetched_at"] == datetime(2024, 1, 1, 8, 0)
+
+
+def test_unknown_method_id_raises_value_error():
+    serializer = CompactMsgpackSerializer(spider)
+    unknown = next(i for i in range(1 << 16) if i not in serializer.method_names)
+    with pytest.raises(ValueError):
+        serializer.deserialize(packb({CompactMsgpackSerializer.URL: "https://a.com", CompactMsgpackSerializer.CALLBACK: unknown}))
+    with pytest.raises(ValueError):
+        serializer.deserialize(packb({CompactMsgpackSerializer.URL: "https://a.com", CompactMsgpackSerializer.CALLBACK: "missing"}))
+
+
+def test_ext_round_trip():
+    increment = IncreamentItem(title="自增", source_url="https://a.com/2", increment_id=2)
+    aware = datetime.fromisoformat("2024-04-12T23:20:50.520000+02:00")
+    value = {"items": [item, increment], "at": aware, 1: {"nested": datetime(2024, 1, 1)}}
+    restored = unpackb(packb(value))
+    assert restored == value
+    assert [type(obj) for obj in restored["items"]] == [DetailDataItem, IncreamentItem]
+    assert restored["at"].utcoffset() == aware.utcoffset()
+
+
+def test_unknown_ext_type_raises_value_error():
+    with pytest.raises(ValueError):
+        unpack_ext(99, b"")
+
+
+def zstd_serializer(dict_dir):
+    crawler = get_crawler(TSpider, {"ZSTD_DICT_DIR": str(dict_dir)})
+    return ZstdSerializer(TSpider.from_crawler(crawler))
+
+
+def train_zstd_dictionary(dict_dir):
+    zstandard = pytest.importorskip("zstandard")
+    inner = MsgpackSerializer(spider)
+    samples = [
+        inner.serialize(KRequest(f"https://a.com/detail?id={i}", callback=spider.parse_detail, cursor=i, priority=i % 5))
+        for i in range(1000)
+    ]
+    dictionary = zstandard.train_dictionary(2048, samples)
+    (dict_dir / f"{spider.name}.{dictionary.dict_id()}.zdict").write_bytes(dictionary.as_bytes())
+    return dictionary.dict_id()
+
+
+@pytest.mark.parametrize("name", REQUESTS)
+def test_zstd_round_trip(name, tmp_path):
+    pytest.importorskip("zstandard")
+    request = REQUESTS[name]
+    without_dict = zstd_serializer(tmp_path)
+    data = without_dict.serialize(request)
+    assert data[:1] == without_dict.WITHOUT_DICT
+    assert_same(without_dict.deserialize(data), expected_of(request))
+    train_zstd_dictionary(tmp_path)
+    with_dict = zstd_serializer(tmp_path)
+    data = with_dict.serialize(request)
+    assert data[:1] == with_dict.WITH_DICT
+    assert_same(with_dict.deserialize(data), expected_of(request))
+
+
+def test_zstd_reads_legacy_and_undictionaried_data(tmp_path):
+    pytest.importorskip("zstandard")
+    request = REQUESTS["krequest_full"]
+    legacy = MsgpackSerializer(spider).serialize(request)
+    without_dict = zstd_serializer(tmp_path).serialize(request)
+    train_zstd_dictionary(tmp_path)
+    serializer = zstd_serializer(tmp_path)
+    # 未压缩的旧数据和训练字典前写入的数据都能读取
+    assert_same(serializer.deserialize(legacy), expected_of(request))
+    assert_same(serializer.deserialize(without_dict), expected_of(request))
+
+
+def test_zstd_missing_dictionary_raises_value_error(tmp_path):
+    pytest.importorskip("zstandard")
+    dict_id = train_zstd_dictionary(tmp_path)
+    data = zstd_serializer(tmp_path).serialize(REQUESTS["krequest"])
+    (tmp_path / f"{spider.name}.{dict_id}.zdict").unlink()
+    with pytest.raises(ValueError, match=str(dict_id)):
+        zstd_serializer(tmp_path).deserialize(data)
+
+
+@pytest.mark.parametrize("with_dictionary", [False, True])
+def test_zstd_corrupt_frame_raises_value_error(with_dictionary, tmp_path):
+    pytest.importorskip("zstandard")
+    if with_dictionary:
+        train_zstd_dictionary(tmp_path)
+    serializer = zstd_serializer(tmp_path)
+    data = serializer.serialize(REQUESTS["krequest_full"])
+    with pytest.raises(ValueError):
+        serializer.deserialize(data[:1] + b"\xff" * 8 + data[9:])
+    with pytest.raises(ValueError):
+        serializer.deserialize(data[: len(data) // 2])
@@ -0,0 +1,53 @@
+import pytest
+from scrapy import Spider
+from scrapy.utils.test import get_crawler
+
+from scrapy_konne.exceptions import MemorySetDuplicateItem
+from scrapy_konne.items import DetailDataItem
+from scrapy_konne.pipelines.filter import SetFilterPipeline
+
+
+class TSpider(Spider):
+    name = "t"
+
+
+def make_pipeline(size):
+    crawler = get_crawler(TSpider, {"SET_FILTER_SIZE": size})
+    crawler.spider = TSpider.from_crawler(crawler)
+    crawler.stats.open_spider(crawler.spider)
+    return SetFilterPipeline.from_crawler(crawler)
+
+
+def process(pipeline, i):
+    item = DetailDataItem(source_url=f"https://a.com/{i}")
+    return pipeline.process_item(item, pipeline.crawler.spider)
+
+
+def test_default_size():
+    crawler = get_crawler(TSpider)
+    assert SetFilterPipeline.from_crawler(crawler).max_size == 200_000
+
+
+def test_duplicate_dropped_and_lru_eviction():
+    pipeline = make_pipeline(3)
+    for i in range(3):
+        process(pipeline, i)
+    # 重复出现的指纹移到最新，之后写入的指纹淘汰最久未出现的
+    with pytest.raises(MemorySetDuplicateItem):
+        process(pipeline, 0)
+    process(pipeline, 3)
+    process(pipeline, 1)
+    with pytest.raises(MemorySetDuplicateItem):
+        process(pipeline, 0)
+    stats = pipeline.crawler.stats
+    assert stats.get_value("set_filter/size") == 3
+    assert stats.get_value("set_filter/evicted") == 2
+    assert stats.get_value("set_filter/false_positive_rate") == 3 / 2**128
+
+
+def test_spider_closed_clears_fingerprints():
+    pipeline = make_pipeline(10)
+    process(pipeline, 0)
+    pipeline.spider_closed(pipeline.crawler.spider)
+    assert len(pipeline.fp_seen) == 0
+    process(pipeline, 0)